@@ -15,10 +15,100 @@ from hivwholeseq.filenames import root_data_folder
 
 from filenames import get_figure_folder
 from util import store_data, load_data, fig_width, fig_fontsize
+from cache import cached_collect, use_stored_data
+from cohort import load_patient
+from parallel import map_patient_regions, add_jobs_argument
+
+
+
+# Classes
+class LDHistogram(object):
+    '''Distance histogram of linkage disequilibrium, accumulated sample by sample
+
+    Only pairs of sites closer than the last bin edge are looked at: with the sites
+    sorted by position, pairs at index offset k are visited for increasing k until
+    all of them are too far apart. Every pair is counted in both orders, as in the
+    full pair matrices.
+    '''
+    def __init__(self, bins):
+        self.bins = np.asarray(bins)
+        self.counts = np.zeros(len(self.bins) - 1, int)
+        self.LD = np.zeros(len(self.bins) - 1)
+        self.Dp = np.zeros(len(self.bins) - 1)
+
+
+    def add(self, positions, LD, Dp, cov, cov_min):
+        '''Add the pairs of sites with coverage of at least cov_min'''
+        positions = np.asarray(positions)
+        order = np.argsort(positions, kind='mergesort')
+        if (order != np.arange(len(order))).any():
+            positions = positions[order]
+            LD, Dp, cov = [m[np.ix_(order, order)] for m in (LD, Dp, cov)]
+
+        nbins = len(self.counts)
+        for k in xrange(1, len(positions)):
+            i = np.arange(len(positions) - k)
+            d = positions[k:] - positions[:-k]
+            if d.min() > self.bins[-1]:
+                break
+            # np.histogram bins are half open, except the last one
+            ind = np.minimum(np.searchsorted(self.bins, d, side='right') - 1, nbins - 1)
+            inrange = (d >= self.bins[0]) & (d <= self.bins[-1])
+            for i1, i2 in ((i, i + k), (i + k, i)):
+                good = inrange & (cov[i1, i2] >= cov_min)
+                self.counts += np.bincount(ind[good], minlength=nbins)
+                self.LD += np.bincount(ind[good], weights=LD[i1, i2][good], minlength=nbins)
+                self.Dp += np.bincount(ind[good], weights=Dp[i1, i2][good], minlength=nbins)
+
+
+    def merge(self, other):
+        '''Add the counts of another histogram with the same bins'''
+        if not np.array_equal(self.bins, other.bins):
+            raise ValueError('Cannot merge LD histograms with different bins')
+        self.counts += other.counts
+        self.LD += other.LD
+        self.Dp += other.Dp
+        return self
+
+
+    def get_means(self):
+        '''Mean r^2 and D' in each distance bin'''
+        return self.LD/(1e-10+self.counts), self.Dp/(1e-10+self.counts)
+
+
+
+# Functions
+def _LD_patient_fragment(pcode, frag, bins, dmin=40, dmin_pad=200, var_min=0.2, cov_min=200):
+    '''Distance histogram of LD (r^2 and D') of covered site pairs in one patient fragment'''
+    hist = LDHistogram(bins)
+    p = load_patient(pcode)
+    depth = p.get_fragment_depth(pad=False, limit_to_dilution=False)
+    depth_pad = p.get_fragment_depth(pad=True, limit_to_dilution=False)
+
+    for si, sample in enumerate(p.samples):
+
+        # check for sufficient depth
+        if ((depth[si][all_fragments.index(frag)] > dmin) or 
+            (depth_pad[si][all_fragments.index(frag)] > dmin_pad)):
+
+            positions, af2p, cov, af1p = sample.get_pair_frequencies(frag, var_min=var_min)
+
+            if positions is None:
+                continue
+            LD, Dp, p12 =  LDfunc(af2p, af1p, cov, cov_min=100)
+            hist.add(positions, LD, Dp, cov, cov_min)
+            print (pcode, si, frag,
+                   " # of positions:", len(positions),
+                   'depth:', depth[si][all_fragments.index(frag)])
+        else:
+            print (pcode, si, frag, "insufficient depth:",
+                   depth[si][all_fragments.index(frag)],
+                   depth_pad[si][all_fragments.index(frag)])
 
+    return hist
 
 
-def collect_data_LD(patients):
+def collect_data_LD(patients, jobs=1):
     '''Collect data for LD plot'''
     dmin = 40
     dmin_pad = 200
@@ -28,63 +118,23 @@ def collect_data_LD(patients):
     Dp_vs_distance = {}
     bins = np.arange(0,401,40)
     binc = (bins[:-1]+bins[1:])*0.5
-    for frag in all_fragments:
-        if frag not in ['F'+str(i) for i in xrange(1,7)]:
-            continue
-        dists = []
-        weights_LD = []
-        weights_Dp = []
-        for pcode in patients:
-            p = Patient.load(pcode)
-            depth = p.get_fragment_depth(pad=False, limit_to_dilution=False)
-            depth_pad = p.get_fragment_depth(pad=True, limit_to_dilution=False)
-
-            for si, sample in enumerate(p.samples):
-
-                # check for sufficient depth
-                if ((depth[si][all_fragments.index(frag)] > dmin) or 
-                    (depth_pad[si][all_fragments.index(frag)] > dmin_pad)):
-
-                    positions, af2p, cov, af1p = sample.get_pair_frequencies(frag, var_min=var_min)
-
-                    if positions is None:
-                        continue
-                    LD, Dp, p12 =  LDfunc(af2p, af1p, cov, cov_min=100)
-
-                    X,Y = np.meshgrid(positions, positions)
-                    np.fill_diagonal(cov, 0)
-                    dists.extend(np.abs(X-Y)[cov>=cov_min])
-                    weights_LD.extend(LD[cov>=cov_min])
-                    weights_Dp.extend(Dp[cov>=cov_min])
-                    print (pcode, si, frag,
-                           " # of positions:", len(positions),
-                           'depth:', depth[si][all_fragments.index(frag)])
-                else:
-                    print (pcode, si, frag, "insufficient depth:",
-                           depth[si][all_fragments.index(frag)],
-                           depth_pad[si][all_fragments.index(frag)])
-
-        yn,xn = np.histogram(dists, bins = bins)
-        y,x = np.histogram(dists, weights = weights_LD, bins=bins)
-        LD_vs_distance[frag] = y/(1e-10+yn)
-        y,x = np.histogram(dists, weights = weights_Dp, bins=bins)
-        Dp_vs_distance[frag]=y/(1e-10+yn)
+    fragments = [frag for frag in all_fragments if frag in ['F'+str(i) for i in xrange(1,7)]]
+    results = map_patient_regions(_LD_patient_fragment, patients, fragments, jobs=jobs,
+                                  patient_major=False, bins=bins, dmin=dmin, dmin_pad=dmin_pad,
+                                  var_min=var_min, cov_min=cov_min)
+    for fi, frag in enumerate(fragments):
+        hist = LDHistogram(bins)
+        for hist_p in results[fi*len(patients):(fi+1)*len(patients)]:
+            hist.merge(hist_p)
+        LD_vs_distance[frag], Dp_vs_distance[frag] = hist.get_means()
 
     for pcr in ['PCR1', 'PCR2']:
         positions, af2p, cov, af1p = control_LD(pcr, var_min=var_min)
         LD, Dp, p12 =  LDfunc(af2p, af1p, cov, cov_min=100)
 
-        X,Y = np.meshgrid(positions, positions)
-        np.fill_diagonal(cov, 0)
-        dists = np.abs(X-Y)[cov>=cov_min].flatten()
-        weights_LD = LD[cov>=cov_min].flatten()
-        weights_Dp = Dp[cov>=cov_min].flatten()
-
-        yn,xn = np.histogram(dists, bins = bins)
-        y,x = np.histogram(dists, weights = weights_LD, bins=bins)
-        LD_vs_distance[pcr] = y/(1e-10+yn)
-        y,x = np.histogram(dists, weights = weights_Dp, bins=bins)
-        Dp_vs_distance[pcr]=y/(1e-10+yn)
+        hist = LDHistogram(bins)
+        hist.add(positions, LD, Dp, cov, cov_min)
+        LD_vs_distance[pcr], Dp_vs_distance[pcr] = hist.get_means()
     data = {'Dp': Dp_vs_distance,
             'LDrsq': LD_vs_distance,
             'bins': bins, 'binc': binc,
@@ -96,15 +146,51 @@ def collect_data_LD(patients):
 
 
 
-def control_LD(PCR='PCR1', fragment='F3', var_min=0.2):
-    control_fn = (root_data_folder+'specific/PCR_recombination/'+
-              'RNA_mix'+PCR+'_cocounts_'+fragment+'.pickle')
-    def load_cocounts(PCR, fragment):
-        '''Load cocounts from file'''
-        import cPickle as pickle
-        with open(control_fn, 'rb') as f:
-            return pickle.load(f)
+def get_control_folder():
+    '''Folder of the converted control cocounts (HIVEVO_CONTROL_FOLDER or the figure data folder)'''
+    folder = os.getenv('HIVEVO_CONTROL_FOLDER')
+    if folder is None:
+        username = os.path.split(os.getenv('HOME'))[-1]
+        folder = get_figure_folder(username, 'first')+'data/controls/'
+    return folder
+
+
+def load_control_cocounts(PCR='PCR1', fragment='F3', mmap_mode='r'):
+    '''Load the cocounts of a PCR recombination control, memory-mapped if possible
+
+    The cocounts are read from a .npy file in the control folder. If there is none
+    yet, the original pickle in the raw data folder is loaded and converted to .npy
+    for the next time.
+    '''
+    name = 'RNA_mix'+PCR+'_cocounts_'+fragment
+    fn = os.path.join(get_control_folder(), name+'.npy')
+    if os.path.isfile(fn):
+        return np.load(fn, mmap_mode=mmap_mode)
+
+    import cPickle as pickle
+    with open(root_data_folder+'specific/PCR_recombination/'+name+'.pickle', 'rb') as f:
+        acc = pickle.load(f)['cocounts']
+
+    folder = os.path.dirname(fn)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # created by a parallel run in the meantime
+            if not os.path.isdir(folder):
+                raise
+    # write atomically, parallel runs may read the file concurrently
+    fn_tmp = fn+'.'+str(os.getpid())+'.tmp.npy'
+    try:
+        np.save(fn_tmp, acc)
+        os.rename(fn_tmp, fn)
+    finally:
+        if os.path.isfile(fn_tmp):
+            os.remove(fn_tmp)
+    return acc
+
 
+def control_LD(PCR='PCR1', fragment='F3', var_min=0.2):
     # Globals
     samplenames = {'PCR1': 'MIX1_new_PCR1',
                    'PCR2': 'MIX1_new_PCR2'}
@@ -113,17 +199,15 @@ def control_LD(PCR='PCR1', fragment='F3', var_min=0.2):
     # F2 and F3 have no indels between the references, which makes life easier
     # F4 and F5 have indels
 
-    data = load_cocounts(PCR, fragment)
-    acc = data['cocounts']
+    acc = load_control_cocounts(PCR, fragment)
     af1p = np.array(acc[:,:,np.arange(acc.shape[2]), np.arange(acc.shape[3])].sum(axis=1),dtype=float)
     af1p = af1p/(1e-10+af1p.sum(axis=0))
     variable_sites = np.sum(af1p**2, axis=0)<1.-var_min
-    reduced_af1p = af1p[:,variable_sites]
     positions = np.where(variable_sites)[0]
-    n_variable_sites = reduced_af1p.shape[-1]
-    reduced_af2p = np.zeros((acc.shape[0], acc.shape[1], n_variable_sites, n_variable_sites), dtype = float)
-    for di,dsite in enumerate(positions):
-        reduced_af2p[:,:,di,:] = acc[:,:,dsite,variable_sites]
+
+    # only the variable site submatrix is read from the memory map
+    reduced_af2p = np.array(acc[np.ix_(np.arange(acc.shape[0]), np.arange(acc.shape[1]),
+                                       positions, positions)], dtype=float)
 
     reduced_acc_cov = np.array(reduced_af2p.sum(axis=1).sum(axis=0), dtype=int)
     reduced_af2p /= (1e-10+reduced_acc_cov) 
@@ -174,6 +258,7 @@ if __name__=="__main__":
     import argparse
     parser = argparse.ArgumentParser(description="make figure")
     parser.add_argument('--redo', action='store_true', help='recalculate data')
+    add_jobs_argument(parser)
     params = parser.parse_args()
 
     username = os.path.split(os.getenv('HOME'))[-1]
@@ -182,10 +267,11 @@ if __name__=="__main__":
     fn_data = fn_data + 'LD.pickle'
     patients = ['p' +str(i) for i in xrange(1,12) if i not in [4,7]]
 
-    if not os.path.isfile(fn_data) or params.redo:
-        data = collect_data_LD(patients)
-        store_data(data, fn_data)
-    else:
+    if use_stored_data(fn_data, redo=params.redo):
         data = load_data(fn_data)
+    else:
+        data = cached_collect(collect_data_LD, fn_data, args=(patients,),
+                              kwargs={'jobs': params.jobs}, redo=params.redo)
+        store_data(data, fn_data)
 
     plot_LD(data, fig_filename=foldername+'LD')
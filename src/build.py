@@ -0,0 +1,276 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Build runner for the figure scripts.
+
+            Every script is a node of a dependency graph, declared in the
+            manifest below together with the data files it produces and the
+            data files of other scripts it reads. The runner rebuilds the
+            nodes whose products are missing or older than their script or
+            their inputs, runs independent nodes concurrently, and prints the
+            wall time of every node at the end.
+
+            Usage: python build.py [--jobs N] [--force] [--dry-run] [node ...]
+'''
+# Modules
+import os
+import sys
+import time
+import subprocess
+
+from filenames import get_figure_folder
+from cache import get_local_modules
+
+
+# Globals
+# name: script, command line arguments, data products, required data products.
+# cached nodes use cache.cached_collect and are rerun without --redo (unless they
+# have no cache yet), the others only recompute their data if called with --redo.
+manifest = [
+    {'name': 'divdiv_correlation', 'script': 'divergence_diversity_correlation.py',
+     'products': ['divdiv_correlation.pickle']},
+    {'name': 'syn_nonsyn_divdiv', 'script': 'syn_nonsyn_divdiv.py', 'cached': True,
+     'products': ['syn_nonsyn_divergence.bundle'],
+     'requires': ['divdiv_correlation.pickle']},
+    {'name': 'genome_wide_divdiv', 'script': 'genome_wide_divdiv.py',
+     'products': ['genomewide_divdiv.pickle']},
+    {'name': 'evolutionary_rates', 'script': 'evolutionary_rates.py', 'cached': True,
+     'products': ['evolutionary_rates.pickle']},
+    {'name': 'evolutionary_rates_aa', 'script': 'evolutionary_rates.py', 'cached': True,
+     'args': ['--type', 'aa'],
+     'products': ['evolutionary_rates_aa.pickle']},
+    {'name': 'to_away', 'script': 'to_away.py', 'cached': True,
+     'products': ['to_away.bundle']},
+    {'name': 'to_away_aa', 'script': 'to_away.py', 'cached': True,
+     'args': ['--type', 'aa'],
+     'products': ['to_away_aa.bundle']},
+    {'name': 'subtype_correlation', 'script': 'subtype_correlation.py', 'cached': True,
+     'products': ['subtype_correlation.bundle']},
+    {'name': 'subtype_correlation_aa', 'script': 'subtype_correlation.py', 'cached': True,
+     'args': ['--type', 'aa'],
+     'products': ['subtype_correlation_aa.bundle']},
+    {'name': 'interpatient_correlation', 'script': 'interpatient_correlation.py', 'cached': True,
+     'products': ['interpatient_correlation.pickle']},
+    # interpatient_correlation --type aa is disabled: there is no amino acid
+    # collector yet, add the node back together with it
+    {'name': 'substitutions_CTL', 'script': 'substitutions_CTL.py', 'cached': True,
+     'products': ['substitutions_CTL.pickle']},
+    {'name': 'LD', 'script': 'LD.py', 'cached': True,
+     'products': ['LD.pickle']},
+    {'name': 'allele_freqs_control', 'script': 'allele_freqs_control.py',
+     'products': ['minor_alleles_example.pickle']},
+    {'name': 'allele_freqs_panels', 'script': 'allele_freqs_panels.py',
+     'products': ['allele_freqs_panels.pickle']},
+    {'name': 'allele_frequency_overlap', 'script': 'allele_frequency_overlap.py',
+     'products': ['allele_frequency_overlap.pickle']},
+    ]
+
+
+
+# Functions
+def get_data_folder():
+    username = os.path.split(os.getenv('HOME'))[-1]
+    return get_figure_folder(username, 'first')+'data/'
+
+
+def get_nodes(manifest=manifest):
+    '''Nodes of the manifest by name, with the names of the nodes they depend on'''
+    producer = {}
+    for node in manifest:
+        for product in node['products']:
+            if product in producer:
+                raise ValueError(product+' is produced by '+producer[product]+' and '+node['name'])
+            producer[product] = node['name']
+
+    nodes = {}
+    for node in manifest:
+        node = dict(node)
+        node.setdefault('args', [])
+        node.setdefault('requires', [])
+        node.setdefault('cached', False)
+        missing = [fn for fn in node['requires'] if fn not in producer]
+        if missing:
+            raise ValueError(node['name']+' requires unknown products: '+', '.join(missing))
+        node['depends'] = sorted(set(producer[fn] for fn in node['requires']))
+        nodes[node['name']] = node
+    return nodes
+
+
+def get_build_order(nodes, targets=None):
+    '''Topologically sorted names of the targets and all nodes they depend on'''
+    if targets is None:
+        targets = [node['name'] for node in manifest if node['name'] in nodes]
+
+    order = []
+    state = {}
+    def visit(name, path):
+        if name not in nodes:
+            raise ValueError('Unknown node: '+name)
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError('Dependency cycle: '+' -> '.join(path+[name]))
+        state[name] = 'visiting'
+        for dep in nodes[name]['depends']:
+            visit(dep, path+[name])
+        state[name] = 'done'
+        order.append(name)
+
+    for name in targets:
+        visit(name, [])
+    return order
+
+
+def is_outdated(node, data_folder, src_folder):
+    '''A node is outdated if a product is missing or older than an input
+
+    Inputs are the script, the local modules it imports (directly or indirectly),
+    and the data products it requires.
+    '''
+    mtimes = []
+    for fn in node['products']:
+        fn = data_folder+fn
+        if not os.path.exists(fn):
+            return True
+        mtimes.append(os.path.getmtime(fn))
+
+    inputs = get_local_modules(node['script'], src_folder)
+    inputs.extend(data_folder+fn for fn in node['requires'])
+    for fn in inputs:
+        if os.path.exists(fn) and os.path.getmtime(fn) > min(mtimes):
+            return True
+    return False
+
+
+def needs_redo(node, data_folder):
+    '''Cached nodes without a cache would load their outdated data file, see
+    cache.use_stored_data, so they are run with --redo like the uncached ones'''
+    from cache import get_cache_folder
+
+    if not node['cached']:
+        return True
+    return any(not os.path.isdir(get_cache_folder(data_folder+fn)) for fn in node['products'])
+
+
+def get_command(node, redo=False):
+    cmd = [sys.executable, node['script']] + list(node['args'])
+    if redo:
+        cmd.append('--redo')
+    return cmd
+
+
+def build(targets=None, jobs=1, force=False, dry_run=False, VERBOSE=1):
+    '''Rebuild the outdated targets and their dependencies
+
+    Parameters:
+       targets -- node names (default: all nodes of the manifest)
+       jobs    -- maximal number of scripts running at the same time
+       force   -- rerun all nodes, with --redo
+       dry_run -- only print what would be run
+
+    Returns:
+       dict with status ('up to date', 'built', 'failed', 'skipped') and wall time of each node
+    '''
+    src_folder = os.path.dirname(os.path.abspath(__file__))
+    data_folder = get_data_folder()
+    log_folder = data_folder+'build_logs/'
+    nodes = get_nodes()
+    order = get_build_order(nodes, targets)
+
+    # a node is rebuilt if it is outdated or one of its dependencies is rebuilt
+    rebuild = set()
+    for name in order:
+        node = nodes[name]
+        if force or is_outdated(node, data_folder, src_folder) or \
+           any(dep in rebuild for dep in node['depends']):
+            rebuild.add(name)
+
+    summary = {name: {'status': 'up to date', 'time': 0.0} for name in order}
+    pending = [name for name in order if name in rebuild]
+    if dry_run:
+        for name in pending:
+            print ' '.join(get_command(nodes[name], redo=force or needs_redo(nodes[name], data_folder)))
+        return summary
+
+    if pending and not os.path.isdir(log_folder):
+        os.makedirs(log_folder)
+
+    # environment of the scripts: no interactive plot windows
+    env = dict(os.environ)
+    env['MPLBACKEND'] = 'Agg'
+
+    running = {}
+    while pending or running:
+        # skip nodes whose dependencies failed
+        for name in list(pending):
+            if any(summary[dep]['status'] in ('failed', 'skipped') for dep in nodes[name]['depends']):
+                summary[name]['status'] = 'skipped'
+                pending.remove(name)
+
+        # start the nodes whose dependencies are done, in manifest order
+        for name in list(pending):
+            if len(running) >= jobs:
+                break
+            if any(dep in pending or dep in running for dep in nodes[name]['depends']):
+                continue
+            node = nodes[name]
+            cmd = get_command(node, redo=force or needs_redo(node, data_folder))
+            if VERBOSE:
+                print 'Starting', name+':', ' '.join(cmd[1:])
+            log = open(log_folder+name+'.log', 'w')
+            proc = subprocess.Popen(cmd, cwd=src_folder, env=env,
+                                    stdout=log, stderr=subprocess.STDOUT)
+            running[name] = (proc, log, time.time())
+            pending.remove(name)
+
+        time.sleep(0.1)
+        for name, (proc, log, t0) in running.items():
+            if proc.poll() is None:
+                continue
+            log.close()
+            del running[name]
+            summary[name]['time'] = time.time() - t0
+            summary[name]['status'] = 'built' if proc.returncode == 0 else 'failed'
+            if VERBOSE:
+                print 'Finished', name+':', summary[name]['status'], \
+                        '(%.1f s)' % summary[name]['time']
+
+    return summary
+
+
+def print_summary(summary, order):
+    print
+    print '%-30s %-12s %10s' % ('node', 'status', 'time [s]')
+    for name in order:
+        print '%-30s %-12s %10.1f' % (name, summary[name]['status'], summary[name]['time'])
+    print '%-30s %-12s %10.1f' % ('total (sum)', '', sum(s['time'] for s in summary.itervalues()))
+
+
+
+# Script
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="rebuild the data and figures of outdated scripts")
+    parser.add_argument('targets', nargs='*', help='nodes to build (default: all)')
+    parser.add_argument('--jobs', type=int, default=1, help='number of scripts to run in parallel')
+    parser.add_argument('--force', action='store_true', help='rerun all nodes with --redo')
+    parser.add_argument('--dry-run', action='store_true', help='only print the commands')
+    parser.add_argument('--list', action='store_true', help='list the nodes and exit')
+    params = parser.parse_args()
+
+    nodes = get_nodes()
+    if params.list:
+        for name in get_build_order(nodes):
+            node = nodes[name]
+            print name+':', ' '.join([node['script']]+node['args']), \
+                    '->', ', '.join(node['products']), \
+                    ('(needs '+', '.join(node['depends'])+')' if node['depends'] else '')
+        sys.exit()
+
+    targets = params.targets or None
+    summary = build(targets=targets, jobs=params.jobs, force=params.force,
+                    dry_run=params.dry_run)
+    if not params.dry_run:
+        print_summary(summary, get_build_order(nodes, targets))
+    if any(s['status'] in ('failed', 'skipped') for s in summary.itervalues()):
+        sys.exit(1)
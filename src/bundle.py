@@ -0,0 +1,225 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Directory bundles for the collected data of the figures.
+
+            A bundle stores a nested dict of results as a directory with one
+            file per leaf and a manifest.json describing the tree: DataFrames
+            as Parquet tables (pickle if pyarrow is not available or the table
+            cannot be converted), numeric arrays as .npy (masked arrays as data
+            and mask), and everything else as small pickles. Loading a bundle
+            returns a lazy mapping that reads a leaf only when it is accessed,
+            with arrays memory-mapped, so e.g. data['any']['to_away'] reads
+            that one table only.
+'''
+# Modules
+import os
+import re
+import json
+import shutil
+from collections import MutableMapping, OrderedDict
+import numpy as np
+
+
+# Globals
+manifest_name = 'manifest.json'
+
+
+
+# Classes
+class Bundle(MutableMapping):
+    '''Lazy, read-mostly view of a directory bundle
+
+    Leaves are loaded on first access and kept. Arrays are memory-mapped copy
+    on write (mmap_mode='c'), so they can be modified in memory without
+    changing the files. Assigned items are kept in memory only.
+    '''
+    def __init__(self, folder, tree, mmap_mode='c'):
+        self.folder = os.path.join(folder, '')
+        self.mmap_mode = mmap_mode
+        self._items = OrderedDict(tree['items'])
+        self._loaded = {}
+
+
+    def __getitem__(self, key):
+        if key not in self._loaded:
+            self._loaded[key] = _load_node(self._items[key], self.folder, self.mmap_mode)
+        return self._loaded[key]
+
+
+    def __setitem__(self, key, value):
+        if key not in self._items:
+            self._items[key] = None
+        self._loaded[key] = value
+
+
+    def __delitem__(self, key):
+        del self._items[key]
+        self._loaded.pop(key, None)
+
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+    def __repr__(self):
+        return 'Bundle('+repr(self.folder)+', keys='+repr(self.keys())+')'
+
+
+    def to_dict(self):
+        '''Load all leaves into a plain nested dict'''
+        return {key: (value.to_dict() if isinstance(value, Bundle) else value)
+                for key, value in self.iteritems()}
+
+
+
+# Functions
+def _ordered_str_keys(pairs):
+    # json returns unicode keys, convert them back to str as in the stored dicts
+    return OrderedDict((str(k) if isinstance(k, unicode) else k, v) for k, v in pairs)
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow
+        return True
+    except ImportError:
+        return False
+
+
+def _is_tree(obj):
+    '''Dicts with string keys are stored as subtrees, others as leaves'''
+    return isinstance(obj, dict) and all(isinstance(k, str) for k in obj)
+
+
+def _store_pickle(obj, fn):
+    import cPickle as pickle
+    with open(fn, 'wb') as f:
+        pickle.dump(obj, f, protocol=-1)
+
+
+def _load_pickle(fn):
+    import cPickle as pickle
+    with open(fn, 'rb') as f:
+        return pickle.load(f)
+
+
+def _store_node(obj, folder, path, files):
+    '''Store obj in folder, returning its manifest entry'''
+    import pandas as pd
+
+    def get_filename(ext):
+        name = re.sub('[^A-Za-z0-9_.-]+', '_', '.'.join(map(str, path)))[:80]
+        fn = '%04d_%s%s' % (len(files), name, ext)
+        files.append(fn)
+        return fn
+
+    if _is_tree(obj):
+        return {'type': 'dict',
+                'items': OrderedDict((k, _store_node(v, folder, path+[k], files))
+                                     for k, v in obj.iteritems())}
+
+    elif isinstance(obj, pd.DataFrame):
+        if _has_pyarrow():
+            fn = get_filename('.parquet')
+            try:
+                obj.to_parquet(folder+fn, engine='pyarrow')
+                return {'type': 'dataframe', 'format': 'parquet', 'file': fn}
+            except Exception:
+                # e.g. non-string column names or object columns of mixed type
+                files.pop()
+                if os.path.isfile(folder+fn):
+                    os.remove(folder+fn)
+        fn = get_filename('.pickle')
+        _store_pickle(obj, folder+fn)
+        return {'type': 'dataframe', 'format': 'pickle', 'file': fn}
+
+    elif isinstance(obj, np.ma.MaskedArray) and not obj.dtype.hasobject:
+        fn = get_filename('.npy')
+        np.save(folder+fn, obj.data)
+        fn_mask = None
+        if obj.mask is not np.ma.nomask:
+            fn_mask = get_filename('.mask.npy')
+            np.save(folder+fn_mask, obj.mask)
+        return {'type': 'masked_array', 'file': fn, 'mask': fn_mask}
+
+    elif isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        fn = get_filename('.npy')
+        np.save(folder+fn, obj)
+        return {'type': 'array', 'file': fn}
+
+    else:
+        fn = get_filename('.pickle')
+        _store_pickle(obj, folder+fn)
+        return {'type': 'pickle', 'file': fn}
+
+
+def _load_node(node, folder, mmap_mode='c'):
+    '''Load a manifest entry of the bundle in folder'''
+    if node['type'] == 'dict':
+        return Bundle(folder, node, mmap_mode=mmap_mode)
+
+    elif node['type'] == 'dataframe':
+        if node['format'] == 'parquet':
+            import pandas as pd
+            return pd.read_parquet(folder+node['file'], engine='pyarrow')
+        return _load_pickle(folder+node['file'])
+
+    elif node['type'] == 'masked_array':
+        data = np.load(folder+node['file'], mmap_mode=mmap_mode)
+        if node['mask'] is None:
+            return np.ma.array(data, copy=False)
+        return np.ma.array(data, mask=np.load(folder+node['mask'], mmap_mode=mmap_mode),
+                           copy=False)
+
+    elif node['type'] == 'array':
+        return np.load(folder+node['file'], mmap_mode=mmap_mode)
+
+    else:
+        return _load_pickle(folder+node['file'])
+
+
+def store_bundle(data, folder):
+    '''Store a nested dict of results as a directory bundle
+
+    The bundle is written to a temporary directory first and then replaces an
+    existing bundle of the same name, so readers never see a partial bundle.
+    '''
+    folder = folder.rstrip('/')
+    tmp_folder = folder+'.'+str(os.getpid())+'.tmp/'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    if not _is_tree(data):
+        data = {'data': data}
+        root = 'data'
+    else:
+        root = None
+    tree = _store_node(data, tmp_folder, [], [])
+    tree['root'] = root
+    with open(tmp_folder+manifest_name, 'w') as f:
+        json.dump(tree, f, indent=1)
+
+    if os.path.isdir(folder):
+        old_folder = folder+'.'+str(os.getpid())+'.old'
+        os.rename(folder, old_folder)
+        os.rename(tmp_folder, folder)
+        shutil.rmtree(old_folder)
+    else:
+        os.rename(tmp_folder, folder)
+
+
+def load_bundle(folder, mmap_mode='c'):
+    '''Open a directory bundle as a lazy mapping'''
+    folder = os.path.join(folder, '')
+    with open(folder+manifest_name) as f:
+        tree = json.load(f, object_pairs_hook=_ordered_str_keys)
+    bundle = Bundle(folder, tree, mmap_mode=mmap_mode)
+    if tree.get('root') is not None:
+        return bundle[tree['root']]
+    return bundle
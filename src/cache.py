@@ -0,0 +1,200 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Parameter-keyed cache for the collected data of the figures.
+
+            Every call to a collector function is stored in its own pickle,
+            named after a hash of the collector code, the local modules it
+            imports (cohort, util, ...), its arguments and the version of the
+            input data. Changing a parameter (cov_min, Sbins,
+            the patient list, ...) hence recomputes only the combinations that
+            have not been seen before, while everything else is reloaded.
+'''
+# Modules
+import os
+import hashlib
+import inspect
+
+from util import store_data, load_data, data_exists
+
+
+# Globals
+# arguments that do not change the result of a collector
+unkeyed_arguments = ('jobs', 'VERBOSE')
+
+
+
+# Functions
+def get_data_version():
+    '''Version tag of the input data (patients, trajectories, alignments)
+
+    The HIVEVO data do not carry a version themselves, so the tag is taken from
+    the environment variable HIVEVO_DATA_VERSION: bump it whenever the raw data
+    are updated to invalidate all cached results. Results computed from the
+    quantized trajectory store are tagged separately.
+    '''
+    from trajectory_store import get_store_folder, quantization_levels
+
+    version = os.getenv('HIVEVO_DATA_VERSION', '')
+    if get_store_folder() is not None:
+        version = version+'+q'+str(quantization_levels)
+    return version
+
+
+def _canonical(obj):
+    '''Stable, hashable representation of collector arguments'''
+    import numpy as np
+
+    if isinstance(obj, np.ndarray):
+        return ('ndarray', str(obj.dtype), obj.shape,
+                hashlib.sha1(np.ascontiguousarray(obj).tostring()).hexdigest())
+    elif isinstance(obj, (list, tuple)):
+        return (type(obj).__name__, tuple(_canonical(x) for x in obj))
+    elif isinstance(obj, dict):
+        return ('dict', tuple(sorted((repr(k), _canonical(v)) for k, v in obj.iteritems())))
+    elif isinstance(obj, (np.integer, np.floating)):
+        return obj.item()
+    elif callable(obj):
+        return get_code_hash(obj)
+    else:
+        return obj
+
+
+def _get_module_functions(func, seen=None):
+    '''The function and all functions of its module it references, recursively'''
+    import types
+
+    if seen is None:
+        seen = []
+    if func in seen:
+        return seen
+    seen.append(func)
+
+    code = getattr(func, 'func_code', None)
+    if code is None:
+        return seen
+    for name in code.co_names:
+        obj = func.func_globals.get(name)
+        if isinstance(obj, types.FunctionType) and obj.__module__ == func.__module__:
+            _get_module_functions(obj, seen)
+    return seen
+
+
+def get_code_hash(func):
+    '''Hash of the source code of a function and the module functions it calls
+
+    Falls back to the name of the function if the source is not available.
+    '''
+    sources = []
+    for f in _get_module_functions(func):
+        try:
+            sources.append(inspect.getsource(f))
+        except (IOError, TypeError):
+            sources.append(getattr(f, '__name__', repr(f)))
+    return hashlib.sha1(''.join(sources)).hexdigest()
+
+
+def get_local_modules(script, src_folder, seen=None):
+    '''Filenames of the script and of the modules in src_folder it imports, recursively'''
+    import ast
+
+    if seen is None:
+        seen = []
+    fn = os.path.join(src_folder, script)
+    if fn in seen or not os.path.isfile(fn):
+        return seen
+    seen.append(fn)
+
+    with open(fn) as f:
+        try:
+            tree = ast.parse(f.read(), fn)
+        except SyntaxError:
+            return seen
+    for stmt in ast.walk(tree):
+        if isinstance(stmt, ast.Import):
+            names = [alias.name for alias in stmt.names]
+        elif isinstance(stmt, ast.ImportFrom) and stmt.module and not stmt.level:
+            names = [stmt.module]
+        else:
+            continue
+        for name in names:
+            get_local_modules(name.split('.')[0]+'.py', src_folder, seen)
+    return seen
+
+
+def get_dependency_hash(func):
+    '''Hash of the local modules imported (directly or indirectly) by the module of func
+
+    The collector's own module is covered function by function by get_code_hash.
+    '''
+    try:
+        fn = inspect.getsourcefile(func)
+    except TypeError:
+        fn = None
+    if fn is None:
+        return ''
+    folder, script = os.path.split(os.path.abspath(fn))
+    sources = []
+    for fn_module in sorted(get_local_modules(script, folder)[1:]):
+        with open(fn_module) as f:
+            sources.append(os.path.basename(fn_module)+f.read())
+    return hashlib.sha1(''.join(sources)).hexdigest()
+
+
+def get_cache_key(collector, args=(), kwargs={}, data_version=None):
+    '''Key of a collector call: hash of code, local modules, arguments and data version
+
+    Arguments in unkeyed_arguments (e.g. the number of processes) are ignored.
+    '''
+    if data_version is None:
+        data_version = get_data_version()
+    kwargs = {k: v for k, v in kwargs.iteritems() if k not in unkeyed_arguments}
+    key = (collector.__module__, collector.__name__, get_code_hash(collector),
+           get_dependency_hash(collector),
+           _canonical(tuple(args)), _canonical(kwargs), data_version)
+    return hashlib.sha1(repr(key)).hexdigest()
+
+
+def get_cache_folder(fn_data):
+    '''Folder with the cached results that make up the data file fn_data'''
+    return os.path.splitext(fn_data)[0]+'_cache/'
+
+
+def use_stored_data(fn_data, redo=False):
+    '''True if a script should load its data file instead of collecting the data
+
+    That is the case if fn_data (or the pickle it replaces) exists, --redo is not given and there is no cache for
+    fn_data (e.g. data files copied without their cache). Otherwise the data are
+    collected with cached_collect, which recomputes what is not in the cache.
+    '''
+    return ((not redo) and data_exists(fn_data) and
+            (not os.path.isdir(get_cache_folder(fn_data))))
+
+
+def cached_collect(collector, fn_data, args=(), kwargs={}, redo=False,
+                   data_version=None, VERBOSE=1):
+    '''Return collector(*args, **kwargs), from the cache if possible
+
+    Parameters:
+       collector    -- function collecting the data
+       fn_data      -- data file the result belongs to, the cache lives next to it
+       redo         -- recompute and overwrite the cached result regardless
+       data_version -- version of the input data (default: get_data_version())
+    '''
+    key = get_cache_key(collector, args=args, kwargs=kwargs, data_version=data_version)
+    folder = get_cache_folder(fn_data)
+    fn_cache = folder+collector.__name__+'_'+key[:16]+'.pickle'
+
+    if (not redo) and os.path.isfile(fn_cache):
+        if VERBOSE:
+            print 'Loading', collector.__name__, 'from cache:', fn_cache
+        return load_data(fn_cache)
+
+    if VERBOSE:
+        print 'Collecting', collector.__name__, '(cache key '+key[:16]+')'
+    result = collector(*args, **kwargs)
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    store_data(result, fn_cache)
+    return result
@@ -0,0 +1,182 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Memoizing loader for patients and allele frequency trajectories.
+
+            Patient.load and get_allele_frequency_trajectories are called many
+            times with the same arguments within one script (once per collector
+            and reference mode). This module keeps the results in a per-process
+            LRU cache that evicts the least recently used entries once the
+            resident size exceeds a memory budget (default 2 GB, environment
+            variable HIVEVO_CACHE_MB or set_memory_budget). Trajectories can
+            be read from a quantized on-disk store, see trajectory_store.
+'''
+# Modules
+import os
+import sys
+from collections import OrderedDict
+import numpy as np
+
+from hivevo.hivevo.patients import Patient
+
+from references import get_patient_reference
+from coordinates import ReferenceFrame
+from trajectory_store import get_store_folder, load_trajectories
+
+
+# Globals
+_cache = OrderedDict()
+_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0,
+                'budget': int(float(os.getenv('HIVEVO_CACHE_MB', 2000)) * 2**20)}
+
+
+
+# Functions
+def _nbytes(obj):
+    '''Approximate resident size of a cached object in bytes'''
+    if isinstance(obj, np.ma.MaskedArray):
+        return obj.data.nbytes + np.ma.getmaskarray(obj).nbytes
+    elif isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif hasattr(obj, '__dict__'):
+        return sys.getsizeof(obj) + sum(_nbytes(v) for v in obj.__dict__.itervalues()
+                                        if isinstance(v, np.ndarray))
+    else:
+        return sys.getsizeof(obj)
+
+
+def _evict(nbytes_needed=0):
+    '''Drop least recently used entries until nbytes_needed fit into the budget'''
+    while _cache and _cache_stats['bytes'] + nbytes_needed > _cache_stats['budget']:
+        key, (obj, nbytes) = _cache.popitem(last=False)
+        _cache_stats['bytes'] -= nbytes
+        _cache_stats['evictions'] += 1
+
+
+def _cached(key, load):
+    '''Return the cached value for key, calling load() on a miss'''
+    if key in _cache:
+        _cache_stats['hits'] += 1
+        obj, nbytes = _cache.pop(key)
+        _cache[key] = (obj, nbytes)
+        return obj
+
+    _cache_stats['misses'] += 1
+    obj = load()
+    nbytes = _nbytes(obj)
+    if nbytes <= _cache_stats['budget']:
+        _evict(nbytes)
+        _cache[key] = (obj, nbytes)
+        _cache_stats['bytes'] += nbytes
+    return obj
+
+
+def set_memory_budget(nbytes):
+    '''Set the memory budget of the cache in bytes, evicting entries if needed'''
+    _cache_stats['budget'] = int(nbytes)
+    _evict()
+
+
+def clear_cache():
+    '''Empty the cache (statistics are kept)'''
+    _cache.clear()
+    _cache_stats['bytes'] = 0
+
+
+def cache_info():
+    '''Hits, misses, evictions, number of entries and resident bytes of the cache'''
+    info = dict(_cache_stats)
+    info['entries'] = len(_cache)
+    return info
+
+
+def print_cache_info():
+    info = cache_info()
+    print 'Cohort cache:', info['hits'], 'hits,', info['misses'], 'misses,', \
+            info['evictions'], 'evictions,', info['entries'], 'entries,', \
+            round(info['bytes'] / 2.0**20, 1), 'of', round(info['budget'] / 2.0**20, 1), 'MB'
+
+
+def load_patient(pcode):
+    '''Memoized Patient.load'''
+    return _cached(('patient', pcode), lambda: Patient.load(pcode))
+
+
+def get_allele_frequency_trajectories(pcode, region, cov_min=None, type='nuc'):
+    '''Memoized Patient.get_allele_frequency_trajectories
+
+    Returns a copy, so the caller can modify the trajectories (e.g. set the mask
+    or zero out low frequencies) without altering the cached version.
+
+    If a trajectory store is set (see trajectory_store), only the memory-mapped
+    quantized trajectories are cached, and the copy is decoded from them.
+    '''
+    aft = get_trajectory_view(pcode, region, cov_min=cov_min, type=type)
+    if get_store_folder() is not None:
+        return aft.to_masked_array()
+    return aft.copy()
+
+
+def get_trajectory_view(pcode, region, cov_min=None, type='nuc'):
+    '''Read-only trajectories of a patient region, to be indexed by the caller
+
+    With a trajectory store this is the memory-mapped QuantizedTrajectories entry,
+    indexing it (e.g. aft[:nt, :, positions]) decodes only the selected entries.
+    Without a store it is the cached masked array itself, which must not be modified.
+    '''
+    def load():
+        kwargs = {'type': type}
+        if cov_min is not None:
+            kwargs['cov_min'] = cov_min
+        return load_patient(pcode).get_allele_frequency_trajectories(region, **kwargs)
+
+    if get_store_folder() is not None:
+        return _cached(('aft_store', pcode, region, cov_min, type),
+                       lambda: load_trajectories(pcode, region, load, cov_min=cov_min,
+                                                 type=type))
+    return _cached(('aft', pcode, region, cov_min, type), load)
+
+
+def get_reference_frame(pcode, region, refname='HXB2', type='nuc'):
+    '''Memoized coordinate frame between a patient region and the reference'''
+    return _cached(('frame', pcode, region, refname, type),
+                   lambda: ReferenceFrame.from_patient(load_patient(pcode), region,
+                                                       refname=refname, type=type))
+
+
+def load_patient_region(pcode, region, cov_min=None, refname='HXB2', subtype='patient',
+                        type='nuc'):
+    '''Load trajectories of a patient region together with the reference quantities
+
+    Returns a dict with the patient, the trajectories, the map to the reference, and
+    subtype entropy, ancestral indices, consensus indices and good_ref at the mapped
+    positions (in reference order). The reference is group M for subtype='any' and
+    the subtype of the patient for subtype='patient'.
+
+    The trajectories are read-only (see get_trajectory_view), indexing them gives
+    masked arrays with a full mask.
+    '''
+    p = load_patient(pcode)
+    aft = get_trajectory_view(pcode, region, cov_min=cov_min, type=type)
+    if isinstance(aft, np.ma.MaskedArray) and np.ma.getmask(aft) is np.ma.nomask:
+        # full mask on a new array sharing the cached data
+        aft = np.ma.array(np.ma.getdata(aft), mask=np.zeros(aft.shape, bool))
+
+    if type == 'nuc':
+        ref = get_patient_reference(p, subtype=subtype, refname=refname)
+        patient_to_subtype = p.map_to_external_reference(region, refname=refname)
+    else:
+        ref = get_patient_reference(p, subtype=subtype, refname=refname,
+                                    region=region, type='aa')
+        patient_to_subtype = p.map_to_external_reference_aminoacids(region, refname=refname)
+
+    return {'patient': p,
+            'pcode': pcode,
+            'region': region,
+            'aft': aft,
+            'patient_to_subtype': patient_to_subtype,
+            'subtype_entropy': ref.get_entropy_in_patient_region(patient_to_subtype),
+            'ancestral': p.get_initial_indices(region, type=type)[patient_to_subtype[:, -1]],
+            'consensus': ref.get_consensus_indices_in_patient_region(patient_to_subtype),
+            'good_ref': ref.good_pos_in_reference[patient_to_subtype[:, 0]],
+           }
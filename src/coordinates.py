@@ -0,0 +1,135 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Dense coordinate frames between patient regions and a reference.
+
+            map_to_external_reference returns the pairs of mapped positions
+            as an array with the reference position in the first and the
+            patient position in the last column. A ReferenceFrame turns this
+            into dense index arrays in both directions (-1 where unmapped),
+            so that per-site quantities can be moved between patient and
+            reference coordinates with one scatter or gather.
+'''
+# Modules
+import numpy as np
+
+
+# Globals
+# HXB2 and NL4-3 are shorter than this, it is the size of the genome-wide
+# reference buffers of the figure scripts
+default_reference_length = 10000
+
+
+
+# Classes
+class ReferenceFrame(object):
+    '''Map between the positions of a patient region and a reference
+
+    Attributes:
+       forward  -- reference position of every patient position (-1 if unmapped)
+       inverse  -- patient position of every reference position (-1 if unmapped)
+       patient_positions, reference_positions -- the mapped pairs, in map order
+    '''
+    def __init__(self, patient_to_reference, patient_length=None,
+                 reference_length=default_reference_length):
+        '''
+        Parameters:
+           patient_to_reference -- output of map_to_external_reference(_aminoacids),
+                                   reference positions in the first column and patient
+                                   positions in the last
+           patient_length       -- length of the patient region (default: last mapped
+                                   position + 1)
+           reference_length     -- length of the reference axis
+        '''
+        ptoref = np.asarray(patient_to_reference, int)
+        self.reference_positions = ptoref[:, 0]
+        self.patient_positions = ptoref[:, -1]
+        if patient_length is None:
+            patient_length = self.patient_positions.max() + 1 if len(ptoref) else 0
+        if len(ptoref) and self.reference_positions.max() >= reference_length:
+            raise ValueError('Reference position '+str(self.reference_positions.max())+
+                             ' outside of the reference axis of length '+str(reference_length))
+
+        self.forward = -np.ones(patient_length, int)
+        self.forward[self.patient_positions] = self.reference_positions
+        self.inverse = -np.ones(reference_length, int)
+        self.inverse[self.reference_positions] = self.patient_positions
+
+
+    def __repr__(self):
+        return ('ReferenceFrame(patient_length='+str(self.patient_length)+
+                ', reference_length='+str(self.reference_length)+
+                ', mapped='+str(len(self.patient_positions))+')')
+
+
+    @classmethod
+    def from_patient(cls, p, region, refname='HXB2', type='nuc', patient_length=None,
+                     reference_length=default_reference_length):
+        '''Coordinate frame of a patient region, for nucleotides or amino acids'''
+        if type == 'nuc':
+            ptoref = p.map_to_external_reference(region, refname=refname)
+        else:
+            ptoref = p.map_to_external_reference_aminoacids(region, refname=refname)
+        return cls(ptoref, patient_length=patient_length, reference_length=reference_length)
+
+
+    @property
+    def patient_length(self):
+        return len(self.forward)
+
+
+    @property
+    def reference_length(self):
+        return len(self.inverse)
+
+
+    @property
+    def forward_valid(self):
+        '''True at the patient positions that map to the reference'''
+        return self.forward >= 0
+
+
+    @property
+    def inverse_valid(self):
+        '''True at the reference positions covered by the patient region'''
+        return self.inverse >= 0
+
+
+    def to_reference(self, values, fill=np.nan, out=None):
+        '''Scatter values along the last axis from patient to reference coordinates
+
+        Parameters:
+           values -- array with patient positions on the last axis
+           fill   -- value at the reference positions not covered by the patient
+           out    -- array to scatter into instead of a new one filled with fill,
+                     only the covered reference positions are overwritten
+
+        Masked arrays are returned as masked arrays, with the uncovered positions masked.
+        '''
+        values = np.asanyarray(values)
+        if out is None:
+            dtype = np.result_type(values.dtype, np.min_scalar_type(fill))
+            out = np.empty(values.shape[:-1]+(self.reference_length,), dtype=dtype)
+            out.fill(fill)
+            if isinstance(values, np.ma.MaskedArray):
+                out = np.ma.array(out, mask=True)
+        out[..., self.reference_positions] = values[..., self.patient_positions]
+        return out
+
+
+    def from_reference(self, values, fill=np.nan):
+        '''Gather values along the last axis from reference to patient coordinates
+
+        Patient positions that do not map to the reference are set to fill, or
+        masked if values is a masked array.
+        '''
+        values = np.asanyarray(values)
+        out = values[..., np.maximum(self.forward, 0)]
+        unmapped = ~self.forward_valid
+        if unmapped.any():
+            if isinstance(out, np.ma.MaskedArray):
+                out[..., unmapped] = np.ma.masked
+            else:
+                out = out.astype(np.result_type(out.dtype, np.min_scalar_type(fill)))
+                out[..., unmapped] = fill
+        return out
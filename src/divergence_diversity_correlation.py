@@ -11,6 +11,7 @@ from hivevo.hivevo.samples import all_fragments
 
 from util import store_data, load_data, draw_genome, fig_width, fig_fontsize, patients, HIVEVO_colormap
 from evolutionary_rates import running_average_masked, weighted_linear_regression
+from coordinates import ReferenceFrame, default_reference_length
 from filenames import get_figure_folder
 
 
@@ -53,15 +54,15 @@ if __name__=="__main__":
 
         # prepare arrays to accumulate divergence and diversity data
         # all are -1, stuff that stays negative will be eventually masked
-        HXB2_syn_divs = -np.ones((len(patients), 10000), dtype=float)
-        HXB2_nonsyn_divs = -np.ones((len(patients), 10000), dtype=float)
-        HXB2_nonsyn_divg = -np.ones((len(patients), 10000), dtype=float)
+        HXB2_syn_divs = -np.ones((len(patients), default_reference_length), dtype=float)
+        HXB2_nonsyn_divs = -np.ones((len(patients), default_reference_length), dtype=float)
+        HXB2_nonsyn_divg = -np.ones((len(patients), default_reference_length), dtype=float)
         for pi, pcode in enumerate(patients):
             print("patient:",pcode)
             p = Patient.load(pcode)
             for region in regions:
                 # map each regional alignment to HXB2, exclude regions gapped in the global alignmnt
-                toHXB2 = p.map_to_external_reference(region)
+                toHXB2 = ReferenceFrame.from_patient(p, region)
                 aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min)
                 initial_indices = p.get_initial_indices(region)
                 diversity = (aft*(1-aft)).sum(axis=1)[p.ysi>4].mean(axis=0)
@@ -79,9 +80,9 @@ if __name__=="__main__":
                 divg_nonsyn = -np.ones_like(divergence)
                 divg_nonsyn[nonsyn_pos] = divergence[nonsyn_pos]
 
-                HXB2_syn_divs[pi,toHXB2[:,0]] = divs_syn[toHXB2[:,2]]
-                HXB2_nonsyn_divs[pi,toHXB2[:,0]] = divs_nonsyn[toHXB2[:,2]]
-                HXB2_nonsyn_divg[pi,toHXB2[:,0]] = divg_nonsyn[toHXB2[:,2]]
+                toHXB2.to_reference(divs_syn, out=HXB2_syn_divs[pi])
+                toHXB2.to_reference(divs_nonsyn, out=HXB2_nonsyn_divs[pi])
+                toHXB2.to_reference(divg_nonsyn, out=HXB2_nonsyn_divg[pi])
                 
         # all HXB2 arrays now contain data where appropriate
         # negative values are masked (i.e. positions that are never syn)
@@ -4,11 +4,13 @@ import numpy as np
 from itertools import izip
 from matplotlib import pyplot as plt
 
-from hivevo.hivevo.patients import Patient
 from hivevo.hivevo.samples import all_fragments
 from hivevo.hivevo.HIVreference import HIVreference, HIVreferenceAminoacid
 
 from util import store_data, load_data, draw_genome, fig_width, fig_fontsize
+from cache import cached_collect, use_stored_data
+from cohort import load_patient, get_allele_frequency_trajectories, get_reference_frame, print_cache_info
+from coordinates import default_reference_length
 from filenames import get_figure_folder
 
 
@@ -16,44 +18,72 @@ from filenames import get_figure_folder
 # Functions
 def running_average_masked(obs, ws, min_valid_fraction=0.95):
     '''
-    calculates a running average via convolution, fixing the edges
-    obs     --  observations (a masked array)
+    calculates a running average via cumulative sums, fixing the edges
+    obs     --  observations (a masked array), either a vector or a matrix with
+                positions on the last axis, whose rows are averaged independently
     ws      --  window size (number of points to average)
+
+    The window of position i is [i - ws//2, i + (ws-1)//2], as for a convolution
+    with mode='same'. Averages with less than ws * min_valid_fraction unmasked
+    points in the window are masked.
     '''
-    #tmp_vals = np.convolve(np.ones(ws, dtype=float), obs*(1-obs.mask), mode='same')
-    tmp_vals = np.convolve(np.ones(ws, dtype=float), obs.filled(0), mode='same')
-
-     # if the array is not masked, edges needs to be explictly fixed due to smaller counts
-    if len(obs.mask.shape) == 0:
-        tmp_valid = ws*np.ones_like(tmp_vals)
-        # fix the edges. using mode='same' assumes zeros outside the range
-        if ws%2==0:
-            tmp_vals[:ws//2]*=float(ws)/np.arange(ws//2,ws)
-            if ws//2>1:
-                tmp_vals[-ws//2+1:]*=float(ws)/np.arange(ws-1,ws//2,-1.0)
-        else:
-            tmp_vals[:ws//2]*=float(ws)/np.arange(ws//2+1,ws)
-            tmp_vals[-ws//2:]*=float(ws)/np.arange(ws,ws//2,-1.0)
+    obs = np.ma.asarray(obs)
+    L = obs.shape[-1]
+    start = np.clip(np.arange(L) - ws//2, 0, L)
+    stop = np.clip(np.arange(L) + (ws-1)//2 + 1, 0, L)
+
+    def window_sums(a):
+        csum = np.zeros(a.shape[:-1]+(L+1,), dtype=float)
+        np.cumsum(a, axis=-1, out=csum[..., 1:])
+        return csum[..., stop] - csum[..., start]
+
+    tmp_vals = window_sums(obs.filled(0))
+
+    # if the array is not masked, the edges are averaged over the points within the range
+    # and nothing is masked
+    if obs.mask is np.ma.nomask:
+        run_avg = np.ma.array(tmp_vals / (stop - start),
+                              mask=np.zeros(tmp_vals.shape, bool))
 
     # if the array is masked, then we get the normalizer from counting the unmasked values
     else:
-        tmp_valid = np.convolve(np.ones(ws, dtype=float), (1-obs.mask), mode='same')
-
-    run_avg = np.ma.array(tmp_vals / tmp_valid)
-    run_avg.mask = tmp_valid < ws * min_valid_fraction
+        tmp_valid = window_sums(~obs.mask)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            run_avg = np.ma.array(tmp_vals / tmp_valid)
+        run_avg.mask = tmp_valid < ws * min_valid_fraction
 
     return run_avg
 
 
 def weighted_linear_regression(x, y):
-    data = np.array([(tmpx, tmpy) for tmpx, tmpy, m in zip(x,y,y.mask) if not m])
-    if len(data)>2:
-        weights = data[:,1] + 3e-3  #shot noise + sequencing error
-        slope = np.sum(data[:,0]*data[:,1]/weights)/np.sum(data[:,0]**2/weights)
-        gof = np.corrcoef(x,y)[0,1]
-        return slope, gof
-    else:
-        return np.nan, np.nan
+    '''Weighted slope through the origin and correlation coefficient of y vs x
+
+    x       --  times
+    y       --  observations (a masked array), either a vector or a matrix with
+                times on the first axis, in which case all columns are fitted at once
+
+    Only the unmasked points of each column enter slope and correlation, columns
+    with less than three of them give NaN.
+    '''
+    x = np.asarray(x, float)
+    y = np.ma.asarray(y, float)
+    valid = ~np.ma.getmaskarray(y)
+    n = valid.sum(axis=0)
+    x = x.reshape(x.shape+(1,)*(y.ndim-1)) * valid
+    y = y.filled(0)
+
+    weights = y + 3e-3  #shot noise + sequencing error
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.sum(x*y/weights, axis=0) / np.sum(x**2/weights, axis=0)
+        dx = (x - x.sum(axis=0) / n) * valid
+        dy = (y - y.sum(axis=0) / n) * valid
+        gof = np.sum(dx*dy, axis=0) / np.sqrt(np.sum(dx**2, axis=0) * np.sum(dy**2, axis=0))
+
+    slope = np.where(n > 2, slope, np.nan)
+    gof = np.where(n > 2, gof, np.nan)
+    if y.ndim == 1:
+        return slope[()], gof[()]
+    return slope, gof
 
 
 def get_divergence_trajectory(p, cov_min=100, sequence_type='nuc',
@@ -81,8 +111,8 @@ def get_divergence_trajectory(p, cov_min=100, sequence_type='nuc',
         else:
             reg_coo = list(p.annotation[region])[::3]
 
-        aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min,
-                                                  type=sequence_type)
+        aft = get_allele_frequency_trajectories(p.name, region, cov_min=cov_min,
+                                                type=sequence_type)
         aft[aft < 0.002] = 0
 
         ii = p.get_initial_indices(region, type=sequence_type)
@@ -107,6 +137,48 @@ def get_divergence_trajectory(p, cov_min=100, sequence_type='nuc',
     return div_traj
 
 
+def collect_evolutionary_rates(patients, cov_min=200, window_size=300,
+                               sequence_type='nuc', rate_or_gof=0):
+    '''Collect the divergence rates in a sliding window in reference coordinates'''
+    cats = [{'name': 'total', 'only_substitutions': False},
+            {'name': 'substitutions', 'only_substitutions': True},
+           ]
+    ref = {key: -np.ones((len(patients), default_reference_length), dtype=float)
+           for key in ['total', 'substitutions']}
+    evo_rates = {key: {} for key in ref}
+    for pi, pcode in enumerate(patients):
+        p = load_patient(pcode)
+        frame = get_reference_frame(pcode, 'genomewide')
+
+        for cat in cats:
+            div_traj = get_divergence_trajectory(p, cov_min=cov_min,
+                                                 sequence_type=sequence_type,
+                                                 only_substitutions=cat['only_substitutions'])
+
+            print (pcode, cat['name']+' divergence',
+                   zip(np.round(p.ysi),
+                       [[np.round(x[x<th].sum()) for th in [.1, .5, 0.95, 1.0]] for x in div_traj]))
+
+            if sequence_type == 'nuc':
+                min_valid_fraction = 0.95
+            else:
+                # Two out of three are masked by design
+                min_valid_fraction = 0.30
+            smoothed_divergence = running_average_masked(div_traj, window_size,
+                                                         min_valid_fraction=min_valid_fraction)
+
+            evo_rates[cat['name']][pcode] = \
+                    weighted_linear_regression(p.ysi, smoothed_divergence)[rate_or_gof]
+
+            frame.to_reference(evo_rates[cat['name']][pcode], out=ref[cat['name']][pi])
+
+    data = {'rates': ref['total'],
+            'rates_substitutions': ref['substitutions'],
+            'patients': patients,
+           }
+    return data
+
+
 def plot_evo_rates(data, fig_filename=None, figtypes=['.png', '.svg', '.pdf'],
                    include_substitutions=False,
                    refname='HXB2'):
@@ -214,50 +286,18 @@ if __name__=="__main__":
     window_size = 300
     cov_min = 200
 
-    if not os.path.isfile(fn_data) or params.redo:
-        print("Regenerating plot data")
-        cats = [{'name': 'total', 'only_substitutions': False},
-                {'name': 'substitutions', 'only_substitutions': True},
-               ]
-        ref = {key: -np.ones((len(patients), 10000), dtype=float) for key in ['total', 'substitutions']}
-        evo_rates = {key: {} for key in ref}
-        for pi, pcode in enumerate(patients):
-            p = Patient.load(pcode)
-            to_ref = p.map_to_external_reference('genomewide')
-
-            for cat in cats:
-                div_traj = get_divergence_trajectory(p, cov_min=cov_min,
-                                                     sequence_type=params.type,
-                                                     only_substitutions=cat['only_substitutions'])
-
-                print (pcode, cat['name']+' divergence',
-                       zip(np.round(p.ysi),
-                           [[np.round(x[x<th].sum()) for th in [.1, .5, 0.95, 1.0]] for x in div_traj]))
-
-                if params.type == 'nuc':
-                    min_valid_fraction = 0.95
-                else:
-                    # Two out of three are masked by design
-                    min_valid_fraction = 0.30
-                smoothed_divergence = np.ma.array([running_average_masked(div, window_size,
-                                                                          min_valid_fraction=min_valid_fraction)
-                                                   for div in div_traj])
-
-                evo_rates[cat['name']][pcode] = \
-                        np.array([weighted_linear_regression(p.ysi, smoothed_divergence[:,i])[rate_or_gof]
-                                  for i in xrange(smoothed_divergence.shape[1])])
-
-                ref[cat['name']][pi, to_ref[:,0]] = evo_rates[cat['name']][pcode][to_ref[:,1]]
-
-        data = {'rates': ref['total'],
-                'rates_substitutions': ref['substitutions'],
-                'patients': patients,
-               }
-
-        store_data(data, fn_data)
-    else:
-        print("Loading data from file")
+    if use_stored_data(fn_data, redo=params.redo):
         data = load_data(fn_data)
+    else:
+        data = cached_collect(collect_evolutionary_rates, fn_data,
+                              args=(patients,),
+                              kwargs={'cov_min': cov_min,
+                                      'window_size': window_size,
+                                      'sequence_type': params.type,
+                                      'rate_or_gof': rate_or_gof},
+                              redo=params.redo)
+        store_data(data, fn_data)
+    print_cache_info()
 
     fig_filename = foldername+'evolutionary_rates'
     if False:
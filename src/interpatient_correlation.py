@@ -3,58 +3,103 @@ import os, sys
 import numpy as np
 import pandas as pd
 from itertools import izip
-from scipy.stats import spearmanr
 
-from hivevo.hivevo.patients import Patient
 from hivevo.hivevo.HIVreference import HIVreference, HIVreferenceAminoacid
 from hivevo.hivevo.samples import all_fragments
 
 from util import store_data, load_data, fig_width, fig_fontsize, get_quantiles, add_panel_label, patient_colors, patients
+from util import masked_ranks, rank_correlation, spearman_pvalue
+from cache import cached_collect, use_stored_data
+from cohort import load_patient, get_allele_frequency_trajectories, get_reference_frame
 from filenames import get_figure_folder
 
 
 
 # Functions
+def get_region_profiles(patients, region, cov_min=1000, refname='HXB2', min_dsi=1500):
+    '''Late-time entropy and founder sequence of all patients on a shared reference axis
+
+    Returns:
+       positions -- reference positions covered by any patient
+       entropy   -- patients x positions, entropy of the mean frequencies after min_dsi
+                    (NaN where masked)
+       sequence  -- patients x positions, founder sequence
+       covered   -- patients x positions, True where the patient maps to the reference
+    '''
+    entropy, sequence, covered = [], [], []
+    for pcode in patients:
+        p = load_patient(pcode)
+        frame = get_reference_frame(pcode, region, refname=refname)
+        aft = get_allele_frequency_trajectories(pcode, region, cov_min=cov_min)
+        af = aft[p.dsi >= min_dsi].mean(axis=0)
+        en = np.maximum(0,-np.sum(af[:-1]*np.log(1e-10+af[:-1]), axis=0))
+        entropy.append(frame.to_reference(np.ma.filled(np.ma.asarray(en, dtype=float), np.nan)))
+        sequence.append(frame.to_reference(np.asarray(p.get_initial_sequence(region)), fill=''))
+        covered.append(frame.inverse_valid)
+
+    # restrict to the reference positions covered by any patient
+    covered = np.array(covered)
+    positions = covered.any(axis=0).nonzero()[0]
+    entropy = np.array(entropy)[:, positions]
+    sequence = np.array(sequence)[:, positions]
+    covered = covered[:, positions]
+    return positions, entropy, sequence, covered
+
+
+def pairwise_correlations(entropy, sequence, covered, chunk_size=500):
+    '''Spearman's rho and founder distance of all patient pairs (i, j) with j < i
+
+    Both are computed on the positions covered by the two patients. As with spearmanr,
+    rho is NaN if any of these positions has a NaN entropy.
+
+    Returns:
+       i, j, rho, pval, distance -- arrays over pairs, ordered like the loops i, j<i
+    '''
+    pi, pj = np.tril_indices(entropy.shape[0], -1)
+    rho = np.empty(len(pi))
+    distance = np.empty(len(pi))
+    noverlap = np.empty(len(pi))
+    # chunks of pairs limit the memory of the pairs x positions arrays
+    for start in xrange(0, len(pi), chunk_size):
+        i, j = pi[start:start+chunk_size], pj[start:start+chunk_size]
+        overlap = covered[i] & covered[j]
+        n = overlap.sum(axis=1).astype(float)
+        has_nan = (overlap & (np.isnan(entropy[i]) | np.isnan(entropy[j]))).any(axis=1)
+
+        chunk_rho = rank_correlation(masked_ranks(entropy[i], overlap),
+                                     masked_ranks(entropy[j], overlap), overlap)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chunk_distance = ((sequence[i] != sequence[j]) & overlap).sum(axis=1) / n
+        chunk_rho[has_nan] = np.nan
+
+        rho[start:start+chunk_size] = chunk_rho
+        distance[start:start+chunk_size] = chunk_distance
+        noverlap[start:start+chunk_size] = n
+
+    return pi, pj, rho, spearman_pvalue(rho, noverlap), distance
+
+
 def collect_correlations(patients, regions, cov_min=1000, refname='HXB2', min_dsi=1500):
     '''Correlation of entropy between patients'''
-    ps = [Patient.load(pcode) for pcode in patients]
-
     correlations = []
     for region in regions:
         print region
-        for pi, p1 in enumerate(ps):
-            aft1 = p1.get_allele_frequency_trajectories(region, cov_min=cov_min)
-            af1 = aft1[p1.dsi >= min_dsi].mean(axis=0)
-            en1 = np.maximum(0,-np.sum(af1[:-1]*np.log(1e-10+af1[:-1]), axis=0))
-            ptoref1 = p1.map_to_external_reference(region, refname=refname)
-            ptorefd1 = dict(ptoref1[:, ::2])
-            seq1 = p1.get_initial_sequence(region)
-
-            for p2 in ps[:pi]:
-                aft2 = p2.get_allele_frequency_trajectories(region, cov_min=cov_min)
-                af2 = aft2[p2.dsi >= min_dsi].mean(axis=0)
-                en2 = np.maximum(0,-np.sum(af2[:-1]*np.log(1e-10+af2[:-1]), axis=0))
-                ptoref2 = p2.map_to_external_reference(region, refname=refname)
-                ptorefd2 = dict(ptoref2[:, ::2])
-                seq2 = p2.get_initial_sequence(region)
-
-                overlap = np.intersect1d(ptoref1[:, 0], ptoref2[:, 0], assume_unique=True)
-                af_ov = np.array([(en1[ptorefd1[pos]], en2[ptorefd2[pos]]) for pos in overlap])
-                rho, pval = spearmanr(af_ov[:, 0], af_ov[:, 1])
-
-                seq1_ov = np.array([seq1[ptorefd1[pos]] for pos in overlap])
-                seq2_ov = np.array([seq2[ptorefd2[pos]] for pos in overlap])
-                dist = (seq1_ov != seq2_ov).mean()
-
-                correlations.append({'pcode1': p1.name,
-                                     'pcode2': p2.name,
-                                     'pcode': p1.name+'-'+p2.name,
-                                     'region': region,
-                                     'rho': rho,
-                                     'distance': dist,
-                                     'pval': pval})
-
-    return pd.DataFrame(correlations)
+        positions, entropy, sequence, covered = get_region_profiles(patients, region,
+                                                                    cov_min=cov_min,
+                                                                    refname=refname,
+                                                                    min_dsi=min_dsi)
+        i, j, rho, pval, dist = pairwise_correlations(entropy, sequence, covered)
+        names = np.array([load_patient(pcode).name for pcode in patients])
+        pcode1, pcode2 = names[i], names[j]
+        correlations.append(pd.DataFrame({'pcode1': pcode1,
+                                          'pcode2': pcode2,
+                                          'pcode': [p1+'-'+p2 for p1, p2 in izip(pcode1, pcode2)],
+                                          'region': region,
+                                          'rho': rho,
+                                          'distance': dist,
+                                          'pval': pval}))
+
+    return pd.concat(correlations, ignore_index=True)
 
 
 def plot_correlation(data, fig_filename=None, figtypes=['.png', '.svg', '.pdf']):
@@ -150,16 +195,21 @@ if __name__=="__main__":
         fn_data = fn_data + '_aa'
     fn_data = fn_data + '.pickle'
 
-    if not os.path.isfile(fn_data) or params.redo:
-        regions = ['p17', 'p24', 'PR', 'RT', 'p15', 'IN', 'vif', 'gp41', 'gp120', 'nef']
-        #regions = ['p24', 'p17', 'RT1', 'RT2', 'RT3', 'RT4', 'PR', 
-        #           'IN1', 'IN2', 'IN3','p15', 'vif', 'nef','gp41','gp1201']
-        cov_min = 1000
+    regions = ['p17', 'p24', 'PR', 'RT', 'p15', 'IN', 'vif', 'gp41', 'gp120', 'nef']
+    #regions = ['p24', 'p17', 'RT1', 'RT2', 'RT3', 'RT4', 'PR', 
+    #           'IN1', 'IN2', 'IN3','p15', 'vif', 'nef','gp41','gp1201']
+    cov_min = 1000
 
+    if use_stored_data(fn_data, redo=params.redo):
+        data = load_data(fn_data)
+    else:
         if params.type == 'nuc':
             # determine correlations between intra patient diversity and subtype diversity
-            correlations = collect_correlations(patients, regions, cov_min=cov_min,
-                                                refname=params.reference)
+            correlations = cached_collect(collect_correlations, fn_data,
+                                          args=(patients, regions),
+                                          kwargs={'cov_min': cov_min,
+                                                  'refname': params.reference},
+                                          redo=params.redo)
 
         else:
             pass
@@ -173,9 +223,6 @@ if __name__=="__main__":
               'patients': patients,
               'cov_min': cov_min}
         store_data(data, fn_data)
-    else:
-        print("Loading data from file")
-        data = load_data(fn_data)
 
 fig_filename = foldername+'entropy_correlation_interpatient'
 if params.type == 'aa':
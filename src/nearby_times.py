@@ -4,12 +4,13 @@ from matplotlib import cm
 import numpy as np
 import seaborn as sns
 
-from hivevo.hivevo.patients import Patient
 from hivevo.hivevo.samples import all_fragments
 from hivevo.hivevo.sequence import alpha
 
 from filenames import get_figure_folder
 from util import store_data, load_data, fig_width, fig_fontsize, patients, patient_colors, HIVEVO_colormap
+from cohort import load_patient
+from polymorphisms import get_polymorphism_table
 plt.ion()
 sns.set_style('darkgrid')
 
@@ -18,25 +19,26 @@ foldername = get_figure_folder(username, 'first')
 
 
 cmap = HIVEVO_colormap()
-p = Patient.load('p1')
+p = load_patient('p1')
 fig, axs = plt.subplots(2,3, sharey=True, sharex=True)
 traj = []
 ti = 3
 tj = ti+1
+# only alleles above 1% at some time are considered, N is excluded
+polymorphisms = get_polymorphism_table('p1', all_fragments, floor=0.01)
+polymorphisms = polymorphisms.select_alleles(polymorphisms.get_alleles()[2] < 5)
+freqs = polymorphisms.get_trajectories()
+regions, positions, alleles = polymorphisms.get_alleles()
+rising = np.ma.filled((freqs[:,0]<0.5) & (freqs[:,ti]>0.2) & (freqs[:,tj]>0.2), False)
+diverse = np.ma.filled((freqs[:,ti]*(1-freqs[:,ti])>0.01)|(freqs[:,tj]*(1-freqs[:,tj])>0.01), False)
 for fi, frag in enumerate(all_fragments):
     ax = axs[fi//3,fi%3]
-    aft = p.get_allele_frequency_trajectories(frag)
-    pos = np.linspace(0,1,aft.shape[-1])
-    for pi in xrange(aft.shape[-1]):
-        for ni in xrange(5):
-            if aft[0,ni,pi]<0.5 and (aft[ti,ni,pi]>0.2 and aft[tj,ni,pi]>0.2):
-                traj.append([frag, pi, aft[:,ni,pi]])
-    try:
-        for ni in xrange(5):
-            ind = (aft[ti,ni,:]*(1-aft[ti,ni,:])>0.01)|(aft[tj,ni,:]*(1-aft[tj,ni,:])>0.01)
-            ax.scatter(aft[ti,ni,ind], aft[tj,ni,ind], c = [cmap(x) for x in pos[ind]])
-    except:
-        print 'fragment didnt work'
+    in_frag = regions==frag
+    for ai in np.where(in_frag & rising)[0]:
+        traj.append([frag, positions[ai], freqs[ai]])
+    ind = in_frag & diverse
+    pos = positions[ind] / (polymorphisms.lengths[fi] - 1.0)
+    ax.scatter(freqs[ind,ti], freqs[ind,tj], c = [cmap(x) for x in pos])
 
 for ax in axs[:,0]:
     ax.set_ylabel('frequency at '+str(int(p.dsi[tj]))+' days')
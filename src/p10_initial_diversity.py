@@ -6,12 +6,13 @@ this diversity to establish the cause
 
 import numpy as np
 from itertools import izip
-from hivevo.patients import Patient
 from hivevo.samples import all_fragments
 from hivevo.af_tools import LD as LDfunc
 from util import store_data, load_data, fig_width, fig_fontsize, HIVEVO_colormap
 import os
 from filenames import get_figure_folder
+from cohort import load_patient
+from polymorphisms import get_polymorphism_table
 import matplotlib.pyplot as plt
 import seaborn as sns
 plt.ion()
@@ -19,28 +20,41 @@ plt.ion()
 sns.set_style('darkgrid')
 cols = HIVEVO_colormap()
 
+
+def get_peak_alleles(positions, af, peak, af_min, af_max):
+    '''First allele (in alphabet order) with af_min < af < af_max at every peak position'''
+    ind = np.ma.filled((af>af_min)&(af<af_max), False) & peak[positions]
+    # alleles are sorted by position and allele
+    first = np.unique(positions[ind], return_index=True)[1]
+    return np.where(ind)[0][first]
+
+
 if __name__=="__main__":
-    p = Patient.load('p10')
-    aft = p.get_allele_frequency_trajectories('genomewide')
+    p = load_patient('p10')
+    # minor frequencies above 1% are exact, those below are all in the first bin
+    polymorphisms = get_polymorphism_table('p10', ['genomewide'], floor=0.01)
+    freqs = polymorphisms.get_trajectories()
+    positions = polymorphisms.get_alleles()[1]
 
-    af = aft[0]
+    af = freqs[:,0]
     consensus_indices = p.get_initial_indices('genomewide')
-    minor_af = 1.0 - af.max(axis=0)
+    # masked at positions not covered in the first sample
+    minor_af = polymorphisms.get_minor_frequencies('genomewide', 0)
 
     # make a histogram of the minor allele frequencies
     plt.figure()
-    plt.hist(minor_af, bins = np.linspace(0,1,51), bottom=0.5)
+    plt.hist(minor_af.compressed(), bins = np.linspace(0,1,51), bottom=0.5)
     plt.yscale('log')
     plt.xlabel('frequency')
     plt.ylabel('number of minor variants')
 
     # --> there are two clear peaks one around 0.35-0.5 , the other around 0.1-0.15
-    variable_pos = minor_af>0.05
+    variable_pos = np.ma.filled(minor_af>0.05, False)
     print("number of variable positions:",variable_pos.sum())
-    peak1 = minor_af>0.3
-    peak1_ii = ((af>0.3)&(af<0.5)).argmax(axis=0)
-    peak2 = (minor_af>0.05)&(minor_af<0.2)
-    peak2_ii = ((af>0.05)&(af<0.2)).argmax(axis=0)
+    peak1 = np.ma.filled(minor_af>0.3, False)
+    peak1_ii = get_peak_alleles(positions, af, peak1, 0.3, 0.5)
+    peak2 = np.ma.filled((minor_af>0.05)&(minor_af<0.2), False)
+    peak2_ii = get_peak_alleles(positions, af, peak2, 0.05, 0.2)
     print("there are two clear peaks at frequency about 0.15 and 0.4")
     print("peak 1:",peak1.sum())
     print("peak 2:",peak2.sum())
@@ -52,14 +66,14 @@ if __name__=="__main__":
     # trajectories of these mutations
     plt.figure()
     plt.title('frequencies trajectories of high peak')
-    for pos in np.where(peak1)[0]:
-        plt.plot(p.ysi, aft[:,peak1_ii[pos], pos], c=cols(pos*0.0001))
+    for ai in peak1_ii:
+        plt.plot(p.ysi, freqs[ai], c=cols(positions[ai]*0.0001))
     plt.xlabel('ETI[years]')
 
     plt.figure()
     plt.title('frequencies trajectories of low peak')
-    for pos in np.where(peak2)[0]:
-        plt.plot(p.ysi, aft[:,peak2_ii[pos], pos], c=cols(pos*0.0001))
+    for ai in peak2_ii:
+        plt.plot(p.ysi, freqs[ai], c=cols(positions[ai]*0.0001))
     plt.xlabel('ETI[years]')
 
 
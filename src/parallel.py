@@ -0,0 +1,77 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Parallel execution of per (patient, region) collection steps.
+
+            The collectors loop over patients and regions, and every (patient,
+            region) unit is independent. map_patient_regions runs a worker on
+            all units, either serially or on a process pool, and returns the
+            results in the order of the serial loops, so the merged output does
+            not depend on the number of processes.
+'''
+# Modules
+import argparse
+
+
+
+# Classes
+class _WorkerCall(object):
+    '''Picklable closure of a worker and its keyword arguments'''
+    def __init__(self, worker, kwargs):
+        self.worker = worker
+        self.kwargs = kwargs
+
+    def __call__(self, unit):
+        return self.worker(*unit, **self.kwargs)
+
+
+
+# Functions
+def add_jobs_argument(parser):
+    '''Add the --jobs flag to an argparse parser'''
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes for the data collection')
+
+
+def map_patient_regions(worker, patients, regions, jobs=1, patient_major=True, **kwargs):
+    '''Apply worker(pcode, region, **kwargs) to all patient and region pairs
+
+    Parameters:
+       worker        -- module level function (it has to be picklable)
+       jobs          -- number of processes, 1 runs serially in this process
+       patient_major -- loop over patients in the outer loop (else regions)
+
+    Returns:
+       list of the worker results, in the order of the serial loops
+    '''
+    if patient_major:
+        units = [(pcode, region) for pcode in patients for region in regions]
+    else:
+        units = [(pcode, region) for region in regions for pcode in patients]
+
+    call = _WorkerCall(worker, kwargs)
+    if jobs == 1 or len(units) < 2:
+        return map(call, units)
+
+    from multiprocessing import Pool
+    pool = Pool(processes=min(jobs, len(units)))
+    try:
+        # chunksize 1: units are few and of very different size
+        results = pool.map(call, units, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def merge_rows(results):
+    '''Concatenate lists of rows (or DataFrames) returned by the workers'''
+    import pandas as pd
+
+    if len(results) and all(isinstance(r, pd.DataFrame) for r in results):
+        return pd.concat(results, ignore_index=True)
+
+    rows = []
+    for r in results:
+        rows.extend(r)
+    return rows
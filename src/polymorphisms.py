@@ -0,0 +1,283 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Sparse tables of the polymorphic alleles of a patient.
+
+            Minor allele analyses only look at alleles that rise above a small
+            frequency at some time, a few percent of the dense trajectory
+            array (time x allele x position). A PolymorphismTable keeps the
+            trajectories of these alleles as rows (region, position, allele,
+            time, frequency), so that selections like "founder frequency < 0.5
+            and frequency > 0.2 later" are vectorized expressions on a small
+            allele x time matrix. Tables are stored as one .npz file per
+            patient, region and frequency floor, written once, so parallel
+            runs never rewrite each other's tables.
+'''
+# Modules
+import os
+import numpy as np
+
+from filenames import get_figure_folder
+from cohort import load_patient, get_allele_frequency_trajectories
+
+
+
+# Classes
+class PolymorphismTable(object):
+    '''Trajectories of the polymorphic alleles of one patient
+
+    An allele is polymorphic if its frequency is above floor at some time and
+    below 1 - floor at some time (fixed alleles are left out). Every unmasked
+    time point of a polymorphic allele is one row, the rows are sorted by
+    region, position, allele and time.
+
+    Attributes:
+       pcode, floor     -- patient and frequency floor
+       times            -- times of the samples in days (the columns of the trajectories)
+       regions, lengths -- regions in the table and their lengths
+       region, position, allele, time, freq -- columns, region and time are indices
+                                               into regions and times
+       observed         -- time x position (of all regions, concatenated) boolean array,
+                           True where some allele of the position is not masked
+    '''
+    columns = ['region', 'position', 'allele', 'time', 'freq']
+    dtypes = [np.int16, np.int32, np.int8, np.int16, float]
+
+    def __init__(self, pcode, times, floor, regions=[], lengths=[], observed=None,
+                 **columns):
+        self.pcode = pcode
+        self.times = np.asarray(times, float)
+        self.floor = floor
+        self.regions = list(regions)
+        self.lengths = np.asarray(lengths, int)
+        if observed is None:
+            observed = np.ones((len(self.times), self.lengths.sum()), bool)
+        self.observed = np.asarray(observed, bool)
+        for name, dtype in zip(self.columns, self.dtypes):
+            setattr(self, name, np.asarray(columns.get(name, []), dtype=dtype))
+        self._alleles = None
+
+
+    def __len__(self):
+        return len(self.freq)
+
+
+    def __repr__(self):
+        return ('PolymorphismTable('+repr(self.pcode)+', regions='+repr(self.regions)+
+                ', alleles='+str(self.get_number_of_alleles())+', rows='+str(len(self))+')')
+
+
+    @classmethod
+    def from_trajectories(cls, pcode, region, aft, times, floor=0.01):
+        '''Table of one region from its (masked) allele frequency trajectories'''
+        af = np.ma.getdata(aft)
+        observed = ~np.ma.getmaskarray(aft)
+        with np.errstate(invalid='ignore'):
+            polymorphic = (((af > floor) & observed).any(axis=0) &
+                           ((af < 1 - floor) & observed).any(axis=0))
+
+        # alleles sorted by position and allele, then their observed time points
+        positions, alleles = polymorphic.T.nonzero()
+        ai, ti = observed[:, alleles, positions].T.nonzero()
+        return cls(pcode, np.asarray(times)[:af.shape[0]], floor, regions=[region],
+                   lengths=[af.shape[-1]], observed=observed.any(axis=1),
+                   region=np.zeros(len(ai)), position=positions[ai],
+                   allele=alleles[ai], time=ti, freq=af[ti, alleles[ai], positions[ai]])
+
+
+    @classmethod
+    def load(cls, fn):
+        data = np.load(fn)
+        lengths = data['lengths']
+        observed = np.unpackbits(data['observed'], axis=-1)[:, :lengths.sum()]
+        return cls(str(data['pcode']), data['times'], float(data['floor']),
+                   regions=map(str, data['regions']), lengths=lengths, observed=observed,
+                   **{name: data[name] for name in cls.columns})
+
+
+    def save(self, fn):
+        '''Store the table as .npz, written under a temporary name and renamed'''
+        fn_tmp = fn+'.'+str(os.getpid())+'.tmp.npz'
+        try:
+            np.savez(fn_tmp, pcode=self.pcode, times=self.times, floor=self.floor,
+                     regions=np.array(self.regions), lengths=self.lengths,
+                     observed=np.packbits(self.observed, axis=-1),
+                     **{name: getattr(self, name) for name in self.columns})
+            os.rename(fn_tmp, fn)
+        finally:
+            if os.path.isfile(fn_tmp):
+                os.remove(fn_tmp)
+
+
+    def _get_region_columns(self, ri):
+        '''Columns of region index ri in observed'''
+        start = self.lengths[:ri].sum()
+        return slice(start, start + self.lengths[ri])
+
+
+    def _take(self, rows, regions=None):
+        '''Table with some rows (and regions, renumbering the region column)'''
+        columns = {name: getattr(self, name)[rows] for name in self.columns}
+        lengths, observed = self.lengths, self.observed
+        if regions is not None:
+            ri = [self.regions.index(region) for region in regions]
+            renumber = -np.ones(len(self.regions), int)
+            renumber[ri] = np.arange(len(ri))
+            columns['region'] = renumber[columns['region']]
+            lengths = self.lengths[ri]
+            observed = np.concatenate([self.observed[:, self._get_region_columns(i)]
+                                       for i in ri] +
+                                      [np.zeros((len(self.times), 0), bool)], axis=1)
+        else:
+            regions = self.regions
+        return PolymorphismTable(self.pcode, self.times, self.floor, regions=regions,
+                                 lengths=lengths, observed=observed, **columns)
+
+
+    def merge(self, other):
+        '''Table with the regions of both tables, times are the union of both'''
+        if other.pcode != self.pcode or other.floor != self.floor:
+            raise ValueError('Only tables of the same patient and floor can be merged')
+        shared = [region for region in other.regions if region in self.regions]
+        if shared:
+            raise ValueError('Regions in both tables: '+', '.join(shared))
+
+        times = np.union1d(self.times, other.times)
+        columns = {name: np.concatenate([getattr(self, name), getattr(other, name)])
+                   for name in self.columns}
+        columns['region'][len(self):] += len(self.regions)
+        columns['time'] = np.concatenate([np.searchsorted(times, self.times[self.time]),
+                                          np.searchsorted(times, other.times[other.time])])
+        # positions are not observed at the times a table has no sample of
+        observed = np.zeros((len(times), self.observed.shape[1] + other.observed.shape[1]), bool)
+        observed[np.searchsorted(times, self.times), :self.observed.shape[1]] = self.observed
+        observed[np.searchsorted(times, other.times), self.observed.shape[1]:] = other.observed
+        return PolymorphismTable(self.pcode, times, self.floor,
+                                 regions=self.regions+other.regions,
+                                 lengths=np.concatenate([self.lengths, other.lengths]),
+                                 observed=observed, **columns)
+
+
+    def select_regions(self, regions):
+        '''Table of some regions, in the order given'''
+        ri = [self.regions.index(region) for region in regions]
+        rows = np.concatenate([(self.region == i).nonzero()[0] for i in ri] +
+                              [np.zeros(0, int)])
+        return self._take(rows, regions=regions)
+
+
+    def _get_allele_index(self):
+        '''First row of every allele and the allele index of every row'''
+        if self._alleles is None:
+            new = np.ones(len(self), bool)
+            new[1:] = ((np.diff(self.region) != 0) | (np.diff(self.position) != 0) |
+                       (np.diff(self.allele) != 0))
+            self._alleles = (new.nonzero()[0], np.cumsum(new) - 1)
+        return self._alleles
+
+
+    def get_number_of_alleles(self):
+        return len(self._get_allele_index()[0])
+
+
+    def get_alleles(self):
+        '''Region names, positions and allele indices of the alleles'''
+        first = self._get_allele_index()[0]
+        regions = np.array(self.regions, dtype=object)
+        return regions[self.region[first]], self.position[first], self.allele[first]
+
+
+    def get_trajectories(self):
+        '''Allele x time masked array of frequencies, masked where not observed'''
+        row_allele = self._get_allele_index()[1]
+        traj = np.ma.masked_all((self.get_number_of_alleles(), len(self.times)))
+        traj[row_allele, self.time] = self.freq
+        return traj
+
+
+    def select_alleles(self, ind):
+        '''Table of some alleles, ind is a boolean or index array over alleles'''
+        first, row_allele = self._get_allele_index()
+        keep = np.zeros(self.get_number_of_alleles(), bool)
+        keep[ind] = True
+        return self._take(keep[row_allele])
+
+
+    def filter(self, condition):
+        '''Table of the alleles where condition (e.g. on get_trajectories) is True
+
+        Masked entries of the condition count as False.
+        '''
+        return self.select_alleles(np.ma.filled(condition, False))
+
+
+    def get_minor_frequencies(self, region, ti):
+        '''Minor allele frequency (1 - major allele frequency) at every position of a region
+
+        Exact where the minor allele frequency is above the floor, below it may be 0.
+        Positions without polymorphic alleles are 0, positions not observed at time
+        index ti are masked.
+        '''
+        ri = self.regions.index(region)
+        first = self._get_allele_index()[0]
+        freq = self.get_trajectories()[:, ti]
+        ind = (self.region[first] == ri) & ~np.ma.getmaskarray(freq)
+        major = np.zeros(self.lengths[ri])
+        np.maximum.at(major, self.position[first][ind], np.ma.getdata(freq)[ind])
+        # the major allele is in the table unless it is above 1 - floor at all times,
+        # in which case the polymorphic alleles at the position are all below the floor
+        return np.ma.array(np.where(major > self.floor, 1 - major, 0),
+                           mask=~self.observed[ti, self._get_region_columns(ri)])
+
+
+
+# Functions
+def get_polymorphism_folder():
+    '''Folder of the stored tables (HIVEVO_POLYMORPHISM_FOLDER or the figure data folder)'''
+    folder = os.getenv('HIVEVO_POLYMORPHISM_FOLDER')
+    if folder is None:
+        username = os.path.split(os.getenv('HOME'))[-1]
+        folder = get_figure_folder(username, 'first')+'data/polymorphisms/'
+    return folder
+
+
+def get_polymorphism_filename(pcode, region, floor=0.01, cov_min=None, type='nuc'):
+    '''Filename of the stored table, tables of other input data versions have other names'''
+    import re
+    from cache import get_data_version
+
+    parts = [pcode, region, type, 'cov'+str(cov_min), 'floor'+str(floor)]
+    version = get_data_version()
+    if version:
+        parts.append('data'+re.sub('[^A-Za-z0-9_.+-]+', '_', version))
+    return get_polymorphism_folder()+'_'.join(parts)+'.npz'
+
+
+def get_polymorphism_table(pcode, regions, floor=0.01, cov_min=None, type='nuc'):
+    '''Polymorphism table of some regions of a patient
+
+    The table of every region is read from its stored file, regions that are not
+    stored yet are extracted from the trajectories and stored.
+    '''
+    table = None
+    for region in regions:
+        fn = get_polymorphism_filename(pcode, region, floor=floor, cov_min=cov_min, type=type)
+        if os.path.isfile(fn):
+            new = PolymorphismTable.load(fn)
+        else:
+            times = load_patient(pcode).dsi
+            aft = get_allele_frequency_trajectories(pcode, region, cov_min=cov_min, type=type)
+            new = PolymorphismTable.from_trajectories(pcode, region, aft, times, floor=floor)
+
+            folder = os.path.dirname(fn)
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    # created by a parallel run in the meantime
+                    if not os.path.isdir(folder):
+                        raise
+            new.save(fn)
+        table = new if table is None else table.merge(new)
+
+    return table
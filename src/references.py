@@ -0,0 +1,138 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Registry of subtype reference alignments.
+
+            Parsing an alignment and computing its entropy, consensus and gaps
+            is slow, and the scripts do it for every patient and region. The
+            registry does it once per (refname, subtype, region, sequence type)
+            and stores the resulting arrays in a small .npz file, so that later
+            runs do not need to parse the alignment at all.
+'''
+# Modules
+import os
+import numpy as np
+
+from filenames import get_figure_folder
+
+
+# Globals
+_references = {}
+
+
+
+# Classes
+class ReferenceProfile(object):
+    '''Entropy, consensus and ungapped positions of a reference alignment
+
+    Provides the subset of the HIVreference interface used by the figure scripts.
+    '''
+    def __init__(self, entropy, consensus_indices, good_pos_in_reference):
+        self.entropy = entropy
+        self.consensus_indices = consensus_indices
+        self.good_pos_in_reference = good_pos_in_reference
+
+
+    def get_entropy_in_patient_region(self, map_to_ref):
+        return self.entropy[map_to_ref[:, 0]]
+
+
+    def get_consensus_indices_in_patient_region(self, map_to_ref):
+        return self.consensus_indices[map_to_ref[:, 0]]
+
+
+
+# Functions
+def get_reference_folder():
+    '''Folder of the stored reference profiles (HIVEVO_REFERENCE_FOLDER or the figure data folder)'''
+    folder = os.getenv('HIVEVO_REFERENCE_FOLDER')
+    if folder is None:
+        username = os.path.split(os.getenv('HOME'))[-1]
+        folder = get_figure_folder(username, 'first')+'data/references/'
+    return folder
+
+
+def get_reference_filename(refname, subtype, region=None, type='nuc', threshold=0.05):
+    '''Filename of the stored profile, profiles of other input data versions have other names'''
+    import re
+    from cache import get_data_version
+
+    parts = ([refname, subtype] + ([region] if region is not None else []) +
+             [type, str(threshold)])
+    version = get_data_version()
+    if version:
+        parts.append('data'+re.sub('[^A-Za-z0-9_.+-]+', '_', version))
+    return get_reference_folder()+'_'.join(parts)+'.npz'
+
+
+def compute_reference_profile(refname, subtype, region=None, type='nuc', threshold=0.05):
+    '''Parse the alignment and compute its profile'''
+    from hivevo.hivevo.HIVreference import HIVreference, HIVreferenceAminoacid
+
+    if type == 'nuc':
+        ref = HIVreference(refname=refname, subtype=subtype)
+    else:
+        ref = HIVreferenceAminoacid(region, refname=refname, subtype=subtype)
+
+    # an identity map to the reference gives the profile along the full alignment
+    good_pos_in_reference = ref.get_ungapped(threshold=threshold)
+    identity = np.repeat(np.arange(len(good_pos_in_reference))[:, None], 2, axis=1)
+    return ReferenceProfile(ref.get_entropy_in_patient_region(identity),
+                            np.array(ref.get_consensus_indices_in_patient_region(identity), dtype=np.int8),
+                            np.array(good_pos_in_reference, dtype=bool))
+
+
+def store_reference_profile(ref, fn):
+    '''Store a profile to fn atomically, since parallel workers may read it concurrently'''
+    folder = os.path.dirname(fn)
+    try:
+        os.makedirs(folder)
+    except OSError:
+        if not os.path.isdir(folder):
+            raise
+
+    fn_tmp = fn+'.'+str(os.getpid())+'.tmp'
+    with open(fn_tmp, 'wb') as f:
+        np.savez(f, entropy=ref.entropy,
+                 consensus_indices=ref.consensus_indices,
+                 good_pos_in_reference=ref.good_pos_in_reference)
+    os.rename(fn_tmp, fn)
+
+
+def get_reference(refname='HXB2', subtype='B', region=None, type='nuc', threshold=0.05):
+    '''Profile of a reference alignment, loaded once per process
+
+    Parameters:
+       refname   -- reference sequence for the coordinates (HXB2, NL4-3)
+       subtype   -- subtype of the alignment ('B', 'C', 'AE', or 'any' for group M)
+       region    -- region of amino acid alignments (nucleotide alignments are genomewide)
+       type      -- 'nuc' or 'aa'
+       threshold -- gap frequency threshold for good_pos_in_reference
+    '''
+    if type == 'nuc':
+        region = None
+
+    key = (refname, subtype, region, type, threshold)
+    if key not in _references:
+        fn = get_reference_filename(refname, subtype, region=region, type=type, threshold=threshold)
+        if os.path.isfile(fn):
+            arrays = np.load(fn)
+            ref = ReferenceProfile(arrays['entropy'],
+                                   arrays['consensus_indices'],
+                                   arrays['good_pos_in_reference'])
+        else:
+            ref = compute_reference_profile(refname, subtype, region=region, type=type,
+                                            threshold=threshold)
+            store_reference_profile(ref, fn)
+        _references[key] = ref
+
+    return _references[key]
+
+
+def get_patient_reference(p, subtype='patient', refname='HXB2', region=None, type='nuc',
+                          threshold=0.05):
+    '''Reference profile of the patient's subtype (subtype='patient') or of subtype'''
+    if subtype == 'patient':
+        subtype = p['Subtype']
+    return get_reference(refname=refname, subtype=subtype, region=region, type=type,
+                         threshold=threshold)
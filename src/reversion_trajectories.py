@@ -6,6 +6,7 @@ from hivevo.hivevo.af_tools import divergence
 from util import store_data, load_data, fig_width, fig_fontsize, \
                  add_panel_label ,add_binned_column, HIVEVO_colormap
 from util import boot_strap_patients, replicate_func
+from sfs import SiteFrequencySpectrum
 import os
 from filenames import get_figure_folder
 import argparse
@@ -16,14 +17,14 @@ plt.ion()
 sns.set_style('darkgrid')
 
 
-def get_toaway_histograms(subtype, Sc=1):
+def get_toaway_spectra(subtype, Sc=1):
     '''
-    calculate allele frequency histograms for each patient and each time points
-    separately for sites that agree or disagree with consensus.
-    this can be done for a low and high entropy category with the threshold set by Sc
+    collect the founder allele frequencies for each patient and each time points
+    separately for sites that agree (away) or disagree (to) with consensus.
+    this can be done for a low and high entropy category with the threshold set by Sc,
+    the spectra are labelled 'away_low', 'to_high', etc.
     '''
-    away_histogram = {(pcode, Sbin):{} for Sbin in ['low','high'] for pcode in patients}
-    to_histogram = {(pcode, Sbin):{} for Sbin in ['low','high'] for pcode in patients}
+    spectrum = SiteFrequencySpectrum()
     # if subtypes == 'any' meaning comparison to groupM, we can load the reference here
     if subtype=='any':
         hxb2 = HIVreference(refname='HXB2', subtype = subtype)
@@ -52,15 +53,35 @@ def get_toaway_histograms(subtype, Sc=1):
                 away_sites = ancestral==consensus
                 aft_HXB2 = aft[:,:,patient_to_subtype[:,2]]
 
-                for H, sites in [(away_histogram, away_sites), (to_histogram, ~away_sites)]:
+                for toaway, sites in [('away', away_sites), ('to', ~away_sites)]:
                     for Sbin in ['low', 'high']:
                         if Sbin=='low':
                             ind = (sites)&(subtype_entropy<Sc)&(good_ref)
                         else:                    
                             ind = (sites)&(subtype_entropy>=Sc)&(good_ref)
                         for ti,t in enumerate(p.dsi):
-                            y,x = np.histogram(aft_HXB2[ti,ancestral[ind],np.where(ind)[0]].compressed(), bins=af_bins)
-                            H[(pcode, Sbin)][t]=y
+                            spectrum.add(pcode, toaway+'_'+Sbin, t,
+                                         aft_HXB2[ti,ancestral[ind],np.where(ind)[0]].compressed())
+
+    return spectrum
+
+
+def get_toaway_histograms(subtype, Sc=1):
+    '''
+    calculate allele frequency histograms for each patient and each time points
+    separately for sites that agree or disagree with consensus.
+    this can be done for a low and high entropy category with the threshold set by Sc
+    '''
+    away_histogram = {(pcode, Sbin):{} for Sbin in ['low','high'] for pcode in patients}
+    to_histogram = {(pcode, Sbin):{} for Sbin in ['low','high'] for pcode in patients}
+
+    spectrum = get_toaway_spectra(subtype, Sc=Sc)
+    counts = spectrum.segment_histograms(af_bins)
+    for pcode, label, t, y in izip(spectrum.pcodes, spectrum.labels, spectrum.times, counts):
+        toaway, Sbin = label.split('_')
+        H = away_histogram if toaway=='away' else to_histogram
+        # regions of the same patient and time add up
+        H[(pcode, Sbin)][t] = H[(pcode, Sbin)].get(t, 0) + y
 
     return to_histogram, away_histogram
 
@@ -0,0 +1,60 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Single pass over patient regions feeding several analyses.
+
+            Many collectors need the same per (patient, region, reference)
+            quantities: the trajectories, the map to the reference, ancestral
+            and consensus indices, subtype entropy and good_ref. scan loads
+            these once per unit with cohort.load_patient_region and passes
+            them to every registered analysis, so running several analyses
+            costs one pass over the data. Analyses are module level functions
+            analysis(pr, **kwargs), where pr is the dict of load_patient_region;
+            their results are returned per analysis, in the order of the units,
+            to be merged by the respective collectors.
+'''
+# Modules
+from cohort import load_patient_region
+from parallel import map_patient_regions
+
+
+
+# Functions
+def _scan_unit(pcode, region, analyses, subtypes, cov_min=None, refname='HXB2',
+               sequence_type='nuc'):
+    '''Run all analyses on one patient region, for every reference
+
+    Returns:
+       dict {subtype: {name: result}}
+    '''
+    results = {}
+    for subtype in subtypes:
+        # the trajectories are memoized in cohort, only the reference changes
+        pr = load_patient_region(pcode, region, cov_min=cov_min, refname=refname,
+                                 subtype=subtype, type=sequence_type)
+        results[subtype] = {name: func(pr, **kwargs)
+                            for name, (func, kwargs) in analyses.iteritems()}
+    return results
+
+
+def scan(patients, regions, analyses, subtypes=['patient'], cov_min=None, refname='HXB2',
+         sequence_type='nuc', jobs=1, patient_major=True):
+    '''Load every (patient, region, reference) once and apply several analyses to it
+
+    Parameters:
+       analyses      -- dict {name: (function, kwargs)}, function(pr, **kwargs) is called
+                        with the dict returned by load_patient_region
+       subtypes      -- references to map to ('patient' and/or 'any'), see load_patient_region
+       jobs          -- number of processes, see parallel.map_patient_regions
+       patient_major -- loop over patients in the outer loop (else regions)
+
+    Returns:
+       dict {subtype: {name: list of results in the order of the units}}
+    '''
+    subtypes = list(subtypes)
+    units = map_patient_regions(_scan_unit, patients, regions, jobs=jobs,
+                                patient_major=patient_major, analyses=analyses,
+                                subtypes=subtypes, cov_min=cov_min, refname=refname,
+                                sequence_type=sequence_type)
+    return {subtype: {name: [unit[subtype][name] for unit in units] for name in analyses}
+            for subtype in subtypes}
@@ -0,0 +1,136 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Site frequency spectra that can be rebinned after collection.
+
+            The derived allele frequencies of every (patient, class, time) are
+            kept as one sorted segment of a flat array. Most derived alleles
+            are at frequency 0, these are only counted per segment. Any
+            histogram, for any bins and time window, is then obtained with
+            searchsorted on the selected segments, without recomputing the
+            frequencies. Spectra of parallel workers are combined with merge.
+'''
+# Modules
+import numpy as np
+
+
+
+# Classes
+class SiteFrequencySpectrum(object):
+    '''Allele frequencies by patient, class (e.g. syn/nonsyn) and time
+
+    Attributes:
+       pcodes, labels, times -- keys of the segments
+       values                -- nonzero frequencies, sorted within each segment
+       offsets               -- segment i is values[offsets[i]:offsets[i+1]]
+       zeros                 -- number of frequencies 0 of every segment
+
+    Segments with the same key are allowed (e.g. one per protein) and add up.
+    '''
+    def __init__(self):
+        self.pcodes = np.array([], dtype=object)
+        self.labels = np.array([], dtype=object)
+        self.times = np.array([], dtype=float)
+        self.values = np.array([], dtype=float)
+        self.offsets = np.zeros(1, int)
+        self.zeros = np.array([], dtype=int)
+        self._pending = []
+
+
+    def __len__(self):
+        self._finalize()
+        return len(self.times)
+
+
+    def __repr__(self):
+        self._finalize()
+        return ('SiteFrequencySpectrum(segments='+str(len(self.times))+
+                ', frequencies='+str(len(self.values) + self.zeros.sum())+')')
+
+
+    def __getstate__(self):
+        self._finalize()
+        return self.__dict__
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'zeros' not in state:
+            # stored before zeros were counted separately
+            self.zeros = np.zeros(len(self.times), int)
+
+
+    def add(self, pcode, label, time, freqs):
+        '''Add the frequencies of one patient, class and time'''
+        freqs = np.asarray(freqs, float).ravel()
+        nonzero = freqs != 0
+        self._pending.append((pcode, label, time, np.sort(freqs[nonzero]),
+                              len(freqs) - nonzero.sum()))
+
+
+    def merge(self, other):
+        '''Add the segments of another spectrum'''
+        other._finalize()
+        self._finalize()
+        self.pcodes = np.concatenate([self.pcodes, other.pcodes])
+        self.labels = np.concatenate([self.labels, other.labels])
+        self.times = np.concatenate([self.times, other.times])
+        self.offsets = np.concatenate([self.offsets, other.offsets[1:] + len(self.values)])
+        self.values = np.concatenate([self.values, other.values])
+        self.zeros = np.concatenate([self.zeros, other.zeros])
+        return self
+
+
+    def _finalize(self):
+        '''Append the pending segments to the flat arrays'''
+        if not self._pending:
+            return
+        pcodes, labels, times, freqs, zeros = zip(*self._pending)
+        self._pending = []
+        self.pcodes = np.concatenate([self.pcodes, np.array(pcodes, dtype=object)])
+        self.labels = np.concatenate([self.labels, np.array(labels, dtype=object)])
+        self.times = np.concatenate([self.times, np.array(times, dtype=float)])
+        lengths = np.cumsum([len(f) for f in freqs])
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + lengths])
+        self.values = np.concatenate([self.values]+list(freqs))
+        self.zeros = np.concatenate([self.zeros, np.array(zeros, dtype=int)])
+
+
+    def select(self, pcodes=None, labels=None, time_window=None):
+        '''Indices of the segments of some patients, classes and times in [tmin, tmax)'''
+        self._finalize()
+        ind = np.ones(len(self.times), bool)
+        if pcodes is not None:
+            ind &= np.in1d(self.pcodes, list(pcodes))
+        if labels is not None:
+            ind &= np.in1d(self.labels, list(labels))
+        if time_window is not None:
+            ind &= (self.times >= time_window[0]) & (self.times < time_window[1])
+        return ind.nonzero()[0]
+
+
+    def segment_histograms(self, bins, segments=None):
+        '''Histogram of every segment, segments x bins, binned like np.histogram'''
+        self._finalize()
+        bins = np.asarray(bins, float)
+        if segments is None:
+            segments = np.arange(len(self.times))
+        counts = np.zeros((len(segments), len(bins) - 1))
+        for i, si in enumerate(segments):
+            seg = self.values[self.offsets[si]:self.offsets[si+1]]
+            # bins are half open, except the last one
+            edges = np.searchsorted(seg, bins, side='left')
+            edges[-1] = np.searchsorted(seg, bins[-1], side='right')
+            counts[i] = np.diff(edges)
+
+        # zeros go to the bin containing 0, if any
+        if bins[0] <= 0 <= bins[-1]:
+            b0 = min(np.searchsorted(bins, 0, side='right') - 1, len(bins) - 2)
+            counts[:, b0] += self.zeros[segments]
+        return counts
+
+
+    def histogram(self, bins, pcodes=None, labels=None, time_window=None):
+        '''Summed histogram of the selected segments'''
+        segments = self.select(pcodes=pcodes, labels=labels, time_window=time_window)
+        return self.segment_histograms(bins, segments).sum(axis=0)
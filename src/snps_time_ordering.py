@@ -2,24 +2,29 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 import numpy as np
 import seaborn as sns
-from hivevo.patients import Patient
 from hivevo.samples import all_fragments
 from hivevo.sequence import alpha
+from cohort import load_patient
+from polymorphisms import get_polymorphism_table
 plt.ion()
 sns.set_style('darkgrid')
 
-p = Patient.load('p3')
-aft = p.get_allele_frequency_trajectories('RT1')
-div = (aft*(1.0-aft)).sum(axis=1)
-var_pos = div.max(axis=0)>0.1
+p = load_patient('p3')
+# alleles above 1% at some time, the diversity of a position ignores those below
+polymorphisms = get_polymorphism_table('p3', ['RT1'], floor=0.01)
+freqs = polymorphisms.get_trajectories()
+positions, alleles = polymorphisms.get_alleles()[1:]
+L = polymorphisms.lengths[0]
+div = np.zeros((L, freqs.shape[1]))
+np.add.at(div, positions, np.ma.filled(freqs*(1.0-freqs), 0))
+var_pos = div.max(axis=1)>0.1
 
 plt.figure()
-for pos in np.where(var_pos)[0]:
-    for ni in range(5):
-        traj = aft[:,ni,pos]
-        if traj.max()>0.2 and traj[0]<0.5 : #and traj[-1]<0.2:
-            plt.plot(p.ysi[~traj.mask], traj[~traj.mask], c = cm.jet(1.0*pos/aft.shape[-1]), label = str(pos+1)+alpha[ni], lw=2)
-            print pos, alpha[ni], np.round(traj,2)
+selected = np.ma.filled((freqs.max(axis=1)>0.2) & (freqs[:,0]<0.5), False) #& (freqs[:,-1]<0.2)
+selected &= var_pos[positions] & (alleles<5)
+for traj, pos, ni in zip(freqs[selected], positions[selected], alleles[selected]):
+    plt.plot(p.ysi[~traj.mask], traj[~traj.mask], c = cm.jet(1.0*pos/L), label = str(pos+1)+alpha[ni], lw=2)
+    print pos, alpha[ni], np.round(traj,2)
 
 plt.ylabel('SNP frequency')
 plt.xlabel('ETI [years]')
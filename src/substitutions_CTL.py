@@ -12,18 +12,40 @@ import numpy as np
 import pandas as pd
 
 from hivevo.hivevo.sequence import alpha
-from hivevo.hivevo.patients import Patient
 from util import store_data, load_data, draw_genome, fig_width, fig_fontsize
+from cache import cached_collect, use_stored_data
+from cohort import load_patient, get_allele_frequency_trajectories, get_reference_frame
+from parallel import map_patient_regions, merge_rows, add_jobs_argument
 from filenames import get_figure_folder
 
 
+# Globals
+_codon_table = {}
+
+
 
 # Functions
+def get_codon_table():
+    '''Amino acids of all codons of letters in alpha, indexed by 36 * i1 + 6 * i2 + i3
+
+    Codons with gaps are '-', codons with N translate as in Biopython (e.g. CTN -> L).
+    '''
+    if 'aa' not in _codon_table:
+        from itertools import product
+        from Bio.Seq import translate
+        table = []
+        for codon in product(alpha, repeat=3):
+            codon = ''.join(codon)
+            table.append('-' if '-' in codon else translate(codon))
+        _codon_table['aa'] = np.array(table)
+    return _codon_table['aa']
+
+
 def collect_ctl_data(patients, regions, ctl_kind='mhci=80'):
     data_ctl = []
 
     for pi, pcode in enumerate(patients):
-        p = Patient.load(pcode)
+        p = load_patient(pcode)
 
         # Add predicted epitopes
         ctl_table = p.get_ctl_epitopes(kind=ctl_kind, regions=regions)
@@ -33,167 +55,273 @@ def collect_ctl_data(patients, regions, ctl_kind='mhci=80'):
     return data_ctl
 
 
-def collect_substitution_data(patients, regions, cov_min=100):
-    from Bio.Seq import translate
+def _substitutions_patient_region(pcode, region, cov_min=100):
+    '''Substitutions (fixations of a derived allele) in one patient region
+
+    A site has a substitution if the ancestral allele is at 0.7 or more at the first
+    and drops to 0.2 or less at some covered time, and a derived nucleotide is at 0.95
+    or more at the last covered time. The substitution is dated halfway between the
+    covered times around the first time the derived allele is above 0.5.
+    '''
+    p = load_patient(pcode)
+    print p.name, region
+
+    initial_indices = p.get_initial_indices(region)
+    aft = get_allele_frequency_trajectories(pcode, region, cov_min=cov_min)
+    af = aft.data
+    L = af.shape[-1]
+    positions = np.arange(L)
+    times = np.arange(af.shape[0])[:, None]
+
+    # covered times of each site, by the mask of the first nucleotide
+    covered = ~np.ma.getmaskarray(aft)[:, 0]
+    has_data = covered.any(axis=0)
+    first = covered.argmax(axis=0)
+    last = len(covered) - 1 - covered[::-1].argmax(axis=0)
+
+    # ancestral allele at the first covered time, and lost at some time (indels are ignored)
+    ianc = np.minimum(initial_indices, 3)
+    af_anc = af[:, ianc, positions]
+    af_anc_min = np.where(covered, af_anc, np.inf).min(axis=0)
+    candidate = has_data & (initial_indices < 4) & \
+                (af_anc[first, positions] >= 0.7) & (af_anc_min <= 0.2)
+
+    # codons without gaps (the last one may be incomplete)
+    codon_start = positions - positions % 3
+    codon_gap = np.zeros(L, bool)
+    for offset in xrange(3):
+        inside = codon_start + offset < L
+        codon_gap[inside] |= initial_indices[codon_start[inside] + offset] == 4
+    candidate &= ~codon_gap
+
+    # a derived nucleotide fixed at the last covered time (max 1 per site)
+    af_last = af[last, :4, positions]
+    af_last[np.arange(L), ianc] = 0
+    fixed = af_last >= 0.95
+    candidate &= fixed.any(axis=1)
+
+    pos = candidate.nonzero()[0]
+    if not len(pos):
+        return []
+    inuc = fixed[pos].argmax(axis=1)
+    ianc = ianc[pos]
+
+    # Assign a time to the substitution: between the first covered time above 0.5
+    # and the covered time before (wrapping to the last, as with negative indices)
+    above = covered[:, pos] & (af[:, inuc, pos] > 0.5)
+    ist = above.argmax(axis=0)
+    prev_covered = np.maximum.accumulate(np.where(covered[:, pos], times, -1), axis=0)
+    before = prev_covered[np.maximum(ist - 1, 0), np.arange(len(pos))]
+    wrap = ist == first[pos]
+    before[wrap] = last[pos][wrap]
+    tsubst = 0.5 * (p.dsi[before] + p.dsi[ist])
+
+    # Define transition/transversion: A<->G and C<->T (same parity in alpha)
+    is_ts = (ianc % 2) == (inuc % 2)
+
+    # Check syn/nonsyn, incomplete codons translate to nothing and count as syn
+    codon_table = get_codon_table()
+    complete = codon_start[pos] + 3 <= L
+    codon = np.zeros(len(pos), int)
+    for offset, factor in enumerate((36, 6, 1)):
+        codon += factor * initial_indices[np.minimum(codon_start[pos] + offset, L - 1)]
+    rf_factor = np.array([36, 6, 1])[pos % 3]
+    codon_nuc = codon + rf_factor * (inuc - ianc)
+    is_syn = (codon_table[codon] == codon_table[codon_nuc]) | ~complete
+
+    to_ref = get_reference_frame(pcode, region).forward
     data = []
-    for pi, pcode in enumerate(patients):
-        p = Patient.load(pcode)
-
-        for region in regions:
-            print p.name, region
-
-            initial_indices = p.get_initial_indices(region)
-            aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min)
-            if np.isscalar(aft.mask):
-                aft.mask = np.zeros_like(aft, bool)
-
-            coomap = p.map_to_external_reference(region)[:, ::2]
-            coomapd = {'pat_to_subtype': dict(coomap[:, ::-1]),
-                       'subtype_to_pat': dict(coomap)}
-
-            for posdna in xrange(aft.shape[-1]):
-                # Get the position in reference coordinates
-                if posdna not in coomapd['pat_to_subtype']:
-                    pos_sub=-1 #continue
-                else:
-                    pos_sub = coomapd['pat_to_subtype'][posdna]
-
-                # Get allele frequency trajectory
-                aftpos = aft[:, :, posdna]
-                ind = -aftpos[:, 0].mask
-                if ind.sum() == 0:
-                    continue
-                aftpos = aftpos[ind]
-                timespos = p.dsi[ind]
-
-                # Ancestral allele
-                ianc = initial_indices[posdna]
-                anc = alpha[ianc]
-
-                # Ignore indels
-                if ianc >= 4:
-                    continue
-
-                # Check for fixation
-                if (aftpos[0, ianc] < 0.7) or np.min(aftpos[:, ianc]) > 0.2:
-                    continue
-
-                # Get codon
-                ci = posdna // 3
-                rf = posdna % 3
-                cod_anc = ''.join(alpha[initial_indices[ci * 3: (ci + 1) * 3]])
-                if '-' in cod_anc:
-                    continue
-                aa_anc = translate(cod_anc)
-
-                # Check which allele (if any) is fixing
-                for inuc, nuc in enumerate(alpha[:4]):
-                    if nuc == anc:
-                        continue
-                    
-                    if aftpos[-1, inuc] < 0.95:
-                        continue
-
-                    # NOTE: OK, it's a substitution (max 1 per site)
-                    break
-                else:
-                    continue
-
-                # Assign a time to the substitution
-                ist = (aftpos[:, inuc] > 0.5).nonzero()[0][0]
-                tsubst = 0.5 * (timespos[ist - 1] + timespos[ist])
-
-                nuc = alpha[inuc]
-                mut = anc+'->'+nuc
-
-                # Define transition/transversion
-                if frozenset(nuc+anc) in (frozenset('CT'), frozenset('AG')):
-                    trclass = 'ts'
-                else:
-                    trclass = 'tv'
-
-                # Check syn/nonsyn
-                cod_nuc = cod_anc[:rf] + nuc + cod_anc[rf+1:]
-                aa_nuc = translate(cod_nuc)
-                is_syn = aa_nuc == aa_anc
-
-                datum = {'pcode': p.name,
-                         'region': region,
-                         'pos_patient': posdna,
-                         'pos_ref': pos_sub,
-                         'mut': mut,
-                         'trclass': trclass,
-                         'syn': is_syn,
-                         'time': tsubst,
-                        }
-
-                data.append(datum)
+    for i, posdna in enumerate(pos):
+        datum = {'pcode': p.name,
+                 'region': region,
+                 'pos_patient': posdna,
+                 'pos_ref': to_ref[posdna] if posdna < len(to_ref) else -1,
+                 'mut': alpha[ianc[i]]+'->'+alpha[inuc[i]],
+                 'trclass': 'ts' if is_ts[i] else 'tv',
+                 'syn': is_syn[i],
+                 'time': tsubst[i],
+                }
+
+        data.append(datum)
+
+    return data
 
 
+def collect_substitution_data(patients, regions, cov_min=100, jobs=1):
+    data = map_patient_regions(_substitutions_patient_region, patients, regions,
+                               jobs=jobs, cov_min=cov_min)
+    data = merge_rows(data)
     data = pd.DataFrame(data)
     return data
 
 
-def correlate_epitope_substitution(ds, dctl):
-    '''Correlate presence of a substitution with epitope'''
+def get_genome_range():
+    '''HXB2 coordinates from the start of F1 to the end of F6'''
     from hivwholeseq.data.primers import primers_coordinates_HXB2_outer
     start_F1 = primers_coordinates_HXB2_outer['F1'][0][1]
     end_F6 = primers_coordinates_HXB2_outer['F6'][1][0]
+    return start_F1, end_F6
 
-    ds = ds.copy()
-
-    dg = []
-    for pcode, datum in dctl.groupby('pcode'):
-        a = np.arange(start_F1, end_F6)
-        b = np.zeros(len(a), bool)
-        for _, epi in datum.iterrows():
-            b[(a >= epi['start_HXB2']) & (a < epi['end_HXB2'])] = True
-        c = np.zeros(len(a), bool)
-        datum = ds.loc[ds['pcode'] == pcode]
-        # Keep only nonsyn substitutions
-        datum = datum.loc[datum['syn'] == False]
-        c[datum['pos_ref'] - a[0]] = True
-        dat = {'pos': a,
-               'epitope': b,
-               'substitution': c,
-               }
-        dat = pd.DataFrame(dat)
-        dat['pcode'] = pcode
-        dg.append(dat)
-    dg = pd.concat(dg)
 
-    # Exclude env because it has antibody-related substitutions
+def get_env_exclusion():
+    '''HXB2 interval of env excluded from the enrichment (antibody-related substitutions)'''
     from hivwholeseq.reference import load_custom_reference
     from hivwholeseq.utils.sequence import find_annotation
     ref = load_custom_reference('HXB2', 'gb')
     start_env = find_annotation(ref, 'gp41').location.nofuzzy_start 
     end_env = find_annotation(ref, 'gp41').location.nofuzzy_end - 450
-    dg = dg.loc[(dg['pos'] < start_env) | (dg['pos'] >= end_env)]
-
-    M = dg.groupby(['epitope', 'substitution']).size().unstack()
-    Ma = np.array(M)
-    xp = 1.0*Ma[1,0]/Ma[0,0]*Ma[0,1]
-    xs = Ma[1,1] - xp
-    print M
+    return start_env, end_env
+
+
+def get_interval_coverage(rows, starts, ends, nrows, start, end):
+    '''Mask of the positions start..end-1 covered by the intervals [starts, ends) of each row
+
+    The intervals are painted into a difference array, one +1 and one -1 per interval,
+    whose cumulative sum counts the intervals covering every position.
+    '''
+    L = end - start
+    starts = np.clip(np.asarray(starts, int) - start, 0, L)
+    ends = np.maximum(np.clip(np.asarray(ends, int) - start, 0, L), starts)
+    diff = np.zeros((nrows, L + 1), int)
+    np.add.at(diff, (rows, starts), 1)
+    np.add.at(diff, (rows, ends), -1)
+    return diff.cumsum(axis=1)[:, :-1] > 0
+
+
+def get_epitope_substitution_masks(ds, dctl, pcodes, start, end):
+    '''Epitope coverage and nonsyn substitutions (patients x positions start..end-1)'''
+    prow = {pcode: i for i, pcode in enumerate(pcodes)}
+
+    dctl = dctl.loc[dctl['pcode'].isin(pcodes)]
+    epitope = get_interval_coverage(dctl['pcode'].map(prow).values,
+                                    dctl['start_HXB2'].values, dctl['end_HXB2'].values,
+                                    len(pcodes), start, end)
+
+    # Keep only nonsyn substitutions at reference positions within the range
+    ds = ds.loc[(ds['syn'] == False) & ds['pcode'].isin(pcodes) &
+                (ds['pos_ref'] >= start) & (ds['pos_ref'] < end)]
+    substitution = np.zeros((len(pcodes), end - start), bool)
+    substitution[ds['pcode'].map(prow).values, ds['pos_ref'].values - start] = True
+    return epitope, substitution
+
+
+def get_contingency_tables(epitope, substitution, keep):
+    '''2x2 tables of epitope (rows) and substitution (columns) for many site selections
+
+    Parameters:
+       epitope      -- epitope masks, ctl kinds x patients x positions
+       substitution -- substitution mask, patients x positions
+       keep         -- positions to count, ctl kinds x selections x positions
+
+    Returns:
+       counts, ctl kinds x selections x 2 x 2, with False before True as in groupby
+    '''
+    e = epitope.astype(float)
+    s = substitution.astype(float)
+    k = keep.astype(float)
+    n = substitution.shape[0] * k.sum(axis=-1)
+    n_e = np.einsum('kpl,kxl->kx', e, k)
+    n_s = np.einsum('pl,kxl->kx', s, k)
+    n_es = np.einsum('kpl,pl,kxl->kx', e, s, k)
+
+    tables = np.empty(n.shape+(2, 2), int)
+    tables[..., 0, 0] = n - n_e - n_s + n_es
+    tables[..., 0, 1] = n_s - n_es
+    tables[..., 1, 0] = n_e - n_es
+    tables[..., 1, 1] = n_es
+    return tables
+
+
+def get_enrichment(table, npatients):
+    '''Fisher's exact test and excess of substitutions in epitopes of a 2x2 table'''
     from scipy.stats import fisher_exact
-    print 'Fisher\'s exact enrichment:', fisher_exact(Ma)[0]
-    print 'Fisher\'s exact P value:', fisher_exact(Ma)[1]
-    print 'expected:', xp
-    print 'excess:',  xs, 'per patient:',xs/9.0
-
-    pos_epi = dg.loc[dg['epitope'] == True]['pos'].unique()
-    dg2 = dg.loc[dg['pos'].isin(pos_epi)].copy()
-    M2 = dg2.groupby(['epitope', 'substitution']).size().unstack()
-    M2a = np.array(M2)
-    xp = 1.0*M2a[1,0]/M2a[0,0]*M2a[0,1]
-    xs = M2a[1,1] - xp
-    print M2
-    print '\nFisher\'s exact enrichment:', fisher_exact(M2a)[0]
-    print 'Fisher\'s exact P value:', fisher_exact(M2a)[1]
-    print 'expected:', xp
-    print 'excess:',  xs, 'per patient:',xs/9.0
-    return {'dg': dg,
-            'dg2': dg2,
+    odds_ratio, pval = fisher_exact(table)
+    expected = 1.0*table[1,0]/table[0,0]*table[0,1]
+    excess = table[1,1] - expected
+    return {'enrichment': odds_ratio, 'pval': pval,
+            'expected': expected, 'excess': excess, 'excess_per_patient': excess / npatients}
+
+
+def epitope_enrichment_sweep(ds, ctl_tables, exclusions=None):
+    '''Epitope enrichment of nonsyn substitutions for many CTL predictions and exclusions
+
+    Parameters:
+       ds         -- substitutions, from collect_substitution_data
+       ctl_tables -- dict of ctl_kind: epitope table, from collect_ctl_data
+       exclusions -- dict of name: list of excluded HXB2 intervals [start, end)
+                     (default: none and env)
+
+    Returns:
+       DataFrame with the 2x2 table and Fisher's test of every ctl_kind, exclusion and
+       site set ('all' positions or only 'epitope' positions of any patient)
+    '''
+    start, end = get_genome_range()
+    if exclusions is None:
+        exclusions = {'none': [], 'env': [get_env_exclusion()]}
+
+    ctl_kinds = sorted(ctl_tables)
+    exclusion_names = sorted(exclusions)
+    pcodes = sorted(set().union(*[set(ctl_tables[kind]['pcode']) for kind in ctl_kinds]))
+
+    masks = [get_epitope_substitution_masks(ds, ctl_tables[kind], pcodes, start, end)
+             for kind in ctl_kinds]
+    epitope = np.array([m[0] for m in masks])
+    substitution = masks[0][1]
+
+    keep = ~np.array([get_interval_coverage(np.zeros(len(exclusions[name]), int),
+                                            [iv[0] for iv in exclusions[name]],
+                                            [iv[1] for iv in exclusions[name]],
+                                            1, start, end)[0]
+                      for name in exclusion_names])
+    keep = np.repeat(keep[None], len(ctl_kinds), axis=0)
+    keep_epitope = keep & epitope.any(axis=1)[:, None]
+    tables = get_contingency_tables(epitope, substitution,
+                                    np.concatenate([keep, keep_epitope], axis=1))
+
+    rows = []
+    for ki, kind in enumerate(ctl_kinds):
+        for si, sites in enumerate(['all', 'epitope']):
+            for xi, name in enumerate(exclusion_names):
+                table = tables[ki, si * len(exclusion_names) + xi]
+                row = {'ctl_kind': kind, 'exclusion': name, 'sites': sites,
+                       'n00': table[0, 0], 'n01': table[0, 1],
+                       'n10': table[1, 0], 'n11': table[1, 1]}
+                row.update(get_enrichment(table, len(pcodes)))
+                rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def correlate_epitope_substitution(ds, dctl):
+    '''Correlate presence of a substitution with epitope'''
+    start, end = get_genome_range()
+    pcodes = sorted(dctl['pcode'].unique())
+    epitope, substitution = get_epitope_substitution_masks(ds, dctl, pcodes, start, end)
+    a = np.arange(start, end)
+
+    # Exclude env because it has antibody-related substitutions
+    start_env, end_env = get_env_exclusion()
+    keep = (a < start_env) | (a >= end_env)
+    keep_epitope = keep & epitope.any(axis=0)
+    tables = get_contingency_tables(epitope[None], substitution,
+                                    np.array([[keep, keep_epitope]]))[0]
+
+    def get_positions_table(keep):
+        return pd.DataFrame({'pos': np.tile(a[keep], len(pcodes)),
+                             'epitope': epitope[:, keep].ravel(),
+                             'substitution': substitution[:, keep].ravel(),
+                             'pcode': np.repeat(pcodes, keep.sum())})
+
+    for table, prefix in izip(tables, ['', '\n']):
+        enrichment = get_enrichment(table, 9.0)
+        print pd.DataFrame(table,
+                           index=pd.Index([False, True], name='epitope'),
+                           columns=pd.Index([False, True], name='substitution'))
+        print prefix+'Fisher\'s exact enrichment:', enrichment['enrichment']
+        print 'Fisher\'s exact P value:', enrichment['pval']
+        print 'expected:', enrichment['expected']
+        print 'excess:',  enrichment['excess'], 'per patient:', enrichment['excess_per_patient']
+    return {'dg': get_positions_table(keep),
+            'dg2': get_positions_table(keep_epitope),
            }
 
 
@@ -293,6 +421,9 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Make figure for substitutions and CTL epitopes")
     parser.add_argument('--redo', action='store_true', help='recalculate data')
+    parser.add_argument('--ctl-sweep', action='store_true',
+                        help='epitope enrichment for a range of MHC-I thresholds')
+    add_jobs_argument(parser)
     params = parser.parse_args()
 
     VERBOSE = 2
@@ -304,27 +435,38 @@ if __name__ == '__main__':
     fn_data = foldername+'data/'
     fn_data = fn_data + 'substitutions_CTL.pickle'
 
-    if not os.path.isfile(fn_data) or params.redo:
-        patients = ['p1', 'p2', 'p3', 'p5', 'p6', 'p8', 'p9', 'p10', 'p11']
-        # FIXME: add more regions
-        regions = ['gag', 'pol', 'gp120_noVloops', 'gp41', 'vif', 'vpu', 'vpr', 'nef']
+    patients = ['p1', 'p2', 'p3', 'p5', 'p6', 'p8', 'p9', 'p10', 'p11']
+    # FIXME: add more regions
+    regions = ['gag', 'pol', 'gp120_noVloops', 'gp41', 'vif', 'vpu', 'vpr', 'nef']
 
-        ds = collect_substitution_data(patients, regions)
+    if use_stored_data(fn_data, redo=params.redo):
+        data = load_data(fn_data)
+        ds = data['substitutions']
+    else:
+        ds = cached_collect(collect_substitution_data, fn_data,
+                            args=(patients, regions), kwargs={'jobs': params.jobs},
+                            redo=params.redo)
 
-        dctl = collect_ctl_data(patients, regions, ctl_kind=ctl_kind)
-        correlate_epitope_substitution(ds, dctl)
+        dctl = cached_collect(collect_ctl_data, fn_data,
+                              args=(patients, regions), kwargs={'ctl_kind': ctl_kind},
+                              redo=params.redo)
 
         data = {'substitutions': ds,
                 'ctl': dctl,
                }
 
         store_data(data, fn_data)
-    else:
-        data = load_data(fn_data)
 
 
     correlate_epitope_substitution(data['substitutions'], data['ctl'])
 
+    if params.ctl_sweep:
+        ctl_tables = {kind: cached_collect(collect_ctl_data, fn_data,
+                                           args=(patients, regions), kwargs={'ctl_kind': kind},
+                                           redo=params.redo)
+                      for kind in ['mhci='+str(threshold) for threshold in xrange(50, 101, 10)]}
+        print epitope_enrichment_sweep(ds, ctl_tables).to_string()
+
     number_nonsyn_substitutions_per_patient(data['substitutions'])
 
     #plot_ctl_epitopes(data['ctl'])
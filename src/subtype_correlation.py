@@ -3,202 +3,157 @@ import os, sys
 import numpy as np
 import pandas as pd
 from itertools import izip
-from scipy.stats import spearmanr
 
-from hivevo.hivevo.patients import Patient
-from hivevo.hivevo.HIVreference import HIVreference, HIVreferenceAminoacid
 from hivevo.hivevo.samples import all_fragments
 
-from util import store_data, load_data, fig_width, fig_fontsize, get_quantiles, add_panel_label, patient_colors, patients
+from util import store_data, load_data, fig_width, fig_fontsize, get_quantile_labels, add_panel_label, patient_colors, patients
+from util import masked_ranks, subset_ranks, rank_correlation, spearman_pvalue
+from cache import cached_collect, use_stored_data
+from cohort import load_patient_region, print_cache_info
+from parallel import map_patient_regions, merge_rows, add_jobs_argument
+from scan import scan
 from filenames import get_figure_folder
 
 
 
 # Functions
-def collect_correlations(patients, regions, cov_min=1000, subtype='patient', refname='HXB2'):
-    '''Correlation of subtype entropy and intra-patient diversity'''
-    correlations = []
-    if subtype == 'any':
-        ref = HIVreference(refname=refname, subtype='any')
-        ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-    else:
-        refs = {}
-        for subtype in ['B', 'C', 'AE']:
-            ref = HIVreference(refname=refname, subtype=subtype)
-            ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-            refs[subtype] = ref
-
-    for pi, pcode in enumerate(patients):
-        p = Patient.load(pcode)
-
-        if subtype == 'patient':
-            ref = refs[p['Subtype']]
-
-        for region in regions:
-            aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min)
-            if len(aft.mask.shape) < 2:
-                aft.mask = np.zeros_like(aft, dtype=bool)
-
-            # get patient to subtype map and subset entropy vectors
-            patient_to_subtype = p.map_to_external_reference(region, refname=refname)
-            subtype_entropy = ref.get_entropy_in_patient_region(patient_to_subtype)
-            good_ref = ref.good_pos_in_reference[patient_to_subtype[:,0]]
-
-            # loop over times and calculate the correlation for each value
-            for t, af in izip(p.dsi,aft):
-                patient_entropy = np.maximum(0,-np.sum(af[:-1]*np.log(1e-10+af[:-1]), axis=0))[patient_to_subtype[:,2]]
-                # good_af is a mask for useful columns
-                good_af = (~np.any(af.mask, axis=0)[patient_to_subtype[:,2]]) & good_ref
-                if good_af.sum() > 0.5 * good_af.shape[0]:
-                    rho,pval = spearmanr(patient_entropy[good_af], subtype_entropy[good_af])
-                    correlations.append({'pcode':pcode,
-                                 'region': region,
-                                 'time': t,
-                                 'rho': rho,
-                                 'pval': pval})
-
-    return pd.DataFrame(correlations)
-
-
-def collect_correlations_aminoacids(patients, regions, cov_min=1000, subtype='patient', refname='HXB2'):
-    '''Correlation of subtype entropy and intra-patient diversity'''
-    ps = {pcode: Patient.load(pcode) for pcode in patients}
+def _correlations_from_region(pr):
+    '''Correlation of subtype entropy and intra-patient diversity in one loaded patient region'''
+    pcode, region = pr['pcode'], pr['region']
+    p, aft, patient_to_subtype = pr['patient'], pr['aft'], pr['patient_to_subtype']
+    subtype_entropy, good_ref = pr['subtype_entropy'], pr['good_ref']
+
+    # entropy of all time points at mapped positions, good_af is a mask for useful columns
+    af = aft[:, :, patient_to_subtype[:,-1]]
+    good_af = (~np.ma.getmaskarray(af).any(axis=1)) & good_ref
+    af = np.ma.getdata(af)[:, :-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        patient_entropy = np.maximum(0,-np.sum(af*np.log(1e-10+af), axis=1))
+
+    # rank correlation of all time points with enough good columns at once
+    ind = good_af.sum(axis=1) > 0.5 * good_af.shape[1]
+    good_af = good_af[ind]
+    rho = rank_correlation(masked_ranks(patient_entropy[ind], good_af),
+                           subset_ranks(subtype_entropy, good_af), good_af)
+    pval = spearman_pvalue(rho, good_af.sum(axis=1))
 
     correlations = []
-    for region in regions:
-        print region
-
-        if subtype == 'any':
-            ref = HIVreferenceAminoacid(region, refname=refname, subtype='any')
-            ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-        else:
-            refs = {}
-            for subtype in ['B', 'C', 'AE']:
-                ref = HIVreferenceAminoacid(region, refname=refname, subtype=subtype)
-                ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-                refs[subtype] = ref
-
-        for pi, pcode in enumerate(patients):
-            p = ps[pcode]
-    
-            if subtype == 'patient':
-                ref = refs[p['Subtype']]
-
-            aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min,
-                                                      type='aa')
-            if len(aft.mask.shape) < 2:
-                aft.mask = np.zeros_like(aft, dtype=bool)
-
-            # get patient to subtype map and subset entropy vectors
-            patient_to_subtype = p.map_to_external_reference_aminoacids(region, refname=refname)
-            subtype_entropy = ref.get_entropy_in_patient_region(patient_to_subtype)
-            good_ref = ref.good_pos_in_reference[patient_to_subtype[:,0]]
-
-            # loop over times and calculate the correlation for each value
-            for t, af in izip(p.dsi, aft):
-                patient_entropy = np.maximum(0,-np.sum(af[:-1]*np.log(1e-10+af[:-1]), axis=0))[patient_to_subtype[:,1]]
-                # good_af is a mask for useful columns
-                good_af = (~np.any(af.mask, axis=0)[patient_to_subtype[:,1]]) & good_ref
-                if good_af.sum() > 0.5 * good_af.shape[0]:
-                    rho,pval = spearmanr(patient_entropy[good_af], subtype_entropy[good_af])
-                    correlations.append({'pcode':pcode,
-                                 'region': region,
-                                 'time': t,
-                                 'rho': rho,
-                                 'pval': pval})
-
-    return pd.DataFrame(correlations)
-
-
-def collect_diverse_sites(patients, regions, cov_min=1000, af_threshold=0.01, subtype='patient', refname='HXB2'):
-    '''Fraction of sites that are diverse for different quantiles of subtype entropy'''
+    for t, rho_t, pval_t in izip(p.dsi[ind], rho, pval):
+        correlations.append({'pcode':pcode,
+                     'region': region,
+                     'time': t,
+                     'rho': rho_t,
+                     'pval': pval_t})
+    return correlations
+
+
+def _correlations_patient_region(pcode, region, cov_min, subtype, refname, sequence_type='nuc'):
+    '''Correlation of subtype entropy and intra-patient diversity in one patient region'''
+    # reference alignment of group M (subtype='any') or of the patient's subtype
+    pr = load_patient_region(pcode, region, cov_min=cov_min, refname=refname,
+                             subtype=subtype, type=sequence_type)
+    return _correlations_from_region(pr)
+
+
+def _diverse_sites_from_region(pr, af_threshold):
+    '''Fraction of diverse sites per subtype entropy quantile in one loaded patient region'''
+    pcode, region = pr['pcode'], pr['region']
+    p, aft, patient_to_subtype = pr['patient'], pr['aft'], pr['patient_to_subtype']
+    nquantiles = 4
+    entropy_quantile, thresholds = get_quantile_labels(nquantiles, pr['subtype_entropy'])
+    good_ref = pr['good_ref']
+
+    # diverse sites (minor alleles above af_threshold) at mappable positions of all times
+    # good_af is a mask for useful columns
+    af = aft[:, :, patient_to_subtype[:,-1]]
+    good_af = (~np.ma.getmaskarray(af).any(axis=1)) & good_ref
+    af = np.ma.getdata(af)
+    with np.errstate(invalid='ignore'):
+        diverse = af.max(axis=1) < af.sum(axis=1) - af_threshold
+
+    # fraction of diverse sites for every time and quantile, as one grouped mean
+    ntimes = len(p.dsi)
+    ind = good_af & (entropy_quantile >= 0)
+    group = (np.arange(ntimes)[:, None] * nquantiles + entropy_quantile)[ind]
+    nsites = np.bincount(group, minlength=ntimes * nquantiles)
+    ndiverse = np.bincount(group, weights=diverse[ind], minlength=ntimes * nquantiles)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = (ndiverse / nsites).reshape(ntimes, nquantiles)
+
     diverse_fraction = []
-    if subtype=='any':
-        ref = HIVreference(refname=refname, subtype='any')
-        good_pos_in_reference = ref.get_ungapped(threshold = 0.05)
-
-    for pi, pcode in enumerate(patients):
-        p = Patient.load(pcode)
-
-        if subtype=='patient':
-            ref = HIVreference(refname=refname, subtype=p['Subtype'])
-            good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-
-        for region in regions:
-            aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min)
-            if len(aft.mask.shape)<2:
-                aft.mask = np.zeros_like(aft, dtype=bool)
-
-            # get patient to subtype map and subset entropy vectors
-            patient_to_subtype = p.map_to_external_reference(region, refname=refname)
-            subtype_entropy = ref.get_entropy_in_patient_region(patient_to_subtype)
-            entropy_quantiles = get_quantiles(4, subtype_entropy)
-            good_ref = good_pos_in_reference[patient_to_subtype[:,0]]
-
-            # loop over times and calculate the correlation for each value
-            for t, af in izip(p.dsi,aft):
-                good_af = (~np.any(af.mask, axis=0)[patient_to_subtype[:,2]]) & good_ref
-                tmp_af = af[:,patient_to_subtype[:,2]]
-                # tmp_af has only columns that are mappable to the reference
-                # good_af is a mask for useful columns
-                # Squant['ind'] below is a mask for positions corresponding to an entropy quantile (at mappable positions) 
-                tmp = {'S'+str(i+1):np.mean(tmp_af[:,Squant['ind']*good_af].max(axis=0)\
-                                           <tmp_af[:,Squant['ind']*good_af].sum(axis=0)-af_threshold)
-                                        for i, Squant in entropy_quantiles.iteritems()}
-                tmp.update({'pcode':pcode,'region':region,'time':t})
-                diverse_fraction.append(tmp)
-
-    return pd.DataFrame(diverse_fraction)
-
-
-def collect_diverse_sites_aminoacids(patients, regions, cov_min=1000, af_threshold=0.01, subtype='patient', refname='HXB2'):
+    for t, frac in izip(p.dsi, fraction):
+        tmp = {'S'+str(i+1): frac[i] for i in xrange(nquantiles)}
+        tmp.update({'pcode':pcode,'region':region,'time':t})
+        diverse_fraction.append(tmp)
+    return diverse_fraction
+
+
+def _diverse_sites_patient_region(pcode, region, cov_min, af_threshold, subtype, refname,
+                                  sequence_type='nuc'):
+    '''Fraction of diverse sites per subtype entropy quantile in one patient region'''
+    # reference alignment of group M (subtype='any') or of the patient's subtype
+    pr = load_patient_region(pcode, region, cov_min=cov_min, refname=refname,
+                             subtype=subtype, type=sequence_type)
+    return _diverse_sites_from_region(pr, af_threshold)
+
+
+def collect_correlations(patients, regions, cov_min=1000, subtype='patient', refname='HXB2',
+                         jobs=1):
+    '''Correlation of subtype entropy and intra-patient diversity'''
+    correlations = map_patient_regions(_correlations_patient_region, patients, regions,
+                                       jobs=jobs, cov_min=cov_min, subtype=subtype,
+                                       refname=refname)
+    return pd.DataFrame(merge_rows(correlations))
+
+
+def collect_correlations_aminoacids(patients, regions, cov_min=1000, subtype='patient', refname='HXB2',
+                                    jobs=1):
+    '''Correlation of subtype entropy and intra-patient diversity'''
+    correlations = map_patient_regions(_correlations_patient_region, patients, regions,
+                                       jobs=jobs, patient_major=False, cov_min=cov_min,
+                                       subtype=subtype, refname=refname, sequence_type='aa')
+    return pd.DataFrame(merge_rows(correlations))
+
+
+def collect_diverse_sites(patients, regions, cov_min=1000, af_threshold=0.01, subtype='patient', refname='HXB2',
+                          jobs=1):
     '''Fraction of sites that are diverse for different quantiles of subtype entropy'''
-    ps = {pcode: Patient.load(pcode) for pcode in patients}
+    diverse_fraction = map_patient_regions(_diverse_sites_patient_region, patients, regions,
+                                           jobs=jobs, cov_min=cov_min, af_threshold=af_threshold,
+                                           subtype=subtype, refname=refname)
+    return pd.DataFrame(merge_rows(diverse_fraction))
 
-    diverse_fraction = []
-    for region in regions:
-        print region
-
-        if subtype=='any':
-            ref = HIVreferenceAminoacid(refname=refname, subtype='any')
-            ref.good_pos_in_reference = ref.get_ungapped(threshold = 0.05)
-        else:
-            refs = {}
-            for subtype in ['B', 'C', 'AE']:
-                ref = HIVreferenceAminoacid(region, refname=refname, subtype=subtype)
-                ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-                refs[subtype] = ref
-
-        for pi, pcode in enumerate(patients):
-            p = ps[pcode]
-
-            if subtype=='patient':
-                ref = refs[p['Subtype']]
-
-            aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min, type='aa')
-            if len(aft.mask.shape)<2:
-                aft.mask = np.zeros_like(aft, dtype=bool)
-
-            # get patient to subtype map and subset entropy vectors
-            patient_to_subtype = p.map_to_external_reference_aminoacids(region, refname=refname)
-            subtype_entropy = ref.get_entropy_in_patient_region(patient_to_subtype)
-            entropy_quantiles = get_quantiles(4, subtype_entropy)
-            good_ref = ref.good_pos_in_reference[patient_to_subtype[:,0]]
-
-            # loop over times and calculate the correlation for each value
-            for t, af in izip(p.dsi,aft):
-                good_af = (~np.any(af.mask, axis=0)[patient_to_subtype[:,1]]) & good_ref
-                tmp_af = af[:,patient_to_subtype[:,1]]
-                # tmp_af has only columns that are mappable to the reference
-                # good_af is a mask for useful columns
-                # Squant['ind'] below is a mask for positions corresponding to an entropy quantile (at mappable positions) 
-                tmp = {'S'+str(i+1):np.mean(tmp_af[:,Squant['ind']*good_af].max(axis=0)\
-                                           <tmp_af[:,Squant['ind']*good_af].sum(axis=0)-af_threshold)
-                                        for i, Squant in entropy_quantiles.iteritems()}
-                tmp.update({'pcode':pcode,'region':region,'time':t})
-                diverse_fraction.append(tmp)
-
-    return pd.DataFrame(diverse_fraction)
+
+def collect_diverse_sites_aminoacids(patients, regions, cov_min=1000, af_threshold=0.01, subtype='patient', refname='HXB2',
+                                     jobs=1):
+    '''Fraction of sites that are diverse for different quantiles of subtype entropy'''
+    diverse_fraction = map_patient_regions(_diverse_sites_patient_region, patients, regions,
+                                           jobs=jobs, patient_major=False, cov_min=cov_min,
+                                           af_threshold=af_threshold, subtype=subtype,
+                                           refname=refname, sequence_type='aa')
+    return pd.DataFrame(merge_rows(diverse_fraction))
+
+
+def collect_subtype_correlation_data(patients, regions, cov_min=1000, af_threshold=0.01,
+                                     subtype='patient', refname='HXB2', sequence_type='nuc',
+                                     jobs=1):
+    '''Entropy correlations and diverse site fractions from one pass over the data
+
+    Same results as collect_correlations and collect_diverse_sites (or their amino acid
+    versions), but every patient region is loaded and mapped only once.
+
+    Returns:
+       correlations, diverse_fraction
+    '''
+    results = scan(patients, regions,
+                   {'correlations': (_correlations_from_region, {}),
+                    'diverse_fraction': (_diverse_sites_from_region,
+                                         {'af_threshold': af_threshold})},
+                   subtypes=[subtype], cov_min=cov_min, refname=refname,
+                   sequence_type=sequence_type, jobs=jobs,
+                   patient_major=(sequence_type == 'nuc'))[subtype]
+    return (pd.DataFrame(merge_rows(results['correlations'])),
+            pd.DataFrame(merge_rows(results['diverse_fraction'])))
 
 
 def plot_subtype_correlation(data, fig_filename=None, figtypes=['.png', '.svg', '.pdf']):
@@ -292,6 +247,7 @@ if __name__=="__main__":
                         help='Sequence type (nuc or aa)')
     parser.add_argument('--reference', choices=['HXB2', 'NL4-3'], default='HXB2',
                         help='Reference')
+    add_jobs_argument(parser)
 
     params = parser.parse_args()
     if params.groupM:
@@ -307,36 +263,28 @@ if __name__=="__main__":
         fn_data = fn_data + '_'+params.reference
     if params.type == 'aa':
         fn_data = fn_data + '_aa'
-    fn_data = fn_data + '.pickle'
-
-    if not os.path.isfile(fn_data) or params.redo:
-        regions = ['p17', 'p24', 'PR', 'RT', 'p15', 'IN', 'vif', 'gp41', 'gp120', 'nef']
-        #regions = ['p24', 'p17', 'RT1', 'RT2', 'RT3', 'RT4', 'PR', 
-        #           'IN1', 'IN2', 'IN3','p15', 'vif', 'nef','gp41','gp1201']
-        cov_min = 1000
-        af_threshold = 0.01
-
-        if params.type == 'nuc':
-            # determine correlations between intra patient diversity and subtype diversity
-            correlations = collect_correlations(patients, regions, cov_min=cov_min,
-                                                refname=params.reference,
-                                                subtype=subtype)
-
-            # determine genome wide fraction of alleles above a threshold
-            diverse_fraction = collect_diverse_sites(patients, regions, 
-                                    cov_min=cov_min, af_threshold=af_threshold,
-                                                refname=params.reference,
-                                                     subtype=subtype)
-
-        else:
-            correlations = collect_correlations_aminoacids(patients, regions, cov_min=cov_min, subtype=subtype,
-                                                refname=params.reference,
-                                                          )
-            diverse_fraction = collect_diverse_sites_aminoacids(patients, regions, 
-                                    cov_min=cov_min, af_threshold=af_threshold,
-                                                refname=params.reference,
-                                                     subtype=subtype)
+    fn_data = fn_data + '.bundle'
+
+    regions = ['p17', 'p24', 'PR', 'RT', 'p15', 'IN', 'vif', 'gp41', 'gp120', 'nef']
+    #regions = ['p24', 'p17', 'RT1', 'RT2', 'RT3', 'RT4', 'PR', 
+    #           'IN1', 'IN2', 'IN3','p15', 'vif', 'nef','gp41','gp1201']
+    cov_min = 1000
+    af_threshold = 0.01
 
+    if use_stored_data(fn_data, redo=params.redo):
+        data = load_data(fn_data)
+    else:
+        # correlations between intra patient diversity and subtype diversity and the
+        # fraction of alleles above a threshold, collected in one pass over the data
+        correlations, diverse_fraction = cached_collect(collect_subtype_correlation_data, fn_data,
+                                                        args=(patients, regions),
+                                                        kwargs={'cov_min': cov_min,
+                                                                'af_threshold': af_threshold,
+                                                                'refname': params.reference,
+                                                                'subtype': subtype,
+                                                                'sequence_type': params.type,
+                                                                'jobs': params.jobs},
+                                                        redo=params.redo)
 
         data={'correlations': correlations,
               'diverse_fraction': diverse_fraction,
@@ -345,9 +293,7 @@ if __name__=="__main__":
               'cov_min':cov_min,
               'threshold':af_threshold}
         store_data(data, fn_data)
-    else:
-        print("Loading data from file")
-        data = load_data(fn_data)
+    print_cache_info()
 
 fig_filename = foldername+'entropy_correlation'
 if params.type == 'aa':
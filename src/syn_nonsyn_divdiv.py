@@ -10,7 +10,11 @@ from hivevo.hivevo.patients import Patient
 from hivevo.hivevo.samples import all_fragments
 from hivevo.hivevo.af_tools import divergence, diversity
 from util import store_data, load_data, draw_genome, fig_width, fig_fontsize, add_panel_label, HIVEVO_colormap
-from util import boot_strap_patients, replicate_func, add_binned_column
+from util import boot_strap_patient_means, replicate_func, add_binned_column
+from sfs import SiteFrequencySpectrum
+from cache import cached_collect, use_stored_data
+from cohort import load_patient, get_allele_frequency_trajectories
+from parallel import map_patient_regions, add_jobs_argument
 import os
 from filenames import get_figure_folder
 
@@ -26,9 +30,8 @@ def collect_data_richard(patients, regions, syn_degeneracy=2):
 
     nbins=10
     sfs_tmin=1000
-    sfs = {'syn':np.zeros(nbins, dtype=float),
-           'nonsyn':np.zeros(nbins, dtype='float'),
-           'bins':np.linspace(0.01,0.99,nbins+1)}
+    sfs = {'bins':np.linspace(0.01,0.99,nbins+1)}
+    spectrum = SiteFrequencySpectrum()
     time_binc = 0.5*(time_bins[1:]+time_bins[:-1])
     cov_min = 100
     for pi, pcode in enumerate(patients):
@@ -57,17 +60,17 @@ def collect_data_richard(patients, regions, syn_degeneracy=2):
 
                     syn_derived = syn_mask.copy()
                     syn_derived[initial_indices, np.arange(syn_derived.shape[1])]=False
-                    for t,af in izip(p.dsi,aft):
-                        if t>sfs_tmin:
-                            y,x = np.histogram(af[syn_derived].flatten(), bins=sfs['bins'])
-                            sfs['syn']+=y
                     nonsyn_derived = syn_mask==False
                     nonsyn_derived*=(p.get_constrained(prot)==False)*(gaps==False)
                     nonsyn_derived[initial_indices, np.arange(syn_derived.shape[1])]=False
-                    for t,af in izip(p.dsi,aft):
-                        if t>sfs_tmin:
-                            y,x = np.histogram(af[nonsyn_derived], bins=sfs['bins'])
-                            sfs['nonsyn']+=y
+                    for t,af in izip(p.dsi,np.ma.getdata(aft)):
+                        spectrum.add(pcode, 'syn', t, af[syn_derived])
+                        spectrum.add(pcode, 'nonsyn', t, af[nonsyn_derived])
+
+    # SFS of the time points after sfs_tmin
+    for mutclass in ['syn', 'nonsyn']:
+        sfs[mutclass] = spectrum.histogram(sfs['bins'], labels=[mutclass],
+                                           time_window=(np.nextafter(sfs_tmin, np.inf), np.inf))
 
     for tmp_data in [syn_divergence, syn_diversity, nonsyn_diversity, nonsyn_divergence]:
         for region in regions:
@@ -79,79 +82,101 @@ def collect_data_richard(patients, regions, syn_degeneracy=2):
 
     data = {'syn_diversity':syn_diversity, 'syn_divergence':syn_divergence,
             'nonsyn_diversity':nonsyn_diversity, 'nonsyn_divergence':nonsyn_divergence,
-            'sfs':sfs}
+            'sfs':sfs, 'spectrum':spectrum}
 
     return data
 
 
-def collect_data_fabio(patients, regions, cov_min=100, syn_degeneracy=2):
+def _divdiv_patient_protein(pcode, region_prot, cov_min=100, syn_degeneracy=2):
+    '''Divergence/diversity rows and site frequency spectrum of one patient protein'''
+    from itertools import izip
+
+    region, prot = region_prot
+    p = load_patient(pcode)
+    aft = get_allele_frequency_trajectories(pcode, prot, cov_min=cov_min)
+    initial_indices = p.get_initial_indices(prot)
+    gaps = p.get_gaps_by_codon(prot, pad=2, threshold=0.05)
+
+    # Classify syn/nonsyn POSITIONS
+    # NOTE: this is not fully correct because some positions (2-fold
+    # degenerate) are both syn and nonsyn, but it's close enough
+    syn_mask = p.get_syn_mutations(prot)
+    syn_sum = syn_mask.sum(axis=0)
+    # NOTE: syn_mask == 0 are substitutions, they make up most
+    # of the nonsynonymous signal
+    pos = {'syn': (syn_sum >= syn_degeneracy) & (~gaps),
+           'nonsyn': (syn_sum <= 1) & (~p.get_constrained(prot)) & (~gaps),
+          }
+
+    print pcode, prot, pos['syn'].sum(), pos['nonsyn'].sum()
+
+    # Divergence/diversity of all time points at once, the same reductions as
+    # af_tools.divergence and af_tools.diversity along the sites of each class
+    mutclasses = pos.keys()
+    divg = []
+    divs = []
+    for mutclass in mutclasses:
+        ind = pos[mutclass].nonzero()[0]
+        af = aft[:, :, ind]
+        total = af.sum(axis=1).mean(axis=1)
+        divg.append(total - af[:, initial_indices[ind], np.arange(len(ind))].mean(axis=1))
+        divs.append(total - (af**2).sum(axis=1).mean(axis=1))
+
+    # rows ordered by time, then mutation class
+    ntimes, nclasses = len(p.dsi), len(mutclasses)
+    data = {'pcode': np.repeat(pcode, ntimes * nclasses),
+            'time': np.repeat(np.asarray(p.dsi, float), nclasses),
+            'region': np.repeat(region, ntimes * nclasses),
+            'protein': np.repeat(prot, ntimes * nclasses),
+            'nsites': np.tile([pos[mutclass].sum() for mutclass in mutclasses], ntimes),
+            'mutclass': np.tile(mutclasses, ntimes),
+            'divergence': np.ma.filled(np.ma.array(divg, dtype=float).T, np.nan).ravel(),
+            'diversity': np.ma.filled(np.ma.array(divs, dtype=float).T, np.nan).ravel(),
+           }
+
+    # Site frequency spectrum of derived alleles, all time points (as np.histogram
+    # would, this takes the frequencies regardless of the mask)
+    syn_derived = syn_mask.copy()
+    syn_derived[initial_indices, np.arange(syn_derived.shape[1])] = False
+    nonsyn_derived = (~syn_mask) & (~p.get_constrained(prot)) & (~gaps)
+    nonsyn_derived[initial_indices, np.arange(syn_derived.shape[1])] = False
+
+    sfs = SiteFrequencySpectrum()
+    for t, af in izip(p.dsi, np.ma.getdata(aft)):
+        sfs.add(pcode, 'syn', t, af[syn_derived])
+        sfs.add(pcode, 'nonsyn', t, af[nonsyn_derived])
+
+    return data, sfs
+
+
+def collect_data_fabio(patients, regions, cov_min=100, syn_degeneracy=2, jobs=1):
     '''Collect data for divergence and diversity'''
     import pandas as pd
-    from itertools import izip
 
-    # Prepare SFS
+    # one unit per patient and protein, proteins labelled by their region
+    prots = [(region, prot) for region, region_prots in regions.iteritems()
+             for prot in region_prots]
+    results = map_patient_regions(_divdiv_patient_protein, patients, prots, jobs=jobs,
+                                  cov_min=cov_min, syn_degeneracy=syn_degeneracy)
+
+    # SFS of the late time points, the spectrum can be rebinned later
+    spectrum = SiteFrequencySpectrum()
+    for rows, sfs_prot in results:
+        spectrum.merge(sfs_prot)
     nbins=10
     sfs_tmin=1000
-    sfs = {'syn': np.zeros(nbins, dtype=float),
-           'nonsyn': np.zeros(nbins, dtype=float),
-           'bins': np.linspace(0.01, 0.99, nbins+1),
-          }
+    sfs = {'bins': np.linspace(0.01, 0.99, nbins+1)}
+    for mutclass in ['syn', 'nonsyn']:
+        sfs[mutclass] = spectrum.histogram(sfs['bins'], labels=[mutclass],
+                                           time_window=(sfs_tmin, np.inf))
 
-    # Collect into DataFrame
-    data = []
-    for pi, pcode in enumerate(patients):
-        p = Patient.load(pcode)
-        for region, prots in regions.iteritems():
-            for prot in prots:
-                aft = p.get_allele_frequency_trajectories(prot, cov_min=cov_min)
-                initial_indices = p.get_initial_indices(prot)
-                gaps = p.get_gaps_by_codon(prot, pad=2, threshold=0.05)
-
-                # Classify syn/nonsyn POSITIONS
-                # NOTE: this is not fully correct because some positions (2-fold
-                # degenerate) are both syn and nonsyn, but it's close enough
-                syn_mask = p.get_syn_mutations(prot)
-                syn_sum = syn_mask.sum(axis=0)
-                # NOTE: syn_mask == 0 are substitutions, they make up most
-                # of the nonsynonymous signal
-                pos = {'syn': (syn_sum >= syn_degeneracy) & (~gaps),
-                       'nonsyn': (syn_sum <= 1) & (~p.get_constrained(prot)) & (~gaps),
-                      }
-
-                print pcode, prot, pos['syn'].sum(), pos['nonsyn'].sum()
-
-                # Divergence/diversity
-                for t, af in izip(p.dsi, aft):
-                    for mutclass, ind in pos.iteritems():
-                        data.append({'pcode': pcode,
-                                     'time': t,
-                                     'region': region,
-                                     'protein': prot,
-                                     'nsites': ind.sum(),
-                                     'mutclass': mutclass,
-                                     'divergence': divergence(af[:, ind], initial_indices[ind]),
-                                     'diversity': diversity(af[:, ind]),
-                                    })
-
-
-                # Site frequency spectrum
-                syn_derived = syn_mask.copy()
-                syn_derived[initial_indices, np.arange(syn_derived.shape[1])] = False
-                nonsyn_derived = (-syn_mask) & (-p.get_constrained(prot)) & (-gaps)
-                nonsyn_derived[initial_indices, np.arange(syn_derived.shape[1])] = False
-
-                for t,af in izip(p.dsi,aft):
-                    if t < sfs_tmin:
-                        continue
-
-                    sfs['syn'] += np.histogram(af[syn_derived], bins=sfs['bins'])[0]
-                    sfs['nonsyn'] += np.histogram(af[nonsyn_derived], bins=sfs['bins'])[0]
-
-
-    data = pd.DataFrame(data)
-    data['divergence'] = data['divergence'].astype(float)
-    data['diversity'] = data['diversity'].astype(float)
-    return {'divdiv':data, 'sfs':sfs}
+    # Collect into DataFrame, label columns as categoricals
+    columns = ['divergence', 'diversity', 'mutclass', 'nsites', 'pcode', 'protein', 'region', 'time']
+    data = pd.DataFrame({col: np.concatenate([rows[col] for rows, sfs_prot in results])
+                         for col in columns}, columns=columns)
+    for col in ['pcode', 'region', 'protein', 'mutclass']:
+        data[col] = data[col].astype('category')
+    return {'divdiv':data, 'sfs':sfs, 'spectrum': spectrum}
 
 
 def plot_divdiv(data, fig_filename=None, figtypes=['.png', '.svg', '.pdf']):
@@ -200,7 +225,7 @@ def plot_divdiv(data, fig_filename=None, figtypes=['.png', '.svg', '.pdf']):
                 ind = (divdiv.loc[:,'region']==region) & (divdiv.loc[:,'mutclass']==mutclass)
                 tmp = divdiv.loc[ind,['time_bin', 'diversity', 'divergence', 'pcode']]
                 avg_divdiv = get_time_bin_mean(tmp)
-                bs = boot_strap_patients(tmp, eval_func = get_time_bin_mean, n_bootstrap=n_bootstrap)
+                bs = boot_strap_patient_means(tmp, 'time_bin', columns=['diversity', 'divergence'], n_bootstrap=n_bootstrap)
                 # plot the same line with and without error bars, labels for legend without
                 ax.plot(time_binc/365.25, avg_divdiv.loc[:,dtype], ls='-' if mutclass=='nonsyn' else '--',
                             c=colors[region], lw=3, label=label_func(mutclass, region, dtype))
@@ -275,28 +300,29 @@ if __name__=="__main__":
 
     parser = argparse.ArgumentParser(description="Make figure for divergence and diversity")
     parser.add_argument('--redo', action='store_true', help='recalculate data')
+    add_jobs_argument(parser)
     params = parser.parse_args()
 
     username = os.path.split(os.getenv('HOME'))[-1]
     foldername = get_figure_folder(username, 'first')
     fn_data = foldername+'data/'
     fn2_data = fn_data + 'divdiv_correlation.pickle'
-    fn_data = fn_data + 'syn_nonsyn_divergence.pickle'
-
-    if not os.path.isfile(fn_data) or params.redo:
-        patients = ['p1', 'p2', 'p3','p5', 'p6', 'p8', 'p9', 'p10','p11']
-        regions = {'structural':['gag'], #['p17', 'p24'],
-                    'enzymes':  ['pol'], #['PR', 'RT', 'p15', 'IN'],
-                    'accessory': ['vif', 'nef', 'vpr', 'vpu', 'tat', 'rev'],
-                    'envelope': ['env'] #['gp41', 'gp120'],
-                    }
+    fn_data = fn_data + 'syn_nonsyn_divergence.bundle'
+
+    patients = ['p1', 'p2', 'p3','p5', 'p6', 'p8', 'p9', 'p10','p11']
+    regions = {'structural':['gag'], #['p17', 'p24'],
+                'enzymes':  ['pol'], #['PR', 'RT', 'p15', 'IN'],
+                'accessory': ['vif', 'nef', 'vpr', 'vpu', 'tat', 'rev'],
+                'envelope': ['env'] #['gp41', 'gp120'],
+                }
+    if use_stored_data(fn_data, redo=params.redo):
+        data = load_data(fn_data)
+    else:
         # NOTE: these two give the same result, good
-        data = collect_data_fabio(patients, regions)
-        #data = collect_data_richard(patients, regions)
+        data = cached_collect(collect_data_fabio, fn_data, args=(patients, regions),
+                              kwargs={'jobs': params.jobs}, redo=params.redo)
+        #data = cached_collect(collect_data_richard, fn_data, args=(patients, regions), redo=params.redo)
         store_data(data, fn_data)
-    else:
-        print("Loading data from file")
-        data = load_data(fn_data)
 
     # this load additional data produced by script divergence_diversity_correlation
     data['divdiv_corr'] = load_data(fn2_data)
@@ -4,328 +4,327 @@ Script generating the figures and collecting the data on reversion towards conse
 # Modules
 import os, sys
 import numpy as np
+import pandas as pd
 from itertools import izip
 
-from hivevo.hivevo.patients import Patient
-from hivevo.hivevo.HIVreference import HIVreference, HIVreferenceAminoacid
 from hivevo.hivevo.af_tools import divergence
 
 from util import store_data, load_data, fig_width, fig_fontsize, add_panel_label ,add_binned_column,HIVEVO_colormap
-from util import boot_strap_patients, replicate_func
+from util import boot_strap_patient_means, replicate_func
+from cache import cached_collect, use_stored_data
+from cohort import load_patient_region, print_cache_info
+from parallel import map_patient_regions, merge_rows, add_jobs_argument
+from scan import scan
 from filenames import get_figure_folder
 
 
 
 # Functions
+def _to_away_kernel(aft, good_ref, away_sites, ancestral, consensus, entropy,
+                    Sbins, af_thres):
+    '''Entropy and allele frequency bin averages of to/away sites for all time points
+
+    Sites (the columns of aft, the mapped positions in reference order) are assigned
+    their entropy bin and away flag once, the averages of all time points and bins are
+    then grouped reductions with np.bincount. Sites are used at a time point if none of their alleles
+    are masked, the major allele is not a gap or N, and the reference is good there.
+
+    Returns:
+       dict of (time x bin) or (time,) arrays, NaN where no site contributes
+    '''
+    nt, nsites = aft.shape[0], aft.shape[-1]
+    nS, naf = len(Sbins)-1, len(af_thres)-1
+    sites = np.arange(nsites)
+
+    af = np.ma.getdata(aft)
+    good = ((~np.ma.getmaskarray(aft).any(axis=1)) &
+            (af.argmax(axis=1) < af.shape[1] - 2)) & good_ref
+    # drop the last allele (N) like the per time point version
+    af = af[:, :-1]
+    total = af.sum(axis=1)
+    minor = total - af.max(axis=1)
+    derived = total - af[:, ancestral, sites]
+    reversion = af[:, consensus, sites]
+
+    def grouped_mean(values, groups, ngroups, mask, counts=None):
+        groups, values = groups[mask], values[mask]
+        sums = np.bincount(groups, weights=values, minlength=ngroups)
+        if counts is None:
+            counts = np.bincount(groups, minlength=ngroups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    # entropy bins and away flags are per site, broadcast over time
+    sbin = np.searchsorted(Sbins, entropy, side='right') - 1
+    in_sbin = good & (sbin >= 0) & (sbin < nS)
+    time_ind = np.repeat(np.arange(nt), nsites).reshape(nt, nsites)
+    gS = (time_ind * nS + sbin) * 2 + away_sites
+    res = {}
+    for name, values in [('minor', minor), ('derived', derived)]:
+        means = grouped_mean(values, gS, nt*nS*2, in_sbin).reshape(nt, nS, 2)
+        res['af_away_'+name] = means[:, :, 1]
+        res['af_to_'+name] = means[:, :, 0]
+
+    ngood = good.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res['reversion'] = (reversion * (~away_sites) * good).sum(axis=1) / ngood
+        res['divergence'] = (derived * good).sum(axis=1) / ngood
+
+    # allele frequency spectra at sites where the founder differs from consensus,
+    # averaged over all such sites (not only those in the frequency bin)
+    to_sites = good & (~away_sites)
+    nto = to_sites.sum(axis=1)
+    for name, values in [('reversion_spectrum', reversion), ('minor_reversion_spectrum', derived)]:
+        afbin = np.searchsorted(af_thres, values, side='right') - 1
+        in_afbin = to_sites & (afbin >= 0) & (afbin < naf)
+        sums = np.bincount((time_ind * naf + afbin)[in_afbin], weights=values[in_afbin],
+                           minlength=nt*naf).reshape(nt, naf)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            res[name] = sums / nto[:, None]
+    return res
+
+
+def _to_away_from_region(pr, Sbins=[0,0.02, 0.08, 0.25, 2]):
+    '''Collect the quantities of collect_to_away for one loaded patient region'''
+    pcode, region = pr['pcode'], pr['region']
+    p, aft, patient_to_subtype = pr['patient'], pr['aft'], pr['patient_to_subtype']
+    ancestral, consensus, good_ref = pr['ancestral'], pr['consensus'], pr['good_ref']
+    # convert entropy to bits
+    subtype_entropy = pr['subtype_entropy'] / np.log(2.0)
+    away_sites = ancestral == consensus
+    consensus_distance = {(pcode, region): np.mean(~away_sites)}
+    print pcode, region, "dist:", 1-away_sites.mean(), "useful_ref:", good_ref.mean()
+
+    # average the af in entropy bins for all times at once
+    times = p.dsi[:aft.shape[0]]
+    # decode only the time points with dates and the mapped sites
+    aft = aft[:len(times), :, patient_to_subtype[:, -1]]
+    af_thres = [0, 0.05, 0.1, 0.25, 0.5, 0.95, 1.0]
+    res = _to_away_kernel(aft, good_ref, away_sites,
+                          ancestral, consensus, subtype_entropy, Sbins, af_thres)
+
+    # for each time and entropy bin, the average divergence and minor variation
+    minor_variants = [{'pcode': pcode,
+                       'region': region,
+                       'time': t,
+                       'S_bin': sbin,
+                       'af_away_minor': res['af_away_minor'][ti, sbin],
+                       'af_away_derived': res['af_away_derived'][ti, sbin],
+                       'af_to_minor': res['af_to_minor'][ti, sbin],
+                       'af_to_derived': res['af_to_derived'][ti, sbin]}
+                      for ti, t in enumerate(times) for sbin in xrange(len(Sbins)-1)]
+
+    # reversion at sites were the founder differs from consensus and total divergence
+    to_away_divergence = [{'pcode': pcode,
+                           'region': region,
+                           'time': t,
+                           'reversion': res['reversion'][ti],
+                           'divergence': res['divergence'][ti]}
+                          for ti, t in enumerate(times)]
+
+    # minor variation at sites were the founder differs from consensus
+    # in different allele frequency bins
+    to_away_minor = [{'pcode': pcode,
+                      'region': region,
+                      'time': t,
+                      'af_bin': ai,
+                      'reversion_spectrum': res['reversion_spectrum'][ti, ai],
+                      'minor_reversion_spectrum': res['minor_reversion_spectrum'][ti, ai]}
+                     for ti, t in enumerate(times) for ai in xrange(len(af_thres)-1)]
+
+    return minor_variants, to_away_divergence, to_away_minor, consensus_distance
+
+
+def _collect_to_away_patient_region(pcode, region, Sbins=[0,0.02, 0.08, 0.25, 2], cov_min=1000,
+                                    refname='HXB2', subtype='patient', sequence_type='nuc'):
+    '''Collect the quantities of collect_to_away for one patient and region'''
+    pr = load_patient_region(pcode, region, cov_min=cov_min, refname=refname,
+                             subtype=subtype, type=sequence_type)
+    return _to_away_from_region(pr, Sbins=Sbins)
+
+
+def _merge_to_away(results):
+    '''Merge the per patient and region results of _collect_to_away_patient_region'''
+    consensus_distance = {}
+    for res in results:
+        consensus_distance.update(res[3])
+
+    return (pd.DataFrame(merge_rows([res[0] for res in results])),
+            pd.DataFrame(merge_rows([res[1] for res in results])),
+            pd.DataFrame(merge_rows([res[2] for res in results])),
+            consensus_distance)
+
+
 def collect_to_away(patients, regions, Sbins=[0,0.02, 0.08, 0.25, 2], cov_min=1000,
                     refname='HXB2',
-                    subtype='patient'):
+                    subtype='patient',
+                    jobs=1):
     '''Collect allele frequencies polarized from cross-sectional consensus
 
     Collect minor variant frequencies, divergences, etc separately for sites that agree or disagree
     with consensus. consensus is either group M consensus (subtype='any') or the subtype of the 
     respective patient (subtype='patient'). In addition, these quantities are stratified by entropy
     '''
-
-    minor_variants = []
-    to_away_divergence = []
-    to_away_minor = []
-    consensus_distance = {}
-    # if subtypes == 'any' meaning comparison to groupM, we can load the reference here
-    if subtype=='any':
-        ref = HIVreference(refname=refname, subtype=subtype)
-        ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-
     # determine divergence and minor variation at sites that agree with consensus or not
-    for pi, pcode in enumerate(patients):
-        p = Patient.load(pcode)
-        if subtype == 'patient': # if we take the subtype of the patient, load specific ref alignment here
-            ref = HIVreference(refname=refname, subtype=p['Subtype'])
-            ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-        for region in regions:
-            aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min)
-
-            # get patient to subtype map and subset entropy vectors, convert to bits
-            patient_to_subtype = p.map_to_external_reference(region, refname=refname)
-            subtype_entropy = ref.get_entropy_in_patient_region(patient_to_subtype) / np.log(2.0)
-            ancestral = p.get_initial_indices(region)[patient_to_subtype[:, -1]]
-            consensus = ref.get_consensus_indices_in_patient_region(patient_to_subtype)
-            away_sites = ancestral == consensus
-            good_ref = ref.good_pos_in_reference[patient_to_subtype[:,0]]
-            consensus_distance[(pcode, region)] = np.mean(~away_sites)
-            print pcode, region, "dist:", 1-away_sites.mean(), "useful_ref:", good_ref.mean()
-
-            # loop over times and calculate the af in entropy bins
-            for t, af in izip(p.dsi, aft):
-                good_af = (((~np.any(af.mask, axis=0))
-                            #&(aft[0].max(axis=0)>0.9)
-                            &(af.argmax(axis=0) < af.shape[0] - 2))[patient_to_subtype[:, -1]]) \
-                            & good_ref
-                # make version of all arrays that contain only unmasked sites and are also ungapped
-                clean_af = af[:,patient_to_subtype[:, -1]][:-1, good_af]
-                clean_away = away_sites[good_af]
-                clean_consensus = consensus[good_af]
-                clean_ancestral = ancestral[good_af]
-                clean_entropy = subtype_entropy[good_af]
-                clean_entropy_bins = [(clean_entropy >= t_lower) & (clean_entropy < t_upper)
-                                    for t_lower, t_upper in zip(Sbins[:-1], Sbins[1:])]
-                clean_minor = clean_af.sum(axis=0) - clean_af.max(axis=0)
-                clean_derived = clean_af.sum(axis=0) - clean_af[clean_ancestral,np.arange(clean_ancestral.shape[0])]
-                print pcode, region, t
-                
-                # for each entropy bin, calculate the average divergence and minor variation
-                for sbin, sites in enumerate(clean_entropy_bins):
-                    minor_variants.append({'pcode': pcode,
-                                           'region': region,
-                                           'time': t,
-                                           'S_bin': sbin,
-                                           'af_away_minor':  np.mean(clean_minor[sites&clean_away]), 
-                                           'af_away_derived':np.mean(clean_derived[sites&clean_away]),
-                                           'af_to_minor':    np.mean(clean_minor[sites&(~clean_away)]), 
-                                           'af_to_derived':  np.mean(clean_derived[sites&(~clean_away)])
-                                          })
-
-                # calculate the minor variation at sites were the founder differs from consensus
-                # in different allele frequency bins
-                clean_reversion = clean_af[clean_consensus,np.arange(clean_consensus.shape[0])]*(~clean_away)
-                clean_total_divergence = clean_af.sum(axis=0) - clean_af[clean_ancestral,np.arange(clean_ancestral.shape[0])]
-                to_away_divergence.append({'pcode': pcode,
-                                           'region': region,
-                                           'time': t,
-                                           'reversion': np.mean(clean_reversion), 
-                                           'divergence': np.mean(clean_total_divergence)
-                                          })
-
-                af_thres = [0, 0.05, 0.1, 0.25, 0.5, 0.95, 1.0]
-                rev_tmp = clean_af[clean_consensus,np.arange(clean_consensus.shape[0])][~clean_away]
-                der_tmp = clean_derived[~clean_away] 
-                for ai,(af_lower, af_upper) in enumerate(zip(af_thres[:-1], af_thres[1:])):
-                    to_away_minor.append({'pcode': pcode,
-                                          'region': region,
-                                          'time': t,
-                                          'af_bin': ai,
-                      'reversion_spectrum': np.mean(rev_tmp*(rev_tmp>=af_lower)*(rev_tmp<af_upper)),
-                      'minor_reversion_spectrum': np.mean(der_tmp*(der_tmp>=af_lower)*(der_tmp<af_upper))
-                                         })
-
-    return (pd.DataFrame(minor_variants),
-            pd.DataFrame(to_away_divergence),
-            pd.DataFrame(to_away_minor),
-            consensus_distance)
+    results = map_patient_regions(_collect_to_away_patient_region, patients, regions,
+                                  jobs=jobs, Sbins=Sbins, cov_min=cov_min,
+                                  refname=refname, subtype=subtype)
+    return _merge_to_away(results)
 
 
 def collect_to_away_aminoacids(patients, regions, Sbins=[0, 0.1, 0.3, 3], cov_min=1000,
                                refname='HXB2',
-                               subtype='patient'):
+                               subtype='patient',
+                               jobs=1):
     '''Collect allele frequencies polarized from cross-sectional consensus for amino acids
 
     Collect minor variant frequencies, divergences, etc separately for sites that agree or disagree
     with consensus. consensus is either group M consensus (subtype='any') or the subtype of the 
     respective patient (subtype='patient'). In addition, these quantities are stratified by entropy
     '''
-    ps = {pcode: Patient.load(pcode) for pcode in patients}
-
-    minor_variants = []
-    to_away_divergence = []
-    to_away_minor = []
-    consensus_distance = {}
-    for region in regions:
-        print region
+    # determine divergence and minor variation at sites that agree with consensus or not
+    results = map_patient_regions(_collect_to_away_patient_region, patients, regions,
+                                  jobs=jobs, patient_major=False, Sbins=Sbins, cov_min=cov_min,
+                                  refname=refname, subtype=subtype, sequence_type='aa')
+    return _merge_to_away(results)
 
-        # if subtypes == 'any' meaning comparison to groupM, we can load the reference here
-        if subtype == 'any':
-            ref = HIVreferenceAminoacid(region, refname=refname, subtype=subtype)
-            ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-        else:
-            refs = {}
-            for subtype in ['B', 'C', 'AE']:
-                ref = HIVreferenceAminoacid(region, refname=refname, subtype=subtype)
-                ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-                refs[subtype] = ref
-
-        # determine divergence and minor variation at sites that agree with consensus or not
-        for pi, pcode in enumerate(patients):
-            p = ps[pcode]
-            if subtype == 'patient': # if we take the subtype of the patient, load specific ref alignment here
-                ref = refs[p['Subtype']]
-
-            aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min,
-                                                      type='aa')
-
-            # get patient to subtype map and subset entropy vectors, convert to bits
-            patient_to_subtype = p.map_to_external_reference_aminoacids(region, refname=refname)
-            subtype_entropy = ref.get_entropy_in_patient_region(patient_to_subtype) / np.log(2.0)
-            ancestral = p.get_initial_indices(region, type='aa')[patient_to_subtype[:, -1]]
-            consensus = ref.get_consensus_indices_in_patient_region(patient_to_subtype)
-            away_sites = ancestral == consensus
-            good_ref = ref.good_pos_in_reference[patient_to_subtype[:, 0]]
-            consensus_distance[(pcode, region)] = np.mean(~away_sites)
-            print pcode, region, "dist:", 1-away_sites.mean(), "useful_ref:", good_ref.mean()
-
-            # loop over times and calculate the af in entropy bins
-            for t, af in izip(p.dsi, aft):
-                good_af = (((~np.any(af.mask, axis=0))
-                            #&(aft[0].max(axis=0)>0.9)
-                            &(af.argmax(axis=0) < af.shape[0] - 2))[patient_to_subtype[:, -1]]) \
-                            & good_ref
-                # make version of all arrays that contain only unmasked sites and are also ungapped
-                clean_af = af[:,patient_to_subtype[:, -1]][:-1, good_af]
-                clean_away = away_sites[good_af]
-                clean_consensus = consensus[good_af]
-                clean_ancestral = ancestral[good_af]
-                clean_entropy = subtype_entropy[good_af]
-                clean_entropy_bins = [(clean_entropy >= t_lower) & (clean_entropy < t_upper)
-                                    for t_lower, t_upper in zip(Sbins[:-1], Sbins[1:])]
-                clean_minor = clean_af.sum(axis=0) - clean_af.max(axis=0)
-                clean_derived = clean_af.sum(axis=0) - clean_af[clean_ancestral,np.arange(clean_ancestral.shape[0])]
-                print pcode, region, t
-                
-                # for each entropy bin, calculate the average divergence and minor variation
-                for sbin, sites in enumerate(clean_entropy_bins):
-                    minor_variants.append({'pcode': pcode,
-                                           'region': region,
-                                           'time': t,
-                                           'S_bin': sbin,
-                                           'af_away_minor':  np.mean(clean_minor[sites&clean_away]), 
-                                           'af_away_derived':np.mean(clean_derived[sites&clean_away]),
-                                           'af_to_minor':    np.mean(clean_minor[sites&(~clean_away)]), 
-                                           'af_to_derived':  np.mean(clean_derived[sites&(~clean_away)])
-                                          })
-
-                # calculate the minor variation at sites were the founder differs from consensus
-                # in different allele frequency bins
-                clean_reversion = clean_af[clean_consensus,np.arange(clean_consensus.shape[0])]*(~clean_away)
-                clean_total_divergence = clean_af.sum(axis=0) - clean_af[clean_ancestral,np.arange(clean_ancestral.shape[0])]
-                to_away_divergence.append({'pcode': pcode,
-                                           'region': region,
-                                           'time': t,
-                                           'reversion': np.mean(clean_reversion), 
-                                           'divergence': np.mean(clean_total_divergence)
-                                          })
-
-                af_thres = [0, 0.05, 0.1, 0.25, 0.5, 0.95, 1.0]
-                rev_tmp = clean_af[clean_consensus,np.arange(clean_consensus.shape[0])][~clean_away]
-                der_tmp = clean_derived[~clean_away] 
-                for ai,(af_lower, af_upper) in enumerate(zip(af_thres[:-1], af_thres[1:])):
-                    to_away_minor.append({'pcode': pcode,
-                                          'region': region,
-                                          'time': t,
-                                          'af_bin': ai,
-                      'reversion_spectrum': np.mean(rev_tmp*(rev_tmp>=af_lower)*(rev_tmp<af_upper)),
-                      'minor_reversion_spectrum': np.mean(der_tmp*(der_tmp>=af_lower)*(der_tmp<af_upper))
-                                         })
-
-    return (pd.DataFrame(minor_variants),
-            pd.DataFrame(to_away_divergence),
-            pd.DataFrame(to_away_minor),
-            consensus_distance)
 
+def _toaway_histograms_from_region(pr, Sc=1, af_bins=np.linspace(0, 1, 11)):
+    '''Count the ancestral allele frequencies of one loaded patient region
 
-def get_toaway_histograms(subtype, Sc=1, refname='HXB2'):
+    Returns:
+       pcode, times and counts (class (to, away) x Sbin (low, high) x time x af_bin)
+    '''
+    pcode = pr['pcode']
+    p, aft, patient_to_subtype = pr['patient'], pr['aft'], pr['patient_to_subtype']
+    ancestral, consensus, good_ref = pr['ancestral'], pr['consensus'], pr['good_ref']
+    # convert entropy to bits
+    subtype_entropy = pr['subtype_entropy'] / np.log(2.0)
+    away_sites = ancestral==consensus
+    times = p.dsi
+    nt, naf = len(times), len(af_bins)-1
+
+    # ancestral allele frequencies at the mapped sites, time x site
+    aft_anc = aft[:nt, ancestral, patient_to_subtype[:, -1]]
+    freqs = np.ma.getdata(aft_anc)
+
+    # class, entropy class and af bin of every frequency, NaN entropies are in no class
+    cls = np.repeat(away_sites[None, :].astype(int), nt, axis=0)
+    Sbin = np.where(subtype_entropy < Sc, 0, 1)
+    has_Sbin = (subtype_entropy < Sc) | (subtype_entropy >= Sc)
+    afbin = np.searchsorted(af_bins, freqs, side='right') - 1
+    # like np.histogram, the last bin includes its right edge
+    afbin[freqs == af_bins[-1]] = naf - 1
+    time_ind = np.repeat(np.arange(nt)[:, None], len(ancestral), axis=1)
+    ind = (~np.ma.getmaskarray(aft_anc)) & (has_Sbin & good_ref) \
+          & (afbin >= 0) & (afbin < naf)
+
+    groups = ((cls * 2 + Sbin) * nt + time_ind) * naf + afbin
+    counts = np.bincount(groups[ind], minlength=4*nt*naf).reshape(2, 2, nt, naf)
+    return pcode, times, counts
+
+
+def _toaway_histograms_patient_region(pcode, region, subtype='patient', Sc=1, cov_min=1000,
+                                      af_bins=np.linspace(0, 1, 11), refname='HXB2',
+                                      sequence_type='nuc'):
+    '''Count the ancestral allele frequencies of one patient and region, see above'''
+    print 'subtype:', subtype, "patient", pcode
+    pr = load_patient_region(pcode, region, cov_min=cov_min, refname=refname,
+                             subtype=subtype, type=sequence_type)
+    return _toaway_histograms_from_region(pr, Sc=Sc, af_bins=af_bins)
+
+
+def _merge_toaway_histograms(patients, results, af_bins):
+    '''Sum the per patient and region counts into one tensor over the union of times'''
+    times = np.unique(np.concatenate([res[1] for res in results])) if results else np.zeros(0)
+    counts = np.zeros((len(patients), 2, 2, len(times), len(af_bins)-1), dtype=int)
+    present = np.zeros((len(patients), len(times)), dtype=bool)
+    for pcode, unit_times, unit_counts in results:
+        pi = patients.index(pcode)
+        ti = np.searchsorted(times, unit_times)
+        counts[pi][:, :, ti] += unit_counts
+        present[pi, ti] = True
+
+    return {'counts': counts,
+            'present': present,
+            'patients': list(patients),
+            'times': times,
+            'classes': ['to', 'away'],
+            'Sbins': ['low', 'high'],
+            'af_bins': np.asarray(af_bins)}
+
+
+def get_histogram_views(histograms):
+    '''Dict views of the count tensor: to and away histograms {(pcode, Sbin): {time: counts}}'''
+    views = []
+    for cls in ['to', 'away']:
+        ci = histograms['classes'].index(cls)
+        views.append({(pcode, Sbin): {t: histograms['counts'][pi, ci, si, ti]
+                                      for ti, t in enumerate(histograms['times'])
+                                      if histograms['present'][pi, ti]}
+                      for pi, pcode in enumerate(histograms['patients'])
+                      for si, Sbin in enumerate(histograms['Sbins'])})
+    return tuple(views)
+
+
+def get_toaway_histograms(patients, regions, subtype, Sc=1, cov_min=1000,
+                          af_bins=np.linspace(0, 1, 11), refname='HXB2', jobs=1):
     '''Calculate SFS for towards/away from cross-sectional consensus
 
     Calculate allele frequency histograms for each patient and each time points
     separately for sites that agree or disagree with consensus.
     this can be done for a low and high entropy category with the threshold set by Sc
+
+    Returns a dict with the count tensor (patient x class x Sbin x time x af_bin), see
+    get_histogram_views for the histograms as dicts by patient, entropy class and time.
     '''
+    results = map_patient_regions(_toaway_histograms_patient_region, patients, regions,
+                                  jobs=jobs, subtype=subtype, Sc=Sc, cov_min=cov_min,
+                                  af_bins=af_bins, refname=refname)
+    return _merge_toaway_histograms(list(patients), results, af_bins)
 
-    away_histogram = {(pcode, Sbin):{} for Sbin in ['low','high'] for pcode in patients}
-    to_histogram = {(pcode, Sbin):{} for Sbin in ['low','high'] for pcode in patients}
-    # if subtypes == 'any' meaning comparison to groupM, we can load the reference here
-    if subtype=='any':
-        ref = HIVreference(refname=refname, subtype=subtype)
-        ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
 
-    # determine divergence and minor variation at sites that agree with consensus or not
-    for pi, pcode in enumerate(patients):
-        p = Patient.load(pcode)
-        print 'subtype:', subtype, "patient", pcode
-        if subtype == 'patient': # if we take the subtype of the patient, load specific ref alignment here
-            ref = HIVreference(refname=refname, subtype=p['Subtype'])
-            ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-        for region in regions:
-            aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min)
-
-            # get patient to subtype map and subset entropy vectors, convert to bits
-            patient_to_subtype = p.map_to_external_reference(region, refname=refname)
-            subtype_entropy = ref.get_entropy_in_patient_region(patient_to_subtype)/np.log(2.0)
-            ancestral = p.get_initial_indices(region)[patient_to_subtype[:,2]]
-            consensus = ref.get_consensus_indices_in_patient_region(patient_to_subtype)
-            good_ref = ref.good_pos_in_reference[patient_to_subtype[:,0]]
-            away_sites = ancestral==consensus
-            aft_ref = aft[:,:,patient_to_subtype[:,2]]
-
-            # H is the dict ot add this too, sites are the consensus/non consensus positions
-            for H, sites in [(away_histogram, away_sites), (to_histogram, ~away_sites)]:
-                for Sbin in ['low', 'high']:
-                    if Sbin=='low': # make a boolean array with the relevant positions == True
-                        ind = (sites)&(subtype_entropy<Sc)&(good_ref)
-                    else:                    
-                        ind = (sites)&(subtype_entropy>=Sc)&(good_ref)
-                    for ti,t in enumerate(p.dsi): # for each time point, make and allele frequency histogram
-                        y,x = np.histogram(aft_ref[ti,ancestral[ind],np.where(ind)[0]].compressed(), bins=af_bins)
-                        H[(pcode, Sbin)][t]=y
-
-    return to_histogram, away_histogram
-
-
-def get_toaway_histograms_aminoacids(subtype, Sc=1, refname='HXB2'):
+def get_toaway_histograms_aminoacids(patients, regions, subtype, Sc=1, cov_min=1000,
+                                     af_bins=np.linspace(0, 1, 11), refname='HXB2', jobs=1):
     '''Calculate SFS for towards/away from cross-sectional consensus for amino acids
 
     Calculate allele frequency histograms for each patient and each time points
     separately for sites that agree or disagree with consensus.
     this can be done for a low and high entropy category with the threshold set by Sc
     '''
-    ps = {pcode: Patient.load(pcode) for pcode in patients}
-
-    away_histogram = {(pcode, Sbin):{} for Sbin in ['low','high'] for pcode in patients}
-    to_histogram = {(pcode, Sbin):{} for Sbin in ['low','high'] for pcode in patients}
-    for region in regions:
-
-        # if subtypes == 'any' meaning comparison to groupM, we can load the reference here
-        if subtype=='any':
-            ref = HIVreferenceAminoacid(region, refname=refname, subtype=subtype)
-            ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-        else:
-            refs = {}
-            for subtype in ['B', 'C', 'AE']:
-                ref = HIVreferenceAminoacid(region, refname=refname, subtype=subtype)
-                ref.good_pos_in_reference = ref.get_ungapped(threshold=0.05)
-                refs[subtype] = ref
-
-        # determine divergence and minor variation at sites that agree with consensus or not
-        for pi, pcode in enumerate(patients):
-            p = ps[pcode]
-            print 'subtype:', subtype, "patient", pcode
-
-            if subtype == 'patient': # if we take the subtype of the patient, load specific ref alignment here
-                ref = refs[p['Subtype']]
-
-            aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min,
-                                                      type='aa')
-
-            # get patient to subtype map and subset entropy vectors, convert to bits
-            patient_to_subtype = p.map_to_external_reference_aminoacids(region, refname=refname)
-            subtype_entropy = ref.get_entropy_in_patient_region(patient_to_subtype) / np.log(2.0)
-            ancestral = p.get_initial_indices(region, type='aa')[patient_to_subtype[:, -1]]
-            consensus = ref.get_consensus_indices_in_patient_region(patient_to_subtype)
-            good_ref = ref.good_pos_in_reference[patient_to_subtype[:, 0]]
-            away_sites = ancestral == consensus
-            aft_ref = aft[:,:,patient_to_subtype[:, -1]]
-
-            # H is the dict ot add this too, sites are the consensus/non consensus positions
-            for H, sites in [(away_histogram, away_sites), (to_histogram, ~away_sites)]:
-                for Sbin in ['low', 'high']:
-                    if Sbin=='low': # make a boolean array with the relevant positions == True
-                        ind = (sites)&(subtype_entropy<Sc)&(good_ref)
-                    else:                    
-                        ind = (sites)&(subtype_entropy>=Sc)&(good_ref)
-                    for ti,t in enumerate(p.dsi): # for each time point, make and allele frequency histogram
-                        y, x = np.histogram(aft_ref[ti,ancestral[ind], np.where(ind)[0]].compressed(),
-                                            bins=af_bins)
-                        H[(pcode, Sbin)][t] = y
-
-    return to_histogram, away_histogram
+    results = map_patient_regions(_toaway_histograms_patient_region, patients, regions,
+                                  jobs=jobs, patient_major=False, subtype=subtype, Sc=Sc,
+                                  cov_min=cov_min, af_bins=af_bins, refname=refname,
+                                  sequence_type='aa')
+    return _merge_toaway_histograms(list(patients), results, af_bins)
+
+
+def collect_to_away_data(patients, regions, subtypes=['patient', 'any'],
+                         Sbins=[0,0.02, 0.08, 0.25, 2], Sc=1, cov_min=1000,
+                         af_bins=np.linspace(0, 1, 11), refname='HXB2', sequence_type='nuc',
+                         jobs=1):
+    '''To/away quantities and histograms for several references from one pass over the data
+
+    Same results as collect_to_away and get_toaway_histograms (or their amino acid
+    versions) for every subtype in subtypes, but every patient region is loaded only
+    once and mapped once per reference.
+
+    Returns:
+       dict {subtype: {'to_away': output of collect_to_away,
+                       'toaway_histograms': output of get_toaway_histograms}}
+    '''
+    results = scan(patients, regions,
+                   {'to_away': (_to_away_from_region, {'Sbins': Sbins}),
+                    'toaway_histograms': (_toaway_histograms_from_region,
+                                          {'Sc': Sc, 'af_bins': af_bins})},
+                   subtypes=subtypes, cov_min=cov_min, refname=refname,
+                   sequence_type=sequence_type, jobs=jobs,
+                   patient_major=(sequence_type == 'nuc'))
+    return {subtype: {'to_away': _merge_to_away(res['to_away']),
+                      'toaway_histograms': _merge_toaway_histograms(list(patients),
+                                                                    res['toaway_histograms'],
+                                                                    af_bins)}
+            for subtype, res in results.iteritems()}
 
 
 def plot_to_away(data, fig_filename=None, figtypes=['.png', '.svg', '.pdf'],
@@ -372,14 +371,12 @@ def plot_to_away(data, fig_filename=None, figtypes=['.png', '.svg', '.pdf'],
         mv.loc[:,['af_away_minor', 'af_away_derived', 'af_to_minor', 'af_to_derived']] = \
             mv.loc[:,['af_away_minor', 'af_away_derived', 'af_to_minor', 'af_to_derived']].astype(float)
         mean_to_away =get_Sbin_mean(mv)
-        bs = boot_strap_patients(mv,
-                                 eval_func=get_Sbin_mean,
-                                 n_bootstrap=nbs, 
-                                 columns=['af_away_minor',
-                                          'af_away_derived',
-                                          'af_to_minor',
-                                          'af_to_derived',
-                                          'S_bin'])
+        bs = boot_strap_patient_means(mv, 'S_bin',
+                                      n_bootstrap=nbs,
+                                      columns=['af_away_minor',
+                                               'af_away_derived',
+                                               'af_to_minor',
+                                               'af_to_derived'])
 
         print mean_to_away
         col = 'af_away_derived'
@@ -418,8 +415,8 @@ def plot_to_away(data, fig_filename=None, figtypes=['.png', '.svg', '.pdf'],
         to_away.loc[:,['reversion', 'divergence']] = \
                 to_away.loc[:,['reversion', 'divergence']].astype(float)
         rev_div = get_time_bin_means(to_away)
-        bs = boot_strap_patients(to_away, get_time_bin_means,  n_bootstrap = nbs, 
-                                 columns = ['reversion','divergence','time_bin'])
+        bs = boot_strap_patient_means(to_away, 'time_bin', n_bootstrap = nbs,
+                                      columns = ['reversion','divergence'])
         reversion_std = replicate_func(bs, 'reversion', np.std, bin_index='time_bin')
         total_div_std = replicate_func(bs, 'divergence', np.std, bin_index='time_bin')
         fraction = rev_div.loc[:,'reversion']/rev_div.loc[:,'divergence']
@@ -437,49 +434,45 @@ def plot_to_away(data, fig_filename=None, figtypes=['.png', '.svg', '.pdf'],
     ####################################################################################
     # make panel divergence vs time
     ####################################################################################
-    to_histogram=data['to_histogram']
-    away_histogram=data['away_histogram']
+    histograms=data['toaway_histograms']
     time_bins=data['time_bins']
     af_bins=data['af_bins']
     af_binc=0.5*(af_bins[1:]+af_bins[:-1])
 
-    def bin_time(freq_arrays, time_bins):  
-        '''sum up allele frequency histgrams corresponding to the same time bin'''
-        binned_hists = [np.zeros_like(af_binc) for ti in time_bins[1:]]
-        for hists in freq_arrays.values():
-            for t, y in hists.iteritems():
-                ti = np.searchsorted(time_bins, t)
-                if ti>0 and ti<len(time_bins):
-                    binned_hists[ti-1]+=y
+    def bin_time(hists, cls, time_bins):
+        '''sum up allele frequency histgrams corresponding to the same time bin
 
-        return binned_hists
+        Returns an array (patient and entropy class) x time bin x af_bin.
+        '''
+        counts = hists['counts'][:, hists['classes'].index(cls)]
+        counts = counts.reshape((-1,) + counts.shape[2:])
+        ti = np.searchsorted(time_bins, hists['times']) - 1
+        in_bin = (ti[:, None] == np.arange(len(time_bins)-1)).astype(float)
+        return np.tensordot(counts, in_bin, axes=(1, 0)).swapaxes(1, 2)
 
     def get_div(afhist, fixed=False):
-        '''return the fraction of fixed alleles or the mean divergence'''
+        '''return the fraction of fixed alleles or the mean divergence (along the last axis)'''
         if fixed:
-            return afhist[0]/afhist.sum()
+            return afhist[...,0]/afhist.sum(axis=-1)
         else:
-            return np.array(afhist[:-1]*(1-af_binc[:-1])).sum()/afhist.sum()
+            return (afhist[...,:-1]*(1-af_binc[:-1])).sum(axis=-1)/afhist.sum(axis=-1)
 
-    from random import choice
     ax = axs[0]
     time_binc = 0.5*(time_bins[1:]+time_bins[:-1])
     sym='o'
     fs = fig_fontsize
     color_count=0
     for subtype, ls in [('patient', '--'), ('any','-')]:
-        for toaway, H in [(u'founder = '+('group M' if subtype=='any' else 'subtype'),  away_histogram[subtype]), 
-                          (u'founder \u2260 '+('group M' if subtype=='any' else 'subtype'), to_histogram[subtype])]:
-            mean_hists = bin_time(H,time_bins)
-            div = [get_div(mean_hists[ti]) for ti in range(len(time_bins)-1)]
-            # make replicates and calculate bootstrap confidence intervals
-            replicates = []
-            all_keys = H.keys()
-            for ri in xrange(nbs):
-                bootstrap_keys = [all_keys[ii] for ii in np.random.randint(len(all_keys), size=len(all_keys))]
-                tmp = bin_time({key:H[key] for key in bootstrap_keys}, time_bins)
-                replicates.append([get_div(tmp[ti]) for ti in range(len(time_bins)-1)])
-            std_dev = np.array(replicates).std(axis=0)
+        for toaway, cls in [(u'founder = '+('group M' if subtype=='any' else 'subtype'), 'away'),
+                            (u'founder \u2260 '+('group M' if subtype=='any' else 'subtype'), 'to')]:
+            binned = bin_time(histograms[subtype], cls, time_bins)
+            div = get_div(binned.sum(axis=0))
+            # make replicates and calculate bootstrap confidence intervals: resample the
+            # (patient, entropy class) histograms with a matrix of multinomial weights
+            nunits = binned.shape[0]
+            weights = np.random.multinomial(nunits, np.ones(nunits)/nunits, size=nbs)
+            replicates = np.dot(weights, binned.reshape(nunits, -1)).reshape((nbs,) + binned.shape[1:])
+            std_dev = get_div(replicates).std(axis=0)
             ax.errorbar(time_binc/365.25, div, std_dev, ls = ls, lw=3, c=colors[color_count])
             ax.plot(time_binc/365.25, div, label = toaway, ls = ls, lw=3, c=colors[color_count]) # plot again with label to avoid error bars in legend
             color_count+=1
@@ -515,6 +508,7 @@ if __name__=="__main__":
                         help='Sequence type (nuc or aa)')
     parser.add_argument('--reference', choices=['HXB2', 'NL4-3'], default='HXB2',
                         help='Reference')
+    add_jobs_argument(parser)
     params = parser.parse_args()
 
     username = os.path.split(os.getenv('HOME'))[-1]
@@ -525,7 +519,7 @@ if __name__=="__main__":
         fn_data = fn_data + '_'+params.reference
     if params.type == 'aa':
         fn_data = fn_data + '_aa'
-    fn_data = fn_data + '.pickle'
+    fn_data = fn_data + '.bundle'
    
     #patients = ['p2', 'p3','p5', 'p8', 'p9','p11'] # subtype B
     #patients = ['p1', 'p6'] # other subtypes
@@ -545,38 +539,38 @@ if __name__=="__main__":
 
     Sbinc = 0.5 * (Sbins[1:] + Sbins[:-1])
 
-    if not os.path.isfile(fn_data) or params.redo:
-        af_bins = np.linspace(0,1,11)
-        af_binc = 0.5*(af_bins[:-1]+af_bins[1:])
-        time_bins = np.array([-10, 500, 1000, 1500, 2000, 2500])
-        
+    af_bins = np.linspace(0,1,11)
+    af_binc = 0.5*(af_bins[:-1]+af_bins[1:])
+    time_bins = np.array([-10, 500, 1000, 1500, 2000, 2500])
+
+    if use_stored_data(fn_data, redo=params.redo):
+        data = load_data(fn_data)
+    else:
+        # both references and both analyses are collected in one pass over the data,
+        # cached as one result keyed by all parameters
+        subtypes = ['patient', 'any']
+        collected = cached_collect(collect_to_away_data, fn_data,
+                                   args=(patients, regions),
+                                   kwargs={'subtypes': subtypes,
+                                           'Sbins': Sbins,
+                                           'Sc': 10,
+                                           'cov_min': cov_min,
+                                           'af_bins': af_bins,
+                                           'refname': params.reference,
+                                           'sequence_type': params.type,
+                                           'jobs': params.jobs},
+                                   redo=params.redo)
+
         data = {}
-        data['away_histogram'] = {}
-        data['to_histogram']={}
+        data['toaway_histograms'] = {}
 
-        for subtype in ['patient', 'any']:
+        for subtype in subtypes:
             print subtype
 
-            if params.type == 'nuc':
-                (minor_variants,
-                 to_away_divergence,
-                 to_away_minor,
-                 consensus_distance) = collect_to_away(patients,
-                                                       regions,
-                                                       Sbins=Sbins,
-                                                       cov_min=cov_min,
-                                                       subtype=subtype,
-                                                       refname=params.reference)
-            else:
-                (minor_variants,
-                 to_away_divergence,
-                 to_away_minor,
-                 consensus_distance) = collect_to_away_aminoacids(patients,
-                                                       regions,
-                                                       Sbins=Sbins,
-                                                       cov_min=cov_min,
-                                                       subtype=subtype,
-                                                       refname=params.reference)
+            (minor_variants,
+             to_away_divergence,
+             to_away_minor,
+             consensus_distance) = collected[subtype]['to_away']
 
             # make sure data type is float (issues with NaNs and similia)
             tmp = ['reversion_spectrum', 'minor_reversion_spectrum']
@@ -590,25 +584,14 @@ if __name__=="__main__":
                              'Sbins': Sbins,
                              'Sbinc': Sbinc}
 
-            # get the allele frequency histograms for mutations away and towards consensus
-            if params.type == 'nuc':
-                (data['to_histogram'][subtype],
-                 data['away_histogram'][subtype]) = get_toaway_histograms(subtype,
-                                                                          Sc=10,
-                                                                          refname=params.reference)
-            else:
-                (data['to_histogram'][subtype],
-                 data['away_histogram'][subtype]) = get_toaway_histograms_aminoacids(subtype,
-                                                                          Sc=10,
-                                                                          refname=params.reference)
+            # the allele frequency histograms for mutations away and towards consensus
+            data['toaway_histograms'][subtype] = collected[subtype]['toaway_histograms']
 
             data['time_bins'] = time_bins
             data['af_bins'] = af_bins
 
         store_data(data, fn_data)
-    else:
-        print "Loading data from file"
-        data = load_data(fn_data)
+    print_cache_info()
 
     fig_filename = foldername+'to_away'
     if params.reference != 'HXB2':
@@ -0,0 +1,247 @@
+# vim: fdm=indent
+'''
+date:       18/10/26
+content:    Compact on-disk store of allele frequency trajectories.
+
+            Trajectories are float64 masked arrays (time x allele x position),
+            16 bytes per entry with the full boolean mask. The store keeps
+            each (patient, region, cov_min, type) once as frequencies quantized
+            to uint16 and a mask bit-packed along positions, 2.125 bytes per
+            entry. Both files are opened with np.memmap, so a stored cohort
+            lives in the page cache and is shared between processes.
+
+            Quantization: q = round(af * 65535), af' = q / 65535. The error is
+            at most 1 / 131070 (< 7.7e-6) for frequencies in [0, 1], and 0 and
+            1 are represented exactly.
+
+            The store is used by cohort.get_allele_frequency_trajectories if a
+            store folder is set (environment variable HIVEVO_TRAJECTORY_STORE
+            or set_store_folder). Entries are written on first use and
+            rewritten when the input data version (HIVEVO_DATA_VERSION, see
+            cache.get_data_version) changes or the entry cannot be read.
+
+            Each write of an entry has its own data files, named after a token
+            in the .json header, and the header is renamed into place last. A
+            reader thus always pairs a header with the data written with it,
+            also while another run rewrites the entry.
+'''
+# Modules
+import os
+import json
+import numpy as np
+
+
+# Globals
+quantization_levels = 2**16 - 1
+max_quantization_error = 0.5 / quantization_levels
+store_format = 2
+
+_store = {'folder': os.getenv('HIVEVO_TRAJECTORY_STORE')}
+
+
+
+# Classes
+class QuantizedTrajectories(object):
+    '''Memory-mapped quantized trajectories of one patient region
+
+    Indexing decodes only the selected entries, e.g. entry[:nt, :, positions] is
+    the same masked array as the full trajectories indexed that way.
+
+    Attributes:
+       shape  -- shape of the trajectories, time x allele x position
+       data_version -- version of the input data the entry was written from
+       codes  -- quantized frequencies, uint16 memmap of that shape
+       packed -- mask, bit-packed along the last axis (uint8 memmap)
+    '''
+    def __init__(self, fn_prefix, mmap_mode='r'):
+        header = read_header(fn_prefix)
+        if header is None:
+            raise IOError('Missing or unreadable trajectory store entry: '+fn_prefix)
+        if (header.get('format') != store_format or
+            header.get('levels') != quantization_levels):
+            raise ValueError('Incompatible trajectory store entry: '+fn_prefix)
+
+        self.fn_prefix = fn_prefix
+        self.shape = tuple(header['shape'])
+        self.data_version = header.get('data_version')
+        fn_data = get_data_prefix(fn_prefix, header['token'])
+        self.codes = np.memmap(fn_data+'.u16', dtype=np.uint16, mode=mmap_mode,
+                               shape=self.shape)
+        self.packed = np.memmap(fn_data+'.mask', dtype=np.uint8, mode=mmap_mode,
+                                shape=self.shape[:-1]+((self.shape[-1] + 7) // 8,))
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+
+    def __getitem__(self, index):
+        '''Masked array of the indexed entries, as indexing the full masked array'''
+        if not isinstance(index, tuple):
+            index = (index,)
+        if any(ind is Ellipsis for ind in index) or len(index) > self.ndim:
+            raise IndexError('Index with at most '+str(self.ndim)+' entries and no ellipsis')
+        index = index + (slice(None),) * (self.ndim - len(index))
+
+        def is_basic(ind):
+            return isinstance(ind, (slice, int, long, np.integer))
+
+        # unpack only the rows of the mask that are needed, unless integer or fancy indices
+        # on the first and last axes have to be broadcast together
+        if is_basic(index[-1]):
+            mask = self.get_mask(index[:-1])[..., index[-1]]
+        elif isinstance(index[0], slice):
+            mask = self.get_mask(index[0])[(Ellipsis,)+index[1:]]
+        else:
+            mask = self.get_mask()[index]
+        return np.ma.array(self.codes[index] / float(quantization_levels), mask=mask)
+
+
+    def __repr__(self):
+        return 'QuantizedTrajectories('+repr(self.fn_prefix)+', shape='+repr(self.shape)+')'
+
+
+    def get_frequencies(self, times=slice(None)):
+        '''Dequantized frequencies of some time points (index along the first axis)'''
+        return self.codes[times] / float(quantization_levels)
+
+
+    def get_mask(self, times=slice(None)):
+        '''Unpacked mask of some time points (index along the first axis)'''
+        return np.unpackbits(self.packed[times], axis=-1)[..., :self.shape[-1]].astype(bool)
+
+
+    def to_masked_array(self, times=slice(None)):
+        '''Float64 masked array of some time points, as returned by the patient'''
+        return np.ma.array(self.get_frequencies(times), mask=self.get_mask(times))
+
+
+
+# Functions
+def get_store_folder():
+    '''Folder of the trajectory store, None if the store is not used'''
+    return _store['folder']
+
+
+def set_store_folder(folder):
+    '''Use the trajectory store in folder (None to read the trajectories directly)'''
+    _store['folder'] = folder
+
+
+def get_store_prefix(folder, pcode, region, cov_min=None, type='nuc'):
+    '''Common filename prefix of the files of one store entry'''
+    return os.path.join(folder, '_'.join([pcode, region, type, 'cov'+str(cov_min)]))
+
+
+def quantize(aft):
+    '''Quantized frequencies (uint16) and mask of a masked trajectory array'''
+    mask = np.ma.getmaskarray(aft)
+    af = np.ma.getdata(aft)
+    if np.isnan(af[~mask]).any():
+        raise ValueError('Unmasked NaN frequencies cannot be quantized')
+    # masked entries carry no information, NaNs there become 0
+    af = np.where(mask, 0, np.clip(np.nan_to_num(af), 0, 1))
+    return np.rint(af * quantization_levels).astype(np.uint16), mask
+
+
+def get_data_prefix(fn_prefix, token):
+    '''Filename prefix of the data files of one write of a store entry'''
+    return fn_prefix+'.'+token
+
+
+def read_header(fn_prefix):
+    '''Header of a store entry (dict), None if there is none or it cannot be parsed'''
+    try:
+        with open(fn_prefix+'.json') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def get_data_version():
+    '''Version of the raw input data, as in cache.get_data_version without the store tag'''
+    return os.getenv('HIVEVO_DATA_VERSION', '')
+
+
+def write_trajectories(fn_prefix, aft, data_version=None):
+    '''Write a store entry for a masked trajectory array
+
+    The data files get a new token and the header pointing to them is renamed into
+    place last, so concurrent readers see either the old or the new entry, never a
+    mix. The data files of the replaced entry are removed afterwards (readers that
+    opened them keep their memory maps).
+    '''
+    if data_version is None:
+        data_version = get_data_version()
+    codes, mask = quantize(aft)
+    token = str(os.getpid())+'_'+os.urandom(4).encode('hex')
+    fn_data = get_data_prefix(fn_prefix, token)
+    fn_header_tmp = fn_prefix+'.json.'+token+'.tmp'
+    header = {'format': store_format, 'levels': quantization_levels,
+              'shape': list(codes.shape), 'data_version': data_version, 'token': token}
+    old = read_header(fn_prefix)
+    try:
+        codes.tofile(fn_data+'.u16')
+        np.packbits(mask, axis=-1).tofile(fn_data+'.mask')
+        with open(fn_header_tmp, 'w') as f:
+            json.dump(header, f)
+        os.rename(fn_header_tmp, fn_prefix+'.json')
+    except:
+        for fn in [fn_data+'.u16', fn_data+'.mask', fn_header_tmp]:
+            if os.path.isfile(fn):
+                os.remove(fn)
+        raise
+
+    if old is not None and old.get('token') != token:
+        # entries of the first format had no token
+        if old.get('token') is None:
+            fn_old = fn_prefix
+        else:
+            fn_old = get_data_prefix(fn_prefix, old['token'])
+        for ext in ['.u16', '.mask']:
+            try:
+                os.remove(fn_old+ext)
+            except OSError:
+                # removed by a parallel run
+                pass
+
+
+def load_trajectories(pcode, region, load, cov_min=None, type='nuc', folder=None):
+    '''Open the store entry of a patient region, writing it with load() if missing
+
+    Entries written from another version of the input data, in another format, or
+    whose data files are gone are written anew.
+
+    Parameters:
+       load   -- function returning the trajectories as a masked array
+       folder -- store folder (default: get_store_folder())
+
+    Returns:
+       QuantizedTrajectories
+    '''
+    if folder is None:
+        folder = get_store_folder()
+    fn_prefix = get_store_prefix(folder, pcode, region, cov_min=cov_min, type=type)
+    data_version = get_data_version()
+    if os.path.isfile(fn_prefix+'.json'):
+        try:
+            entry = QuantizedTrajectories(fn_prefix)
+        except (ValueError, KeyError, IOError, OSError):
+            entry = None
+        if entry is not None and entry.data_version == data_version:
+            return entry
+
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # created by a parallel run in the meantime
+            if not os.path.isdir(folder):
+                raise
+    write_trajectories(fn_prefix, load(), data_version=data_version)
+    return QuantizedTrajectories(fn_prefix)
@@ -42,26 +42,152 @@ def add_binned_column(df, bins, to_bin):
     # FIXME: this works, but is a little cryptic
     df.loc[:,to_bin+'_bin'] = np.minimum(len(bins)-2, np.maximum(0,np.searchsorted(bins, df.loc[:,to_bin])-1))
 
+def get_quantile_labels(q, arr):
+    '''
+    returns the index of the quantile (0..q-1) of every element of arr and the q+1
+    quantile thresholds. quantile i holds thresholds[i] <= arr < thresholds[i+1], as in
+    get_quantiles, elements in none of them (the maximum) are labelled -1
+    '''
+    from scipy.stats import scoreatpercentile
+    arr = np.asarray(arr)
+    thresholds = scoreatpercentile(arr, [100.0*i/q for i in range(q+1)])
+    labels = np.clip(np.searchsorted(thresholds, arr, side='right') - 1, 0, q-1)
+    # checks the interval explicitly, as comparisons with NaN thresholds are False
+    with np.errstate(invalid='ignore'):
+        inside = (arr >= thresholds[labels]) & (arr < thresholds[labels+1])
+    labels[~inside] = -1
+    return labels, thresholds
+
 def get_quantiles(q, arr):
     '''
     returns ranges and a boolean index map for each of the q quantiles of array arr 
     as a dict, {i:{'range':(start, stop), 'ind':[True, False, ...]},...}
     '''
-    from scipy.stats import scoreatpercentile
-    thresholds = [scoreatpercentile(arr, 100.0*i/q) for i in range(q+1)]
+    labels, thresholds = get_quantile_labels(q, arr)
     return {i: {'range':(thresholds[i],thresholds[i+1]), 
-                'ind':((arr>=thresholds[i])*(arr<thresholds[i+1]))}
+                'ind':labels==i}
            for i in range(q)}
 
+def masked_ranks(x, mask):
+    '''
+    returns the ranks (1 based, ties get their average rank) of x along the last axis,
+    counting only entries where mask is True in each row, NaN elsewhere
+    '''
+    x = np.asarray(x, dtype=float)
+    mask = np.asarray(mask, dtype=bool)
+    shape = x.shape
+    n = shape[-1]
+    x, mask = x.reshape(-1, n), mask.reshape(-1, n)
+    nrows = x.shape[0]
+
+    # sort each row, entries outside the mask last
+    order = np.lexsort((x, ~mask), axis=-1)
+    xs = np.take_along_axis(x, order, axis=-1)
+    ms = np.take_along_axis(mask, order, axis=-1)
+
+    # groups of ties, numbered across all rows
+    new_group = np.ones((nrows, n), dtype=bool)
+    new_group[:, 1:] = (xs[:, 1:] != xs[:, :-1]) | (ms[:, 1:] != ms[:, :-1])
+    groups = np.cumsum(new_group.ravel()) - 1
+    first_rank = np.tile(np.arange(1, n+1, dtype=float), nrows)[new_group.ravel()]
+    group_size = np.bincount(groups)
+    avg_rank = (first_rank + 0.5 * (group_size - 1))[groups].reshape(nrows, n)
+
+    ranks = np.empty((nrows, n))
+    np.put_along_axis(ranks, order, avg_rank, axis=-1)
+    ranks[~mask] = np.nan
+    return ranks.reshape(shape)
+
+
+def subset_ranks(x, mask):
+    '''
+    returns the ranks of the vector x within every row of mask (rows x len(x)), as
+    masked_ranks of x repeated for every row, but sorting x only once
+    '''
+    x = np.asarray(x, dtype=float)
+    mask = np.atleast_2d(np.asarray(mask, dtype=bool))
+    order = np.argsort(x, kind='mergesort')
+    xs = x[order]
+
+    # groups of ties in the sorted vector, ranks of a group from the counts of the
+    # entries in the mask in this and all lower groups
+    new_group = np.ones(len(x), dtype=bool)
+    new_group[1:] = xs[1:] != xs[:-1]
+    groups = np.cumsum(new_group) - 1
+    counts = np.add.reduceat(mask[:, order].astype(float), new_group.nonzero()[0], axis=1)
+    avg_rank = np.cumsum(counts, axis=1) - 0.5 * (counts - 1)
+
+    ranks = np.empty(mask.shape)
+    ranks[:, order] = avg_rank[:, groups]
+    ranks[~mask] = np.nan
+    return ranks
+
+
+def rank_correlation(rx, ry, mask):
+    '''
+    returns Spearman's rho along the last axis from ranks within mask (as from
+    masked_ranks), the Pearson correlation of the ranks, whose mean is (n+1)/2
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    center = 0.5 * (mask.sum(axis=-1) + 1)[..., None]
+    dx = np.where(mask, rx - center, 0)
+    dy = np.where(mask, ry - center, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (dx*dy).sum(axis=-1) / np.sqrt((dx**2).sum(axis=-1) * (dy**2).sum(axis=-1))
+
+
+def spearman_pvalue(rho, n):
+    '''two sided p-value of Spearman's rho for n observations (t-distribution, as scipy)'''
+    from scipy.stats import t as student_t
+    rho = np.asarray(rho, dtype=float)
+    dof = np.asarray(n, dtype=float) - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = rho * np.sqrt((dof / ((rho + 1.0) * (1.0 - rho))).clip(0))
+    return 2 * student_t.sf(np.abs(t), dof)
+
+
 def store_data(data, fn):
-    '''Store data to file for the plots'''
+    '''Store data to file for the plots
+
+    Filenames ending in .bundle are stored as directory bundles (see bundle.py).
+    '''
+    if fn.rstrip('/').endswith('.bundle'):
+        from bundle import store_bundle
+        store_bundle(data, fn)
+        return
+
     import cPickle as pickle
     with open(fn, 'wb') as f:
         pickle.dump(data, f, protocol=-1)
 
 
+def get_legacy_filename(fn):
+    '''Pickle that earlier versions of the scripts wrote instead of the bundle fn'''
+    if fn.rstrip('/').endswith('.bundle'):
+        return fn.rstrip('/')[:-len('.bundle')]+'.pickle'
+
+
+def data_exists(fn):
+    '''True if the data file fn (or the pickle it replaces) exists'''
+    import os
+    legacy = get_legacy_filename(fn)
+    return os.path.exists(fn) or (legacy is not None and os.path.isfile(legacy))
+
+
 def load_data(fn):
-    '''Load the data for the plots'''
+    '''Load the data for the plots (lazily for directory bundles)
+
+    A bundle that does not exist yet is created from the pickle of the same name
+    written by earlier versions of the scripts.
+    '''
+    import os
+    legacy = get_legacy_filename(fn)
+    if legacy is not None and not os.path.isdir(fn) and os.path.isfile(legacy):
+        store_data(load_data(legacy), fn)
+    if os.path.isdir(fn):
+        from bundle import load_bundle
+        return load_bundle(fn)
+
     import cPickle as pickle
     with open(fn, 'rb') as f:
         return pickle.load(f)
@@ -124,20 +250,116 @@ def boot_strap_patients(df, eval_func, columns=None,  n_bootstrap = 100):
         replicates.append(eval_func(bs))
     return replicates
 
-def replicate_func(reps, col, func, bin_index=None):
-    if bin_index is not None:
-        nbins = np.max([np.max(d.loc[:,bin_index]) for d in reps])+1
-        tmp = np.ma.zeros((len(reps), nbins), dtype = 'float')
-        tmp.mask = True
-        for ri, rep in enumerate(reps):
-            tmp[ri, rep.loc[:,bin_index]] = rep.loc[:,col]
+class BootstrapReplicates(object):
+    '''Grouped means of patient bootstrap replicates
+
+    means has shape (replicates, bins, columns), NaN for bins without data in a replicate.
+    '''
+    def __init__(self, means, columns):
+        self.means = means
+        self.columns = list(columns)
+
+    def __len__(self):
+        return self.means.shape[0]
+
+    def get_replicates(self, col):
+        '''Array (replicates x bins) of the means of col, bins up to the largest observed'''
+        observed = np.isfinite(self.means).any(axis=0).any(axis=1).nonzero()[0]
+        nbins = observed[-1]+1 if len(observed) else 0
+        return self.means[:, :nbins, self.columns.index(col)]
+
+
+def boot_strap_patient_means(df, bin_index, columns=None, n_bootstrap=100):
+    '''Bootstrap over patients of the mean of columns in each bin of bin_index
+
+    Equivalent to boot_strap_patients with eval_func = groupby(bin_index).mean(), but
+    the per patient and bin sums and counts are computed once and all replicates are
+    drawn at once as a (replicates x patients) matrix of multinomial patient weights.
+
+    Parameters:
+       df          -- DataFrame with a pcode column and integer bins in bin_index
+       columns     -- columns to average (default: all numeric columns but bin_index)
+       n_bootstrap -- number of replicates
+
+    Returns:
+       BootstrapReplicates, to be summarized with replicate_func
+    '''
+    import pandas as pd
+
+    if columns is None:
+        columns = [c for c in df.select_dtypes(include=[np.number]).columns if c != bin_index]
+    columns = [c for c in columns if c not in (bin_index, 'pcode')]
+
+    pcodes, patients = pd.factorize(df.loc[:,'pcode'])
+    bins = np.asarray(df.loc[:,bin_index], dtype=int)
+    npats, nbins = len(patients), (bins.max()+1 if len(bins) else 0)
+    ind = pcodes*nbins + bins
+
+    # sums and counts of non-NaN values per patient and bin (NaNs are skipped like in pandas)
+    sums = np.zeros((npats * nbins, len(columns)))
+    counts = np.zeros((npats * nbins, len(columns)))
+    for ci, col in enumerate(columns):
+        vals = np.asarray(df.loc[:,col], dtype=float)
+        good = ~np.isnan(vals)
+        sums[:,ci] = np.bincount(ind[good], weights=vals[good], minlength=npats*nbins)
+        counts[:,ci] = np.bincount(ind[good], minlength=npats*nbins)
+
+    # weight of each patient in each replicate: how often it was drawn
+    weights = np.random.multinomial(npats, np.ones(npats)/npats, size=n_bootstrap)
+    shape = (n_bootstrap, nbins, len(columns))
+    rep_sums = np.dot(weights, sums.reshape(npats, -1)).reshape(shape)
+    rep_counts = np.dot(weights, counts.reshape(npats, -1)).reshape(shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(rep_counts > 0, rep_sums / rep_counts, np.nan)
+    return BootstrapReplicates(means, columns)
+
+
+def get_replicate_array(reps, col, bin_index=None):
+    '''Dense float array (replicates x bins) of col, NaN where a replicate has no value
+
+    reps is either a list of replicate DataFrames (with bins in column bin_index, or one
+    row per bin in order if bin_index is None), BootstrapReplicates, or already a
+    (replicates x bins) array.
+    '''
+    if isinstance(reps, BootstrapReplicates):
+        return reps.get_replicates(col)
+    elif isinstance(reps, np.ndarray):
+        return np.asarray(reps, dtype=float)
+    elif bin_index is not None:
+        rep_ind = np.repeat(np.arange(len(reps)), [len(d) for d in reps])
+        bins = np.concatenate([np.asarray(d.loc[:,bin_index], dtype=int) for d in reps])
+        vals = np.concatenate([np.asarray(d.loc[:,col], dtype=float) for d in reps])
+        tmp = np.empty((len(reps), bins.max()+1 if len(bins) else 0))
+        tmp.fill(np.nan)
+        tmp[rep_ind, bins] = vals
+        return tmp
     else:
-        tmp = np.ma.array([d.loc[:,col] for d in reps])
-    try:
-        tmp.mask = np.isnan(tmp) | np.isinf(tmp)
-    except:
-        print "trouble masking " #,tmp
-    return func(tmp, axis=0)
+        return np.array([np.asarray(d.loc[:,col], dtype=float) for d in reps])
+
+
+# numpy reductions and their NaN-skipping counterparts
+_nan_reductions = {np.std: np.nanstd, np.var: np.nanvar, np.mean: np.nanmean,
+                   np.median: np.nanmedian, np.percentile: np.nanpercentile,
+                   np.sum: np.nansum, np.min: np.nanmin, np.max: np.nanmax}
+
+def replicate_func(reps, col, func, bin_index=None, **kwargs):
+    '''Summarize replicates with func over the replicate axis, ignoring NaN and inf
+
+    Standard numpy reductions (np.std, np.mean, np.percentile with q=..., ...) are
+    computed in one call of their NaN-aware version, other functions are applied to
+    the masked array of the replicates. Bins without any value are masked.
+    '''
+    import warnings
+
+    # a new array, get_replicate_array may return the caller's data
+    tmp = get_replicate_array(reps, col, bin_index=bin_index)
+    tmp = np.where(np.isfinite(tmp), tmp, np.nan)
+    if func in _nan_reductions:
+        with warnings.catch_warnings():
+            # all-NaN bins
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.ma.masked_invalid(_nan_reductions[func](tmp, axis=0, **kwargs))
+    return func(np.ma.masked_invalid(tmp), axis=0, **kwargs)
 
 
 def tree_from_json(json_file):